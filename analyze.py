@@ -0,0 +1,263 @@
+"""Run any of the four analyses without a window, e.g. on a compute node.
+
+    python analyze.py pyminis cell*.abf --config lab.json -o minis.npz
+    python analyze.py ca osc1:fmax1 osc2:fmax2 --workers 4 -o ca.parquet
+    python analyze.py baps bap1:bap2:bap3 --set fit_stop=1.2 -o baps.npz
+    python analyze.py atype cell1 cell2 --stats atype_stats.json
+    python analyze.py pyminis --defaults > minis.json
+
+Inputs are given as for jobs.py: a file or folder, or several joined with
+the path separator for the Ca oscillation and fmax folders or the bAP
+folders to average. The config file is JSON with the parameters of the
+app's window (the names printed by --defaults); one file can hold all four
+apps, each under its own name:
+
+    {"pyminis": {"rms_multiple": 3.5}, "ca": {"kd": 120, "background": 14}}
+
+--set overrides single values, anything not given takes the app's default.
+The inputs are analysed by --workers processes (all cores by default, 1
+runs them in this process, reading the next inputs on I/O threads while
+one is computed). The results of all inputs, with a File column,
+go to --output in a binary format chosen by its extension: .npz (numpy,
+one array per column), .parquet, .feather, .h5 or .pkl; read_results()
+reads them back. Load and compute time of every input, rows and failures
+are printed and, with --stats, written as JSON.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from jobs import BATCH_MODULES, app_paths
+from labcommon import jobqueue, prefetch
+
+FORMATS = ('.npz', '.parquet', '.feather', '.h5', '.hdf5', '.pkl')
+
+
+def batch_module(app):
+    import importlib
+    jobqueue._init_worker(app_paths())
+    return importlib.import_module(BATCH_MODULES[app])
+
+
+def read_config(path, app):
+    """The parameters for app in a JSON config file, from its own section if
+    the file has one."""
+    with open(path) as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError('%s does not contain a JSON object' % path)
+    if isinstance(config.get(app), dict):
+        return dict(config[app])
+    # a flat file, minus the sections of the other apps
+    return {key: val for key, val in config.items() if key not in BATCH_MODULES}
+
+
+def parse_set(items):
+    params = {}
+    for item in items:
+        key, sep, text = item.partition('=')
+        if not sep:
+            raise ValueError('--set takes name=value, not %r' % item)
+        try:
+            params[key] = json.loads(text)
+        except ValueError:
+            params[key] = text
+    return params
+
+
+def analyze_one(app, paths, params):
+    """Runs in a worker: (result, load seconds, compute seconds)."""
+    module = batch_module(app)
+    start = time.perf_counter()
+    data = module.load(paths, params)
+    loaded = time.perf_counter()
+    result = module.compute(data, params)
+    return result, loaded - start, time.perf_counter() - loaded
+
+
+def load_timed(module, paths, params):
+    """Runs on a prefetch thread: (data, load seconds, None), or (None, 0,
+    the error) so that one unreadable input does not end the prefetching."""
+    start = time.perf_counter()
+    try:
+        data = module.load(paths, params)
+    except Exception as err:
+        return None, 0.0, err
+    return data, time.perf_counter() - start, None
+
+
+def compute_timed(module, loaded, params):
+    """(result, load seconds, compute seconds) of a load_timed() result."""
+    data, load_s, err = loaded
+    if err is not None:
+        raise err
+    start = time.perf_counter()
+    result = module.compute(data, params)
+    return result, load_s, time.perf_counter() - start
+
+
+def run(app, inputs, params, workers=None, report=print):
+    """Analyses every input, returns (frames, stats) with one stats entry
+    per input in the order given."""
+    stats = [{'input': item, 'ok': False} for item in inputs]
+    frames = [None] * len(inputs)
+
+    def record(i, outcome):
+        entry = stats[i]
+        try:
+            result, entry['load_s'], entry['compute_s'] = outcome()
+        except Exception as err:
+            entry['error'] = ''.join(traceback.format_exception_only(
+                type(err), err)).strip()
+            report('error %s: %s' % (entry['input'], entry['error']))
+            return
+        entry['ok'] = True
+        entry['rows'] = len(result)
+        frames[i] = result
+        report('ok %s: %d row(s), load %.2f s, compute %.2f s' % (
+            entry['input'], entry['rows'], entry['load_s'],
+            entry['compute_s']))
+
+    jobs = [item.split(os.pathsep) for item in inputs]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(jobs) == 1:
+        module = batch_module(app)
+        loads = prefetch.imap(lambda i: load_timed(module, jobs[i], params),
+                              range(len(jobs)))
+        for i, loaded in loads:
+            record(i, lambda: compute_timed(module, loaded, params))
+    else:
+        with ProcessPoolExecutor(min(workers, len(jobs))) as pool:
+            futures = {pool.submit(analyze_one, app, paths, params): i
+                       for i, paths in enumerate(jobs)}
+            for future in as_completed(futures):
+                record(futures[future], future.result)
+    return frames, stats
+
+
+def combine(inputs, frames):
+    import pandas as pd
+    parts = []
+    for item, df in zip(inputs, frames):
+        if df is not None:
+            df = df.reset_index(drop=True)
+            df.insert(0, 'File', item)
+            parts.append(df)
+    if not parts:
+        return None
+    return pd.concat(parts, ignore_index=True)
+
+
+def write_results(df, path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npz':
+        import numpy as np
+        arrays = {'columns': np.array([str(col) for col in df.columns])}
+        for i, col in enumerate(df.columns):
+            values = df[col].to_numpy()
+            if values.dtype.kind == 'O':
+                values = values.astype(str)
+            arrays['c%d' % i] = values
+        np.savez(path, **arrays)
+    elif ext == '.parquet':
+        df.to_parquet(path, index=False)
+    elif ext == '.feather':
+        df.to_feather(path)
+    elif ext in ('.h5', '.hdf5'):
+        df.to_hdf(path, key='results', mode='w')
+    elif ext == '.pkl':
+        df.to_pickle(path)
+    else:
+        raise ValueError('unknown output format %r, use one of %s' % (
+            ext, ', '.join(FORMATS)))
+
+
+def read_results(path):
+    """The DataFrame written by analyze.py --output."""
+    import pandas as pd
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npz':
+        import numpy as np
+        with np.load(path) as arrays:
+            columns = list(arrays['columns'])
+            return pd.DataFrame({col: arrays['c%d' % i]
+                                 for i, col in enumerate(columns)},
+                                columns=columns)
+    if ext == '.parquet':
+        return pd.read_parquet(path)
+    if ext == '.feather':
+        return pd.read_feather(path)
+    if ext in ('.h5', '.hdf5'):
+        return pd.read_hdf(path, 'results')
+    return pd.read_pickle(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('app', choices=sorted(BATCH_MODULES))
+    parser.add_argument('inputs', nargs='*')
+    parser.add_argument('--config', help='JSON file of parameters')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='NAME=VALUE', help='override one parameter')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('-o', '--output', help='results file (%s)' %
+                        ', '.join(FORMATS))
+    parser.add_argument('--stats', help='JSON file of timings per input')
+    parser.add_argument('--defaults', action='store_true',
+                        help='print the default parameters and exit')
+    args = parser.parse_args(argv)
+
+    defaults = batch_module(args.app).DEFAULTS
+    if args.defaults:
+        print(json.dumps(defaults, indent=4))
+        return 0
+    if not args.inputs:
+        parser.error('no inputs given')
+    if args.output and os.path.splitext(args.output)[1].lower() not in FORMATS:
+        parser.error('unknown output format, use one of %s' % ', '.join(FORMATS))
+    try:
+        params = read_config(args.config, args.app) if args.config else {}
+        params.update(parse_set(args.set))
+    except (OSError, ValueError) as err:
+        parser.error(str(err))
+    unknown = sorted(set(params) - set(defaults))
+    if unknown:
+        parser.error('unknown %s parameter(s): %s' % (args.app,
+                                                       ', '.join(unknown)))
+
+    start = time.perf_counter()
+    frames, stats = run(args.app, args.inputs, params, args.workers)
+    wall = time.perf_counter() - start
+    ok = [entry for entry in stats if entry['ok']]
+    summary = {'app': args.app, 'params': dict(defaults, **params),
+               'workers': args.workers or os.cpu_count() or 1,
+               'inputs': len(stats), 'failed': len(stats) - len(ok),
+               'rows': sum(entry['rows'] for entry in ok), 'wall_s': wall,
+               'load_s': sum(entry['load_s'] for entry in ok),
+               'compute_s': sum(entry['compute_s'] for entry in ok),
+               'files': stats}
+    print('%d/%d input(s) ok, %d row(s) in %.1f s (load %.1f s, compute '
+          '%.1f s summed over workers)' % (
+              len(ok), len(stats), summary['rows'], wall, summary['load_s'],
+              summary['compute_s']))
+
+    df = combine(args.inputs, frames)
+    if args.output and df is not None:
+        write_results(df, args.output)
+        print('%d row(s) written to %s' % (len(df), args.output))
+    if args.stats:
+        with open(args.stats, 'w') as f:
+            json.dump(summary, f, indent=4, default=str)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,16 @@
 from PyQt5 import QtCore, QtGui, QtWidgets
 import sys
 import os
-import neurphys.read_pv as rpv
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from labcommon.lazy import lazy_import, warm_up_in_background
+from labcommon import plots, profile_window
+from labcommon.profiling import profiler
 import pyqtgraph as pg
 import numpy as np
-from scipy.optimize import curve_fit
-import pandas as pd
+rpv = lazy_import('neurphys.read_pv')
+optimize = lazy_import('scipy.optimize')
+pd = lazy_import('pandas')
+results = lazy_import('labcommon.results')
 
 
 class ATypeAnalysis(QtWidgets.QWidget):
@@ -25,6 +30,7 @@ class ATypeAnalysis(QtWidgets.QWidget):
 
         layout = QtWidgets.QHBoxLayout(self)
         self.parent_dir = None
+        self.folder = None
         self.df = None
         self.i_vals = []
         self.g_vals = []
@@ -125,6 +131,8 @@ class ATypeAnalysis(QtWidgets.QWidget):
         self.rerun_button.clicked.connect(self.run_analysis)
         self.copy_button = QtWidgets.QPushButton("Copy output")
         self.copy_button.clicked.connect(self.copy_output)
+        self.save_button = QtWidgets.QPushButton("Save to results database")
+        self.save_button.clicked.connect(self.save_results)
 
         left_col.addItem(topSpacer)
         left_col.addLayout(self.ek_layout)
@@ -138,9 +146,11 @@ class ATypeAnalysis(QtWidgets.QWidget):
         left_col.addWidget(self.run_button)
         left_col.addWidget(self.rerun_button)
         left_col.addWidget(self.copy_button)
+        left_col.addWidget(self.save_button)
         left_col.addItem(bottomSpacer)
 
         self.plot_widget = pg.GraphicsLayoutWidget()
+        self.plot_grid = plots.PlotGrid(self.plot_widget)
         self.table = QtWidgets.QTableWidget()
         self.table.setFixedWidth(300)
         self.headers = ['Steps', 'I (pA)', 'g', 'tau (ms)']
@@ -153,13 +163,17 @@ class ATypeAnalysis(QtWidgets.QWidget):
         layout.addWidget(self.plot_widget)
         layout.addWidget(self.table)
 
+        self.profile_window = profile_window.install(self)
+
     def load_data(self):
         folder = QtWidgets.QFileDialog().getExistingDirectory(self,
                                                               "Select data folder",
                                                               self.parent_dir)
 
         self.parent_dir = os.path.dirname(folder)
-        self.df = rpv.import_folder(folder)['voltage recording']
+        self.folder = folder
+        with profiler.stage('import_folder'):
+            self.df = rpv.import_folder(folder)['voltage recording']
 
         if self.df is None:
             self.gen_error_mbox('Folder does not contain voltage recording data')
@@ -194,8 +208,8 @@ class ATypeAnalysis(QtWidgets.QWidget):
         sweeps = self.df.index.levels[0]
         peaks = []
         peak_times = []
-        plot = self.plot_widget.addPlot(0, 0)
-        for step, sweep in zip(self.steps, sweeps):
+        plot = self.plot_grid.plot(0, 0)
+        for n, (step, sweep) in enumerate(zip(self.steps, sweeps)):
             sub = self.df.loc[sweep]
             mask = (sub.time >= start) & (sub.time <= stop)
             peak_ix = sub.loc[mask, 'primary'].idxmax()
@@ -208,10 +222,11 @@ class ATypeAnalysis(QtWidgets.QWidget):
             peaks.append(peak)
             self.i_vals.append(i)
             self.g_vals.append(g)
-            plot.plot(sub.time, sub.primary, pen='b')
+            self.plot_grid.curve(plot, 'sweep%d' % n, sub.time.values,
+                                 sub.primary.values, pen='b')
 
-        plot.plot(peak_times, peaks, pen=None, symbol='o',
-                  symbolPen='r', symbolBrush='r')
+        self.plot_grid.curve(plot, 'peaks', peak_times, peaks, pen=None,
+                             symbol='o', symbolPen='r', symbolBrush='r')
 
     def fit_transient(self):
         sweep = self.df.loc['Sweep0001'].copy()
@@ -232,7 +247,8 @@ class ATypeAnalysis(QtWidgets.QWidget):
         def exp_decay(x, a, b, c):
             return a*np.exp(-x/b) + c
 
-        popt, pcov = curve_fit(exp_decay, x_zeroed*1e3, sub.primary, guess)
+        with profiler.stage('curve_fit'):
+            popt, pcov = optimize.curve_fit(exp_decay, x_zeroed*1e3, sub.primary, guess)
 
         # amp1 = popt[0]
         # tau1 = popt[1]
@@ -242,9 +258,10 @@ class ATypeAnalysis(QtWidgets.QWidget):
         # tau = ((tau1*amp1)+(tau2*amp2))/(amp1+amp2)
         self.tau = popt[1]
         fit = exp_decay(x_zeroed*1e3, *popt)
-        plot = self.plot_widget.addPlot(1, 0)
-        plot.plot(sweep.time, sweep.primary, pen='b')
-        plot.plot(sub.time.values, fit, pen='r')
+        plot = self.plot_grid.plot(1, 0)
+        self.plot_grid.curve(plot, 'sweep', sweep.time.values,
+                             sweep.primary.values, pen='b')
+        self.plot_grid.curve(plot, 'fit', sub.time.values, fit, pen='r')
 
     def write_table(self):
         self.table.setRowCount(self.num_steps)
@@ -258,26 +275,54 @@ class ATypeAnalysis(QtWidgets.QWidget):
         self.table.setItem(0, 3, item)
 
     def run_analysis(self):
-        initialized = self.initialize_parameters()
-        if initialized and self.df is not None:
-            self.plot_widget.clear()
-            # self.table.clear()
-            self.analyze_peaks()
-            self.fit_transient()
-            self.write_table()
+        with profiler.stage('run_analysis'):
+            initialized = self.initialize_parameters()
+            if initialized and self.df is not None:
+                # the plots and curves are reused, finish() empties the
+                # sweeps a shorter protocol no longer has
+                self.plot_grid.reset()
+                # self.table.clear()
+                with profiler.stage('analyze_peaks'):
+                    self.analyze_peaks()
+                with profiler.stage('fit_transient'):
+                    self.fit_transient()
+                self.plot_grid.finish()
+                with profiler.stage('write_table'):
+                    self.write_table()
 
     def run_new_analysis(self):
         self.load_data()
         self.run_analysis()
 
+    def output_df(self):
+        step_df = pd.DataFrame({'Steps': self.steps,
+                                'I (pA)': self.i_vals,
+                                'g': self.g_vals})
+        step_df['tau (ms)'] = self.tau
+        step_df.loc[1:, 'tau (ms)'] = np.nan
+        return step_df[['Steps', 'I (pA)', 'g', 'tau (ms)']]
+
     def copy_output(self):
         if any(self.i_vals):
-            step_df = pd.DataFrame({'Steps': self.steps,
-                                    'I (pA)': self.i_vals,
-                                    'g': self.g_vals})
-            step_df['tau (ms)'] = self.tau
-            step_df.loc[1:, 'tau (ms)'] = np.nan
-            step_df[['Steps', 'I (pA)', 'g', 'tau (ms)']].to_clipboard(index=False)
+            self.output_df().to_clipboard(index=False)
+
+    def analysis_params(self):
+        """The parameters of the last run under atype_batch's names."""
+        return {'ek': self.ek, 'bsl_sweep': self.bsl_sweep.text(),
+                'holding': self.holding, 'start': self.start,
+                'offset': self.offset, 'first_step': self.first_step,
+                'delta': self.delta, 'num_steps': self.num_steps,
+                'stop': self.stop}
+
+    def save_results(self):
+        if not any(self.i_vals):
+            self.gen_error_mbox('Run the analysis first')
+            return
+        try:
+            results.save('atype', self.folder, self.analysis_params(),
+                         self.output_df())
+        except results.ERRORS as err:
+            self.gen_error_mbox('Could not save results: %s' % err)
 
     def gen_error_mbox(self, message):
         msg = QtWidgets.QMessageBox()
@@ -291,6 +336,7 @@ if __name__ == '__main__':
     app = QtWidgets.QApplication(sys.argv)
     ex = ATypeAnalysis()
     ex.show()
+    warm_up_in_background()
     sys.exit(app.exec_())
 
 
@@ -0,0 +1,84 @@
+"""ATypeAnalysis without the window, for the job queue.
+
+compute returns the table copy_output puts on the clipboard: I and g for
+each step and the decay tau of the first sweep on the first row. Parameters
+not given take the window's defaults.
+"""
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from scipy.optimize import curve_fit
+import neurphys.read_pv as rpv
+
+
+DEFAULTS = OrderedDict([('ek', -108), ('bsl_sweep', 'Sweep0006'),
+                        ('holding', -80), ('start', 1.5), ('offset', 0.01),
+                        ('first_step', -10), ('delta', 10), ('num_steps', 5),
+                        ('stop', 1.99)])
+
+COLUMNS = ['Steps', 'I (pA)', 'g', 'tau (ms)']
+
+
+def exp_decay(x, a, b, c):
+    return a*np.exp(-x/b) + c
+
+
+def steps(params):
+    return [params['holding'] + params['first_step'] + params['delta'] * i
+            for i in range(params['num_steps'])]
+
+
+def peak_currents(df, params):
+    # as ATypeAnalysis.analyze_peaks
+    start = params['start'] + params['offset']
+    stop = start + 0.5
+    sub = df.loc[params['bsl_sweep']]
+    mask = (sub.time >= start) & (sub.time <= stop)
+    bsl = sub.loc[mask, 'primary'].mean()
+
+    i_vals, g_vals = [], []
+    for step, sweep in zip(steps(params), df.index.levels[0]):
+        sub = df.loc[sweep]
+        mask = (sub.time >= start) & (sub.time <= stop)
+        peak_ix = sub.loc[mask, 'primary'].idxmax()
+        i = sub.loc[peak_ix, 'primary'] - bsl
+        i_vals.append(i)
+        g_vals.append(i / (step - params['ek']))
+    return i_vals, g_vals
+
+
+def decay_tau(df, params):
+    # as ATypeAnalysis.fit_transient
+    sweep = df.loc['Sweep0001']
+    start = params['start'] + params['offset']
+    mask = (sweep.time >= start) & (sweep.time <= params['stop'])
+    peak_ix = sweep.loc[mask, 'primary'].idxmax()
+    peak_time = sweep.loc[peak_ix, 'time']
+
+    mask = (sweep.time >= peak_time) & (sweep.time <= params['stop'])
+    sub = sweep.loc[mask]
+    x_zeroed = sub.time.values - sub.time.iloc[0]
+    popt, pcov = curve_fit(exp_decay, x_zeroed*1e3, sub.primary, [1, 1, 0])
+    return popt[1]
+
+
+def load(paths, params):
+    df = rpv.import_folder(paths[0])['voltage recording']
+    if df is None:
+        raise ValueError('%s does not contain voltage recording data' % paths[0])
+    return df
+
+
+def compute(df, params):
+    params = dict(DEFAULTS, **params)
+    i_vals, g_vals = peak_currents(df, params)
+    tau = decay_tau(df, params)
+    step_df = pd.DataFrame({'Steps': steps(params)[:len(i_vals)],
+                            'I (pA)': i_vals, 'g': g_vals})
+    step_df['tau (ms)'] = np.nan
+    step_df.loc[0, 'tau (ms)'] = tau
+    return step_df[COLUMNS]
+
+
+def analyze(paths, params):
+    return compute(load(paths, params), params)
@@ -1,15 +1,20 @@
 from PyQt5 import QtCore, QtGui, QtWidgets
 import sys
 import os
-import neurphys.read_pv as rpv
-import neurphys.utilities as util
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from labcommon.lazy import lazy_import, warm_up_in_background
+from labcommon import plots, profile_window, result_cache, roi_picker
+from labcommon.profiling import profiler
 import pyqtgraph as pg
 import numpy as np
-import pandas as pd
-from scipy.optimize import curve_fit
-from scipy.integrate import trapz
 import itertools
 from collections import OrderedDict
+rpv = lazy_import('neurphys.read_pv')
+util = lazy_import('neurphys.utilities')
+linescan = lazy_import('labcommon.linescan')
+pd = lazy_import('pandas')
+optimize = lazy_import('scipy.optimize')
+results = lazy_import('labcommon.results')
 
 class bAPAnalysis(QtWidgets.QWidget):
     def __init__(self):
@@ -24,7 +29,16 @@ class bAPAnalysis(QtWidgets.QWidget):
         pg.setConfigOption('foreground', 'k')
 
         self.df_list = []
+        self.folders = []
+        # LinescanImages of each folder, when profiles come from an ROI
+        self.images = {}
+        self.profile_roi = ''
         self.avg_df = None
+        self.data_dict = None
+        # folders and parameters data_dict was computed from
+        self.data_folders = None
+        self.data_params = None
+        self.result_cache = result_cache.ResultCache()
         self.r_prof = 'Prof 1'
         self.g_prof = 'Prof 2'
 
@@ -76,12 +90,28 @@ class bAPAnalysis(QtWidgets.QWidget):
         self.fit_stop_layout.addWidget(self.fit_stop_label)
         self.fit_stop_layout.addWidget(self.fit_stop_val)
 
+        self.roi_layout = QtWidgets.QHBoxLayout()
+        self.roi_label = QtWidgets.QLabel('Line ROI (px): ')
+        self.roi_label.setFixedWidth(label_width)
+        self.roi_label.setToolTip('Pixel range(s) along the scan line, e.g. 10-40.\n'
+                                  'Blank uses the profiles exported by Prairie View.')
+        self.roi_val = QtWidgets.QLineEdit('')
+        self.roi_val.setFixedWidth(100*self.ratio)
+        self.roi_layout.addWidget(self.roi_label)
+        self.roi_layout.addWidget(self.roi_val)
+
         self.load_btn = QtWidgets.QPushButton('Load folder(s)')
         self.load_btn.clicked.connect(self.load_folders)
         self.clear_btn = QtWidgets.QPushButton('Clear folder(s)')
         self.clear_btn.clicked.connect(self.clear_folders)
         self.run_btn = QtWidgets.QPushButton('Run analysis')
         self.run_btn.clicked.connect(self.run_analysis)
+        self.roi_btn = QtWidgets.QPushButton('Pick ROI')
+        self.roi_btn.clicked.connect(self.pick_roi)
+        self.save_btn = QtWidgets.QPushButton('Save to results database')
+        self.save_btn.clicked.connect(self.save_results)
+        self.bypass_check = QtWidgets.QCheckBox('Bypass result cache')
+        self.bypass_check.toggled.connect(self.set_bypass_cache)
 
         left_col.addWidget(self.list_widget)
         left_col.addLayout(self.stim_layout)
@@ -89,11 +119,16 @@ class bAPAnalysis(QtWidgets.QWidget):
         left_col.addLayout(self.g0_stop_layout)
         left_col.addLayout(self.tb4_stop_layout)
         left_col.addLayout(self.fit_stop_layout)
+        left_col.addLayout(self.roi_layout)
+        left_col.addWidget(self.roi_btn)
         left_col.addWidget(self.load_btn)
         left_col.addWidget(self.clear_btn)
+        left_col.addWidget(self.bypass_check)
         left_col.addWidget(self.run_btn)
+        left_col.addWidget(self.save_btn)
 
         self.plot_widget = pg.GraphicsLayoutWidget(self)
+        self.plot_grid = plots.PlotGrid(self.plot_widget)
         self.table = QtWidgets.QTableWidget()
         self.table.setColumnCount(1)
         self.table.setRowCount(7)
@@ -106,6 +141,8 @@ class bAPAnalysis(QtWidgets.QWidget):
         layout.addWidget(self.plot_widget)
         layout.addWidget(self.table)
 
+        self.profile_window = profile_window.install(self)
+
     def load_folders(self):
         dialog = QtWidgets.QFileDialog(self)
         dialog.setFileMode(QtWidgets.QFileDialog.DirectoryOnly)
@@ -122,17 +159,78 @@ class bAPAnalysis(QtWidgets.QWidget):
             if dir_path in folders:
                 folders.remove(dir_path)
 
+            if not self.refresh_profiles():
+                return
             for folder in folders:
-                df = rpv.import_folder(folder)['linescan']
+                df = self.load_linescan(folder)
                 if df is None:
                     self.gen_error_mbox('Folder %s does not contain necessary data' % folder)
                     folders.remove(folder)
                 else:
                     self.df_list.append(df)
+                    self.folders.append(folder)
 
             if any(folders):
                 self.update_list_widget(folders)
 
+    def get_roi(self):
+        try:
+            return linescan.parse_roi(self.roi_val.text())
+        except ValueError:
+            raise ValueError('Line ROI must be pixel ranges like 10-40 or 10-40, 60-80')
+
+    def load_linescan(self, folder):
+        roi = linescan.parse_roi(self.profile_roi)
+        if roi is None:
+            with profiler.stage('import_folder'):
+                return rpv.import_folder(folder)['linescan']
+
+        with profiler.stage('roi_profiles'):
+            try:
+                if folder not in self.images:
+                    self.images[folder] = linescan.LinescanImages(folder)
+                return self.images[folder].profile_frame(roi)
+            except (ValueError, OSError):
+                return None
+
+    def refresh_profiles(self):
+        """Rebuilds df_list when the line ROI has changed since the folders
+        were loaded."""
+        try:
+            self.get_roi()
+        except ValueError as err:
+            self.gen_error_mbox(str(err))
+            return False
+        if self.roi_val.text() == self.profile_roi:
+            return True
+
+        df_list = [self.load_linescan(folder) for folder in self.folders]
+        missing = [folder for folder, df in zip(self.folders, df_list) if df is None]
+        if any(missing):
+            self.gen_error_mbox('No linescan images for this ROI in %s' % ', '.join(missing))
+            return False
+        # only now, so a failed ROI is tried again on the next run rather than
+        # taken for the profiles of the previous one
+        self.df_list = df_list
+        self.profile_roi = self.roi_val.text()
+        return True
+
+    def pick_roi(self):
+        if not any(self.folders):
+            self.gen_error_mbox('Load a folder first')
+            return
+        folder = self.folders[0]
+        try:
+            roi = self.get_roi()
+            if folder not in self.images:
+                self.images[folder] = linescan.LinescanImages(folder)
+        except (ValueError, OSError) as err:
+            self.gen_error_mbox(str(err))
+            return
+        text = roi_picker.pick_roi(self, self.images[folder], roi)
+        if text is not None:
+            self.roi_val.setText(text)
+
     def update_list_widget(self, folders):
         for full_path in folders:
             folder = os.path.split(full_path)[-1] 
@@ -174,6 +272,8 @@ class bAPAnalysis(QtWidgets.QWidget):
     def clear_folders(self):
         self.list_widget.clear()
         self.df_list = []
+        self.folders = []
+        self.images = {}
         self.avg_df = None
         self.data_dict = None
 
@@ -216,41 +316,92 @@ class bAPAnalysis(QtWidgets.QWidget):
 
         guess = [1, 1e-3, 1, 0]
         x = subset['Prof 2 Time'] - subset['Prof 2 Time'].iloc[0]
-        popt, pcov = curve_fit(eq, x, subset['gr'], p0=guess, maxfev=5000)
+        popt, pcov = optimize.curve_fit(eq, x, subset['gr'], p0=guess, maxfev=5000)
 
         fit = eq(x, *popt)
 
         return fit, popt
 
     def run_analysis(self):
-        self.plot_widget.clear()
-        self.clear_table()
-        if len(self.df_list) > 0:
-            self.get_avg_df()
-        else:
+        with profiler.stage('run_analysis'):
+            # keeps the plot and its curves for this run
+            self.plot_grid.clear()
+            self.clear_table()
+            if not self.refresh_profiles():
+                return
+            if len(self.df_list) == 0:
+                return
+            with profiler.stage('cache_lookup'):
+                key = self.result_key()
+                cached = None if key is None else self.result_cache.get(key)
+            if cached is not None:
+                self.avg_df, subset, fit, popt = cached
+            else:
+                with profiler.stage('average'):
+                    self.get_avg_df()
+                with profiler.stage('subset'):
+                    subset = self.gen_subset()
+                if subset is not None:
+                    with profiler.stage('curve_fit'):
+                        fit, popt = self.gen_fit(subset)
+                    if key is not None:
+                        self.result_cache.put(key, (self.avg_df, subset, fit, popt))
+            if subset is not None:
+                plot = self.plot_grid.plot(0, 0)
+                self.plot_grid.curve(plot, 'average', self.avg_df['Prof 2 Time'].values,
+                                     self.avg_df['gr'].values, pen='b')
+                x = subset['Prof 2 Time'].values
+                y = subset['gr'].values
+                self.plot_grid.curve(plot, 'subset', x, y, pen='r')
+                self.plot_grid.curve(plot, 'fit', x, fit.values, pen='g')
+                dx = subset['Prof 2 Time'].iloc[1] - subset['Prof 2 Time'].iloc[0]
+                total_area = np.trapz(subset.gr)
+                avg_area = np.trapz(subset.gr, dx=dx)
+                self.data_dict = OrderedDict([('Peak', subset.gr.max()),
+                                              ('Total Area', total_area),
+                                              ('Average Area', avg_area),
+                                              ('a', popt[0]),
+                                              ('b', popt[1]),
+                                              ('c', popt[2]),
+                                              ('d', popt[3])])
+                for i, key in enumerate(self.data_dict.keys()):
+                    item = QtWidgets.QTableWidgetItem('%0.4f' % self.data_dict[key])
+                    self.table.setItem(i, 0, item)
+                self.data_folders = list(self.folders)
+                self.data_params = self.analysis_params()
+
+    def result_key(self):
+        try:
+            params = self.analysis_params()
+        except ValueError:
+            # run_analysis reports the invalid value
+            return None
+        arrays = [df[col].values for df in self.df_list
+                  for col in (self.r_prof, self.g_prof, 'Prof 2 Time')]
+        return self.result_cache.key('baps.run_analysis', arrays, params)
+
+    def set_bypass_cache(self, checked):
+        self.result_cache.bypass = checked
+
+    def analysis_params(self):
+        """The parameters of the window under bap_batch's names."""
+        fit_stop = self.fit_stop_val.text()
+        return {'stim_start': float(self.stim_val.text()),
+                'g0_start': float(self.g0_start_val.text()),
+                'g0_stop': float(self.g0_stop_val.text()),
+                'tb4peak': float(self.tb4_stop_val.text()),
+                'fit_stop': float(fit_stop) if fit_stop else None,
+                'roi': self.roi_val.text()}
+
+    def save_results(self):
+        if self.data_dict is None:
+            self.gen_error_mbox('Run the analysis first')
             return
-        subset = self.gen_subset()
-        if subset is not None:
-            fit, popt = self.gen_fit(subset)
-            plot = self.plot_widget.addPlot()
-            plot.plot(self.avg_df['Prof 2 Time'], self.avg_df['gr'], pen='b')
-            x = subset['Prof 2 Time'].values
-            y = subset['gr'].values
-            plot.plot(x, y, pen='r')
-            plot.plot(x, fit.values, pen='g')
-            dx = subset['Prof 2 Time'].iloc[1] - subset['Prof 2 Time'].iloc[0]
-            total_area = np.trapz(subset.gr)
-            avg_area = np.trapz(subset.gr, dx=dx)
-            self.data_dict = OrderedDict([('Peak', subset.gr.max()),
-                                          ('Total Area', total_area),
-                                          ('Average Area', avg_area),
-                                          ('a', popt[0]),
-                                          ('b', popt[1]),
-                                          ('c', popt[2]),
-                                          ('d', popt[3])])
-            for i, key in enumerate(self.data_dict.keys()):
-                item = QtWidgets.QTableWidgetItem('%0.4f' % self.data_dict[key])
-                self.table.setItem(i, 0, item)
+        try:
+            results.save('baps', self.data_folders, self.data_params,
+                         pd.DataFrame([self.data_dict]))
+        except results.ERRORS as err:
+            self.gen_error_mbox('Could not save results: %s' % err)
 
     def clear_table(self):
         for i in range(7):
@@ -268,4 +419,5 @@ if __name__ == '__main__':
     app = QtWidgets.QApplication(sys.argv)
     ex = bAPAnalysis()
     ex.show()
+    warm_up_in_background()
     sys.exit(app.exec_())
@@ -0,0 +1,82 @@
+"""bAPAnalysis without the window, for the job queue.
+
+The folders of one job are averaged and fitted as run_analysis does with
+the same folders loaded in the list. Parameters not given take the window's
+defaults; fit_stop None fits to the end of the trace.
+"""
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from scipy.optimize import curve_fit
+import neurphys.read_pv as rpv
+import neurphys.utilities as util
+from labcommon import linescan
+
+
+DEFAULTS = OrderedDict([('stim_start', 0.5), ('g0_start', 0.35),
+                        ('g0_stop', 0.48), ('tb4peak', 0.1),
+                        ('fit_stop', None), ('roi', '')])
+
+COLUMNS = ['Peak', 'Total Area', 'Average Area', 'a', 'b', 'c', 'd']
+
+
+def bap_eq(x, a, b, c, d):
+    return a*(1-np.exp(-x*b))*(np.exp(-x*c)) + d
+
+
+def gr_col(df, g0_start, g0_stop):
+    # as bAPAnalysis.get_gr_col
+    df['gnorm'] = df['Prof 2'] / df['Prof 1']
+    mask = (df['Prof 2 Time'] >= g0_start) & (df['Prof 2 Time'] <= g0_stop)
+    g0 = df.loc[mask, 'gnorm'].mean()
+    return util.simple_smoothing((df['gnorm']-g0).values, 9)
+
+
+def average(df_list, params):
+    if len(df_list) == 1:
+        avg_df = df_list[0].copy()
+        avg_df['gr'] = gr_col(avg_df, params['g0_start'], params['g0_stop'])
+        return avg_df
+    for df in df_list:
+        df['gr'] = gr_col(df, params['g0_start'], params['g0_stop'])
+    return pd.concat(df_list).groupby(level=1).mean()
+
+
+def fit_subset(avg_df, params):
+    time = avg_df['Prof 2 Time']
+    start = params['stim_start']
+    stop = time.iloc[-1] if params['fit_stop'] is None else params['fit_stop']
+    window = avg_df[(time >= start) & (time <= stop)]
+    peak_time = window['Prof 2 Time'].values[np.nanargmax(window.gr.values)]
+    new_start = peak_time - params['tb4peak']
+    return avg_df[(time >= new_start) & (time <= stop)]
+
+
+def load(paths, params):
+    """The linescan of every folder in paths, exported or from the ROI."""
+    roi = linescan.parse_roi(dict(DEFAULTS, **params)['roi'])
+    df_list = []
+    for folder in paths:
+        if roi is None:
+            df = rpv.import_folder(folder)['linescan']
+        else:
+            df = linescan.LinescanImages(folder).profile_frame(roi)
+        if df is None:
+            raise ValueError('%s does not contain linescan profiles' % folder)
+        df_list.append(df)
+    return df_list
+
+
+def compute(df_list, params):
+    params = dict(DEFAULTS, **params)
+    subset = fit_subset(average(df_list, params), params)
+    x = subset['Prof 2 Time'] - subset['Prof 2 Time'].iloc[0]
+    popt, pcov = curve_fit(bap_eq, x, subset['gr'], p0=[1, 1e-3, 1, 0],
+                           maxfev=5000)
+    dx = subset['Prof 2 Time'].iloc[1] - subset['Prof 2 Time'].iloc[0]
+    row = [subset.gr.max(), np.trapz(subset.gr), np.trapz(subset.gr, dx=dx)]
+    return pd.DataFrame([row + list(popt)], columns=COLUMNS)
+
+
+def analyze(paths, params):
+    return compute(load(paths, params), params)
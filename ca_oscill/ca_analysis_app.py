@@ -1,14 +1,21 @@
 from PyQt5 import QtCore, QtGui, QtWidgets
 import sys
 import os
-import neurphys.read_pv as rpv
-import neurphys.utilities as util
-import neurphys.pacemaking as pace
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from labcommon.lazy import lazy_import, warm_up_in_background
+from labcommon import plots, profile_window, result_cache, roi_picker
+from labcommon.profiling import profiler
 import pyqtgraph as pg
 import numpy as np
-import pandas as pd
-import itertools
 from collections import OrderedDict
+import calibration
+rpv = lazy_import('neurphys.read_pv')
+peaks = lazy_import('labcommon.peaks')
+pd = lazy_import('pandas')
+conversion = lazy_import('conversion')
+ca_batch = lazy_import('ca_batch')
+linescan = lazy_import('labcommon.linescan')
+results = lazy_import('labcommon.results')
 
 
 class CaAnalysis(QtWidgets.QWidget):
@@ -29,6 +36,17 @@ class CaAnalysis(QtWidgets.QWidget):
         self.ls = None
         self.fmax_vm = None
         self.fmax_ls = None
+        # exported profiles, and the folders whose images give ROI profiles
+        self.exported_ls = None
+        self.exported_fmax_ls = None
+        self.ls_folder = None
+        self.fmax_folder = None
+        self.fmax_fingerprint = None
+        self.images = {}
+        self.profile_roi = None
+        self.calibrations = calibration.CalibrationStore()
+        self.result_cache = result_cache.ResultCache()
+        self.conversion = None
         self.kd = 120
         self.background = 0
         self.dye_rf = 22
@@ -40,6 +58,9 @@ class CaAnalysis(QtWidgets.QWidget):
         self.mpd = None
         self.parent_dir = ''
         self.output_df = None
+        # folders and parameters output_df was computed from
+        self.output_files = None
+        self.output_params = None
 
         self.layout = QtWidgets.QHBoxLayout(self)
 
@@ -92,6 +113,18 @@ class CaAnalysis(QtWidgets.QWidget):
         self.profVal.setFixedWidth(100)
         self.profLayout.addWidget(self.profLabel)
         self.profLayout.addWidget(self.profVal)
+        #line ROI
+        self.roiLayout = QtWidgets.QHBoxLayout()
+        self.roiLabel = QtWidgets.QLabel("Line ROI (px): ")
+        self.roiLabel.setToolTip("Pixel range(s) along the scan line, e.g. 10-40.\n"
+                                 "Blank uses the profiles exported by Prairie View.")
+        self.roiVal = QtWidgets.QLineEdit("")
+        self.roiVal.setSizePolicy(sizePolicy)
+        self.roiVal.setFixedWidth(100)
+        self.roiLayout.addWidget(self.roiLabel)
+        self.roiLayout.addWidget(self.roiVal)
+        self.roiButton = QtWidgets.QPushButton("Pick ROI")
+        self.roiButton.clicked.connect(self.pick_roi)
         ### detect_peaks parameters
         self.autoCheckbox = QtWidgets.QCheckBox()
         self.autoCheckbox.setText("Automatically determine vals:")
@@ -129,6 +162,11 @@ class CaAnalysis(QtWidgets.QWidget):
         self.rerunButton.clicked.connect(self.run_analysis)
         self.copy_button = QtWidgets.QPushButton("Copy output")
         self.copy_button.clicked.connect(self.copy_output)
+        self.bypassCheckbox = QtWidgets.QCheckBox()
+        self.bypassCheckbox.setText("Bypass result cache")
+        self.bypassCheckbox.toggled.connect(self.set_bypass_cache)
+        self.save_button = QtWidgets.QPushButton("Save to results database")
+        self.save_button.clicked.connect(self.save_results)
 
         self.leftCol.addItem(topSpacer)
         self.leftCol.addLayout(self.kdLayout)
@@ -137,15 +175,20 @@ class CaAnalysis(QtWidgets.QWidget):
         self.leftCol.addLayout(self.orfLayout)
         self.leftCol.addLayout(self.smthLayout)
         self.leftCol.addLayout(self.profLayout)
+        self.leftCol.addLayout(self.roiLayout)
+        self.leftCol.addWidget(self.roiButton)
         self.leftCol.addWidget(self.autoCheckbox)
         self.leftCol.addLayout(self.mphLayout)
         self.leftCol.addLayout(self.mpdLayout)
+        self.leftCol.addWidget(self.bypassCheckbox)
         self.leftCol.addWidget(self.runButton)
         self.leftCol.addWidget(self.rerunButton)
         self.leftCol.addWidget(self.copy_button)
+        self.leftCol.addWidget(self.save_button)
         self.leftCol.addItem(bottomSpacer)
 
         self.plotWidget = pg.GraphicsLayoutWidget(self)
+        self.plotGrid = plots.PlotGrid(self.plotWidget)
         self.table = QtWidgets.QTableWidget()
         self.headers = ['Average Area', 'Total Area', 'Peak', 'Baseline', 'Average']
         self.table.setColumnCount(len(self.headers))
@@ -160,6 +203,8 @@ class CaAnalysis(QtWidgets.QWidget):
         self.layout.addLayout(self.leftCol)
         self.layout.addWidget(self.tab_widget)
 
+        self.profile_window = profile_window.install(self)
+
     def change_state(self):
         if self.autoCheckbox.isChecked():
             self.mphVal.setText('')
@@ -176,96 +221,175 @@ class CaAnalysis(QtWidgets.QWidget):
                                                           self.parent_dir)
         self.parent_dir = os.path.dirname(folder)
 
-        data_dict = rpv.import_folder(folder)
-        if data_dict['voltage recording'] is None or data_dict['linescan'] is None:
+        self.images = {}
+        self.profile_roi = None
+        with profiler.stage('import_folder'):
+            data_dict = rpv.import_folder(folder)
+        if data_dict['voltage recording'] is None:
             QtWidgets.QMessageBox.about(self, "Error", "Folder does not contain necessary data")
             self.vm = None
             self.ls = None
             return
         else:
             self.vm = data_dict['voltage recording']
-            self.ls = data_dict['linescan']
+            self.ls = self.exported_ls = data_dict['linescan']
+            self.ls_folder = folder
 
         folder = QtWidgets.QFileDialog().getExistingDirectory(self,
                                                           "Select folder containing fmax data",
                                                           self.parent_dir)
-        data_dict = rpv.import_folder(folder)
-        if data_dict['voltage recording'] is None or data_dict['linescan'] is None:
+        with profiler.stage('import_folder'):
+            data_dict = rpv.import_folder(folder)
+        if data_dict['voltage recording'] is None:
             QtWidgets.QMessageBox.about(self, "Error", "Folder does not contain necessary data")
             self.fmax_vm = None
             self.fmax_ls = None
             return
         else:
             self.fmax_vm = data_dict['voltage recording']
-            self.fmax_ls = data_dict['linescan']
+            self.fmax_ls = self.exported_fmax_ls = data_dict['linescan']
+            self.fmax_folder = folder
+            try:
+                self.fmax_fingerprint = calibration.folder_fingerprint(folder)
+            except OSError:
+                self.fmax_fingerprint = None
+
+    def get_images(self, folder):
+        if folder not in self.images:
+            self.images[folder] = linescan.LinescanImages(folder)
+        return self.images[folder]
+
+    def update_profiles(self):
+        """Points ls and fmax_ls at the exported profiles, or at profiles
+        computed from the raw images when a line ROI is set."""
+        try:
+            roi = linescan.parse_roi(self.roiVal.text())
+        except ValueError:
+            QtWidgets.QMessageBox.about(self, "Error",
+                                        "Line ROI must be pixel ranges like 10-40 or 10-40, 60-80")
+            return False
+
+        if roi is not None and self.roiVal.text() == self.profile_roi:
+            # ROI profiles of the loaded folders are already computed
+            return True
+        self.profile_roi = self.roiVal.text()
+        if roi is None:
+            self.ls = self.exported_ls
+            self.fmax_ls = self.exported_fmax_ls
+            if self.ls is None or self.fmax_ls is None:
+                QtWidgets.QMessageBox.about(self, "Error",
+                                            "No exported linescan profiles, set a line ROI")
+                return False
+            return True
+
+        with profiler.stage('roi_profiles'):
+            try:
+                self.ls = self.get_images(self.ls_folder).profile_frame(roi)
+                self.fmax_ls = self.get_images(self.fmax_folder).profile_frame(roi)
+            except (ValueError, OSError) as err:
+                QtWidgets.QMessageBox.about(self, "Error", str(err))
+                self.profile_roi = None
+                return False
+        return True
+
+    def pick_roi(self):
+        if self.ls_folder is None:
+            QtWidgets.QMessageBox.about(self, "Error", "Load data first")
+            return
+        try:
+            roi = linescan.parse_roi(self.roiVal.text())
+            images = self.get_images(self.ls_folder)
+        except (ValueError, OSError) as err:
+            QtWidgets.QMessageBox.about(self, "Error", str(err))
+            return
+        text = roi_picker.pick_roi(self, images, roi)
+        if text is not None:
+            self.roiVal.setText(text)
+
+    def calibration_key(self):
+        if self.fmax_fingerprint is None:
+            return None
+        return {'fingerprint': self.fmax_fingerprint, 'profile': self.prof,
+                'roi': str(linescan.parse_roi(self.roiVal.text()) or ''),
+                'background': self.background, 'dye_rf': self.dye_rf,
+                'obs_rf': self.obs_rf}
 
     def calc_fmax(self):
+        key = self.calibration_key()
+        fmax = None if key is None else self.calibrations.get(key)
+        if fmax is None:
+            with profiler.stage('fmax_window'):
+                fmax = ca_batch.fmax_calibration(self.fmax_vm.time.values,
+                                                 self.fmax_vm.secondary.values,
+                                                 self.fmax_ls[self.prof_t].values,
+                                                 self.fmax_ls[self.prof].values,
+                                                 self.background, self.dye_rf,
+                                                 self.obs_rf)
+            if key is not None:
+                self.calibrations.put(key, fmax, self.fmax_folder)
+        return fmax
+
+    def plot_fmax(self, fmax):
         self.fmax_ls['bkg_sub'] = self.fmax_ls[self.prof] - self.background
-        sampling = 1 / (self.fmax_vm.time[1] - self.fmax_vm.time[0])
-        ix = np.nanargmax(np.gradient(util.simple_smoothing(self.fmax_vm.secondary.values, 200)))
-        end = self.fmax_vm.time.iloc[int(ix-sampling*0.05)]
-        start = end - 0.5
-
-        mask = (self.fmax_ls[self.prof_t] >= start) & (self.fmax_ls[self.prof_t] <= end)
-        f0 = self.fmax_ls.loc[mask, 'bkg_sub'].mean()
-        fmax = f0 * (self.dye_rf / self.obs_rf)
-
-        top = self.plotWidget.addPlot(0, 0)
-        top.plot(self.fmax_vm.time, self.fmax_vm.primary, pen='b')
-        middle = self.plotWidget.addPlot(1, 0)
-        middle.plot(self.fmax_vm.time, self.fmax_vm.secondary, pen='b')
+        mask = (self.fmax_ls[self.prof_t] >= fmax.start) & (self.fmax_ls[self.prof_t] <= fmax.end)
+
+        grid = self.plotGrid
+        top = grid.plot(0, 0)
+        grid.curve(top, 'vm', self.fmax_vm.time.values, self.fmax_vm.primary.values, pen='b')
+        middle = grid.plot(1, 0)
+        grid.curve(middle, 'secondary', self.fmax_vm.time.values,
+                   self.fmax_vm.secondary.values, pen='b')
         middle.setXLink(top)
-        bottom = self.plotWidget.addPlot(2, 0)
-        bottom.plot(self.fmax_ls[self.prof_t], self.fmax_ls['bkg_sub'], pen='b')
-        bottom.plot(self.fmax_ls[self.prof_t][mask], self.fmax_ls['bkg_sub'][mask], pen='r')
+        bottom = grid.plot(2, 0)
+        grid.curve(bottom, 'profile', self.fmax_ls[self.prof_t].values,
+                   self.fmax_ls['bkg_sub'].values, pen='b')
+        grid.curve(bottom, 'fmax', self.fmax_ls[self.prof_t][mask].values,
+                   self.fmax_ls['bkg_sub'][mask].values, pen='r')
         bottom.setXLink(top)
 
-        return fmax
-
     def calc_ca(self, fmax):
-        self.ls['bkg_sub'] = self.ls[self.prof] - self.background
-        self.ls['ca_conc'] = (self.kd * ((1-self.ls['bkg_sub'] / fmax) /
-                                         (self.ls['Prof 2'] / fmax - (1/self.dye_rf))))
-
-        ls_sampling = 1 / (self.ls[self.prof_t][1] - self.ls[self.prof_t][0])
-        self.ls['ca_smth'] = util.simple_smoothing(self.ls['ca_conc'].values, self.smooth_by)
+        """[Ca] smoothed, its peaks and the metrics of every oscillation."""
+        if self.conversion is None:
+            self.conversion = conversion.CaConversion()
+        time = self.ls[self.prof_t].values
+        with profiler.stage('ca_conversion'):
+            self.conversion.convert(self.ls[self.prof].values, self.background,
+                                    fmax, self.kd, self.dye_rf)
+
+        ls_sampling = 1 / (time[1] - time[0])
+        with profiler.stage('smoothing'):
+            ca_smth = self.conversion.smooth(self.smooth_by)
 
         if self.autoCheckbox.isChecked():
-            self.mph = self.ls['ca_smth'].max()/2
+            self.mph = np.nanmax(ca_smth)/2
             self.mpd = ls_sampling*0.25
 
             self.mphVal.setText(str(self.mph))
             self.mpdVal.setText(str(self.mpd))
 
-        ixs = pace.detect_peaks(self.ls['ca_smth'], mph=self.mph, mpd=self.mpd)
-
-        top = self.plotWidget.addPlot(0, 1)
-        top.plot(self.vm.time, self.vm.primary, pen='b')
-        middle = self.plotWidget.addPlot(1, 1)
-        middle.plot(self.ls[self.prof_t], self.ls['ca_smth'], pen='b')
-        middle.plot(self.ls[self.prof_t][ixs], self.ls['ca_smth'][ixs],
-                    pen=None, symbolBrush=pg.mkColor('r'),
-                    symbolPen=pg.mkPen('r'), symbol="d")
+        with profiler.stage('detect_peaks'):
+            ixs = peaks.detect_peaks(ca_smth, mph=self.mph, mpd=self.mpd)
+        with profiler.stage('metrics'):
+            metrics = ca_batch.oscillation_metrics(time, ca_smth, ixs)
+        return ca_smth, ixs, metrics
+
+    def plot_ca(self, ca_smth, ixs, metrics):
+        time = self.ls[self.prof_t].values
+        grid = self.plotGrid
+        top = grid.plot(0, 1)
+        grid.curve(top, 'vm', self.vm.time.values, self.vm.primary.values, pen='b')
+        middle = grid.plot(1, 1)
+        grid.curve(middle, 'ca', time, ca_smth, pen='b')
+        grid.curve(middle, 'peaks', time[ixs], ca_smth[ixs],
+                   pen=None, symbolBrush=pg.mkColor('r'),
+                   symbolPen=pg.mkPen('r'), symbol="d")
         middle.setXLink(top)
 
-        colors = itertools.cycle(['b', 'g', 'r', 'c', 'm', 'y', 'k'])
-        bottom = self.plotWidget.addPlot(2, 1)
+        bottom = grid.plot(2, 1)
+        segments = []
         output_dict = OrderedDict([[header, []] for header in self.headers])
-        for i, ix in enumerate(ixs[1:-1]):
-            tr_ix1 = self.ls['ca_smth'].iloc[ixs[i]:ix].idxmin()[-1]
-            tr_ix2 = self.ls['ca_smth'].iloc[ix:ixs[i+2]].idxmin()[-1]
-            sub = self.ls.iloc[tr_ix1:tr_ix2].copy()
-
-            avg_area = ((np.trapz(sub['ca_smth'], sub[self.prof_t])) /
-                   (sub['Prof 2 Time'][-1] - sub['Prof 2 Time'][0]))
-            total_area = np.trapz(sub['ca_smth'])
-            peak = sub['ca_smth'].max()
-            peak_ix = sub['ca_smth'].idxmax()
-            bsl1 = sub.loc[:peak_ix, 'ca_smth'].iloc[:100].mean()
-            bsl2 = sub.loc[peak_ix:, 'ca_smth'].iloc[-100:].mean()
-            baseline = (bsl1+bsl2)/2 
-            avg = sub['ca_smth'].mean()
-
+        for i, (tr_ix1, tr_ix2, values) in enumerate(metrics):
+            avg_area, total_area, peak, baseline, avg = values
             output_dict['Average Area'].append(avg_area)
             output_dict['Total Area'].append(total_area)
             output_dict['Peak'].append(peak)
@@ -276,49 +400,104 @@ class CaAnalysis(QtWidgets.QWidget):
                 item = QtWidgets.QTableWidgetItem("%0.3f" % metric)
                 self.table.setItem(i, j, item)
 
-            bottom.plot(sub[self.prof_t], sub['ca_smth'], pen=next(colors))
+            segments.append((time[tr_ix1:tr_ix2], ca_smth[tr_ix1:tr_ix2]))
+        # one curve per colour, the oscillations taking the colours in turn
+        grid.segments(bottom, 'oscillations', segments,
+                      ['b', 'g', 'r', 'c', 'm', 'y', 'k'])
         bottom.setXLink(top)
         self.output_df = pd.DataFrame(output_dict)
 
     def run_analysis(self):
-        self.plotWidget.clear()
-        self.output_df = None
-        self.table.setRowCount(0)
-        self.kd = float(self.kdVal.text())
-        self.background = float(self.bkgVal.text())
-        self.dye_rf = float(self.drfVal.text())
-        self.obs_rf = float(self.orfVal.text())
-        self.smooth_by = int(self.smthVal.text())
-        self.prof = self.profVal.text()
-        self.prof_t = self.profVal.text() + ' Time'
-
-        if self.vm is None or self.fmax_vm is None:
-            return
-
-        if self.autoCheckbox.isChecked():
-            self.mph = None
-            self.mpd = None
-        else:
-            try:
-                self.mph = float(self.mphVal.text())
-                self.mpd = float(self.mpdVal.text())
-            except ValueError:
-                QtWidgets.QMessageBox.about(self, "Error",
-                                            "Value for Min. Peak Height or Min Peak Dist is invalid")
+        with profiler.stage('run_analysis'):
+            # keeps the plots and curves for this run
+            self.plotGrid.clear()
+            self.output_df = None
+            self.table.setRowCount(0)
+            self.kd = float(self.kdVal.text())
+            self.background = float(self.bkgVal.text())
+            self.dye_rf = float(self.drfVal.text())
+            self.obs_rf = float(self.orfVal.text())
+            self.smooth_by = int(self.smthVal.text())
+            self.prof = self.profVal.text()
+            self.prof_t = self.profVal.text() + ' Time'
+
+            if self.vm is None or self.fmax_vm is None:
+                return
+            if not self.update_profiles():
                 return
 
-        fmax = self.calc_fmax()
-        self.calc_ca(fmax)
+            if self.autoCheckbox.isChecked():
+                self.mph = None
+                self.mpd = None
+            else:
+                try:
+                    self.mph = float(self.mphVal.text())
+                    self.mpd = float(self.mpdVal.text())
+                except ValueError:
+                    QtWidgets.QMessageBox.about(self, "Error",
+                                                "Value for Min. Peak Height or Min Peak Dist is invalid")
+                    return
+
+            self.output_files = [self.ls_folder, self.fmax_folder]
+            self.output_params = self.analysis_params()
+            with profiler.stage('cache_lookup'):
+                key = self.result_key()
+                result = self.result_cache.get(key)
+            if result is None:
+                with profiler.stage('calc_fmax'):
+                    fmax = self.calc_fmax()
+                with profiler.stage('calc_ca'):
+                    ca_smth, ixs, metrics = self.calc_ca(fmax.fmax)
+                self.result_cache.put(key, (fmax, ca_smth, ixs, metrics,
+                                            self.mph, self.mpd))
+            else:
+                fmax, ca_smth, ixs, metrics, self.mph, self.mpd = result
+                if self.autoCheckbox.isChecked():
+                    self.mphVal.setText(str(self.mph))
+                    self.mpdVal.setText(str(self.mpd))
+            with profiler.stage('plot'):
+                self.plot_fmax(fmax)
+                self.plot_ca(ca_smth, ixs, metrics)
+
+    def result_key(self):
+        arrays = [self.ls[self.prof_t].values, self.ls[self.prof].values,
+                  self.fmax_ls[self.prof_t].values, self.fmax_ls[self.prof].values,
+                  self.fmax_vm.time.values, self.fmax_vm.secondary.values]
+        return self.result_cache.key('ca.run_analysis', arrays,
+                                     self.output_params)
+
+    def set_bypass_cache(self, checked):
+        self.result_cache.bypass = checked
 
     def run_new_analysis(self):
         self.load_data()
         self.run_analysis()
 
+    def analysis_params(self):
+        """The parameters of the window under ca_batch's names, mph and mpd
+        None when they are determined automatically."""
+        return {'kd': self.kd, 'background': self.background,
+                'dye_rf': self.dye_rf, 'obs_rf': self.obs_rf,
+                'smooth_by': self.smooth_by, 'profile': self.prof,
+                'roi': self.roiVal.text(), 'mph': self.mph, 'mpd': self.mpd}
+
     def copy_output(self):
         if self.output_df is not None:
             self.output_df.to_clipboard(index=False)
+
+    def save_results(self):
+        if self.output_df is None:
+            QtWidgets.QMessageBox.about(self, "Error", "Run the analysis first")
+            return
+        try:
+            results.save('ca', self.output_files, self.output_params,
+                         self.output_df)
+        except results.ERRORS as err:
+            QtWidgets.QMessageBox.about(self, "Error",
+                                        "Could not save results: %s" % err)
 if __name__ == '__main__':
     app = QtWidgets.QApplication(sys.argv)
     ex = CaAnalysis()
     ex.show()
+    warm_up_in_background()
     sys.exit(app.exec_())
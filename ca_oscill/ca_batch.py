@@ -0,0 +1,117 @@
+"""CaAnalysis without the window, for the job queue.
+
+load reads an oscillation folder and its fmax folder into plain arrays and
+compute runs the Fmax calibration, [Ca] conversion, peak detection and
+per-oscillation metrics of run_analysis on them. Parameters not given take
+the window's defaults; mph and mpd left as None are determined
+automatically, as with the window's checkbox.
+"""
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import neurphys.read_pv as rpv
+import neurphys.utilities as util
+from labcommon import linescan, peaks
+import calibration
+import conversion
+
+
+DEFAULTS = OrderedDict([('kd', 120), ('background', 0), ('dye_rf', 22),
+                        ('obs_rf', 18), ('smooth_by', 9),
+                        ('profile', 'Prof 2'), ('roi', ''), ('mph', None),
+                        ('mpd', None)])
+
+HEADERS = ['Average Area', 'Total Area', 'Peak', 'Baseline', 'Average']
+
+
+def fmax_calibration(vm_time, secondary, ls_time, profile, background,
+                     dye_rf, obs_rf):
+    """Fmax from the 0.5 s of linescan before the steepest rise of the
+    secondary channel (less 50 ms)."""
+    sampling = 1 / (vm_time[1] - vm_time[0])
+    ix = np.nanargmax(np.gradient(util.simple_smoothing(secondary, 200)))
+    end = vm_time[int(ix-sampling*0.05)]
+    start = end - 0.5
+
+    mask = (ls_time >= start) & (ls_time <= end)
+    f0 = np.nanmean(profile[mask] - background)
+    return calibration.Fmax(f0 * (dye_rf / obs_rf), f0, start, end)
+
+
+def oscillation_metrics(time, ca_smth, ixs):
+    """(first, last, metrics) per oscillation between the troughs either side
+    of each peak, metrics in HEADERS order. The first and last peaks only
+    bound their neighbours."""
+    rows = []
+    for i, ix in enumerate(ixs[1:-1]):
+        tr_ix1 = ixs[i] + np.nanargmin(ca_smth[ixs[i]:ix])
+        tr_ix2 = ix + np.nanargmin(ca_smth[ix:ixs[i+2]])
+        sub = ca_smth[tr_ix1:tr_ix2]
+        sub_t = time[tr_ix1:tr_ix2]
+
+        avg_area = np.trapz(sub, sub_t) / (sub_t[-1] - sub_t[0])
+        total_area = np.trapz(sub)
+        peak = np.nanmax(sub)
+        peak_ix = np.nanargmax(sub)
+        bsl1 = np.nanmean(sub[:peak_ix+1][:100])
+        bsl2 = np.nanmean(sub[peak_ix:][-100:])
+        baseline = (bsl1+bsl2)/2
+        avg = np.nanmean(sub)
+        rows.append((tr_ix1, tr_ix2, (avg_area, total_area, peak, baseline, avg)))
+    return rows
+
+
+def read_folder(folder, roi):
+    data_dict = rpv.import_folder(folder)
+    vm, ls = data_dict['voltage recording'], data_dict['linescan']
+    if vm is None:
+        raise ValueError('%s does not contain a voltage recording' % folder)
+    if roi is not None:
+        ls = linescan.LinescanImages(folder).profile_frame(roi)
+    elif ls is None:
+        raise ValueError('%s does not contain linescan profiles' % folder)
+    return vm, ls
+
+
+def load(paths, params):
+    """paths is [oscillation folder, fmax folder]."""
+    if len(paths) != 2:
+        raise ValueError('Ca analysis needs an oscillation and an fmax folder')
+    params = dict(DEFAULTS, **params)
+    roi = linescan.parse_roi(params['roi'])
+    prof, prof_t = params['profile'], params['profile'] + ' Time'
+    vm, ls = read_folder(paths[0], roi)
+    fmax_vm, fmax_ls = read_folder(paths[1], roi)
+    return {'ls_time': ls[prof_t].values, 'profile': ls[prof].values,
+            'fmax_time': fmax_vm.time.values,
+            'fmax_secondary': fmax_vm.secondary.values,
+            'fmax_ls_time': fmax_ls[prof_t].values,
+            'fmax_profile': fmax_ls[prof].values}
+
+
+def compute(data, params):
+    params = dict(DEFAULTS, **params)
+    fmax = fmax_calibration(data['fmax_time'], data['fmax_secondary'],
+                            data['fmax_ls_time'], data['fmax_profile'],
+                            params['background'], params['dye_rf'],
+                            params['obs_rf'])
+
+    ca = conversion.CaConversion()
+    ca.convert(data['profile'], params['background'], fmax.fmax, params['kd'],
+               params['dye_rf'])
+    ca_smth = ca.smooth(params['smooth_by'])
+
+    time = data['ls_time']
+    mph, mpd = params['mph'], params['mpd']
+    if mph is None:
+        mph = np.nanmax(ca_smth)/2
+    if mpd is None:
+        mpd = 0.25 / (time[1] - time[0])
+    ixs = peaks.detect_peaks(ca_smth, mph=mph, mpd=mpd)
+
+    rows = [metrics for _, _, metrics in oscillation_metrics(time, ca_smth, ixs)]
+    return pd.DataFrame(rows, columns=HEADERS)
+
+
+def analyze(paths, params):
+    return compute(load(paths, params), params)
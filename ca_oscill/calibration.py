@@ -0,0 +1,86 @@
+"""Fmax calibrations kept across runs and sessions.
+
+An Fmax calibration depends only on the fmax folder and on the profile, line
+ROI, background and Rf values used to average it, so it is stored in a small
+SQLite database keyed on exactly those. The folder is identified by a
+fingerprint of its files' names, sizes and modification times; re-exporting
+or editing the data gives a new fingerprint and a fresh calibration.
+"""
+import hashlib
+import os
+import sqlite3
+import time
+from collections import namedtuple
+
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.lab_apps',
+                            'calibration.sqlite')
+
+KEY_FIELDS = ('fingerprint', 'profile', 'roi', 'background', 'dye_rf', 'obs_rf')
+
+Fmax = namedtuple('Fmax', ['fmax', 'f0', 'start', 'end'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fmax (
+    fingerprint TEXT NOT NULL,
+    profile TEXT NOT NULL,
+    roi TEXT NOT NULL,
+    background REAL NOT NULL,
+    dye_rf REAL NOT NULL,
+    obs_rf REAL NOT NULL,
+    folder TEXT,
+    fmax REAL NOT NULL,
+    f0 REAL NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (fingerprint, profile, roi, background, dye_rf, obs_rf)
+)
+"""
+
+
+def folder_fingerprint(folder):
+    digest = hashlib.sha1()
+    for entry in sorted(os.scandir(folder), key=lambda e: e.name):
+        if entry.is_file():
+            stat = entry.stat()
+            digest.update(('%s %d %d\n' % (entry.name, stat.st_size,
+                                           stat.st_mtime_ns)).encode())
+    return digest.hexdigest()
+
+
+class CalibrationStore:
+    """Falls back to not caching at all if the database cannot be opened or
+    written, a calibration is only ever a shortcut."""
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            if self.path != ':memory:':
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute(SCHEMA)
+        return self._conn
+
+    def get(self, key):
+        where = ' AND '.join('%s = ?' % field for field in KEY_FIELDS)
+        try:
+            row = self._connect().execute(
+                'SELECT fmax, f0, start, end FROM fmax WHERE ' + where,
+                [key[field] for field in KEY_FIELDS]).fetchone()
+        except (sqlite3.Error, OSError):
+            return None
+        return None if row is None else Fmax(*row)
+
+    def put(self, key, calibration, folder=None):
+        fields = KEY_FIELDS + ('folder',) + Fmax._fields + ('created',)
+        values = ([key[field] for field in KEY_FIELDS] + [folder] +
+                  list(calibration) + [time.time()])
+        try:
+            with self._connect() as conn:
+                conn.execute('INSERT OR REPLACE INTO fmax (%s) VALUES (%s)' % (
+                    ', '.join(fields), ', '.join('?' * len(fields))), values)
+        except (sqlite3.Error, OSError):
+            pass
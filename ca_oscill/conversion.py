@@ -0,0 +1,55 @@
+"""[Ca] conversion of a linescan profile into buffers kept between runs.
+
+Re-running the analysis with a new Kd, background or smoothing only rewrites
+the buffers in place; they are reallocated when the profile length changes.
+"""
+import numpy as np
+import neurphys.utilities as util
+
+
+class CaConversion:
+    def __init__(self):
+        self.size = None
+
+    def _allocate(self, n):
+        if n != self.size:
+            self.bkg_sub = np.empty(n)
+            self.ca_conc = np.empty(n)
+            self.ca_smth = np.empty(n)
+            self._scratch = np.empty(n)
+            self._cumsum = np.empty(n + 1)
+            self.size = n
+
+    def convert(self, profile, background, fmax, kd, dye_rf):
+        """ca_conc = kd * (1 - bkg_sub/fmax) / (profile/fmax - 1/dye_rf)"""
+        profile = np.asarray(profile, dtype='float64')
+        self._allocate(len(profile))
+        np.subtract(profile, background, out=self.bkg_sub)
+        np.divide(self.bkg_sub, fmax, out=self.ca_conc)
+        np.subtract(1, self.ca_conc, out=self.ca_conc)
+        np.divide(profile, fmax, out=self._scratch)
+        np.subtract(self._scratch, 1/dye_rf, out=self._scratch)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(self.ca_conc, self._scratch, out=self.ca_conc)
+        np.multiply(self.ca_conc, kd, out=self.ca_conc)
+        return self.ca_conc
+
+    def smooth(self, n):
+        """Centred n-point running mean of ca_conc into ca_smth, as
+        util.simple_smoothing computes it."""
+        n = max(int(n), 1)
+        self.ca_smth.fill(np.nan)
+        if n > self.size:
+            return self.ca_smth
+        cs = self._cumsum
+        cs[0] = 0
+        np.cumsum(self.ca_conc, out=cs[1:])
+        if not np.isfinite(cs[-1]):
+            # a running sum carries a nan or inf to the end of the trace
+            self.ca_smth[:] = util.simple_smoothing(self.ca_conc, n)
+            return self.ca_smth
+        shift = (n - 1) // 2
+        out = self.ca_smth[shift:shift + self.size - n + 1]
+        np.subtract(cs[n:], cs[:-n], out=out)
+        np.divide(out, n, out=out)
+        return self.ca_smth
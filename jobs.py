@@ -0,0 +1,167 @@
+"""Queue analyses of many recordings and run them unattended.
+
+    python jobs.py add pyminis cell1.abf cell2.abf --params minis.json
+    python jobs.py add ca osc1:fmax1 osc2:fmax2
+    python jobs.py add baps bap1:bap2:bap3
+    python jobs.py run --workers 4
+    python jobs.py status --failed
+    python jobs.py retry
+    python jobs.py export minis.csv --app pyminis
+    python jobs.py run --results ~/results.sqlite
+    python jobs.py run --shared-memory
+
+Each input is one job: a file or folder, or several joined with the path
+separator (':', ';' on Windows) for the Ca oscillation and fmax folders or
+the bAP folders to average. --params is a JSON file of the analysis
+parameters, anything missing takes the app's default. The queue lives in
+jobs.sqlite (--db); stopping or killing a run and starting it again picks
+up where it left off. Finished jobs also go into the results database
+shared with the apps (--results, see labcommon.results) unless --no-results
+is given. With --shared-memory the files are read by this process and the
+workers get the data through shared memory; the next --prefetch jobs (2) are
+read ahead while the workers compute.
+"""
+import argparse
+import importlib
+import io
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from launcher import APPS
+from labcommon import jobqueue, results
+
+
+# app -> batch module with load/compute/analyze(paths, params)
+BATCH_MODULES = {'pyminis': 'batch', 'ca': 'ca_batch', 'baps': 'bap_batch',
+                 'atype': 'atype_batch'}
+
+
+def app_paths():
+    return [os.path.join(ROOT, APPS[app][0]) for app in sorted(APPS)] + [ROOT]
+
+
+def add(queue, args):
+    params = {}
+    if args.params:
+        with open(args.params) as f:
+            params = json.load(f)
+    task = BATCH_MODULES[args.app] + ':analyze'
+    added = sum(queue.add(args.app, task, item.split(os.pathsep), params)
+                for item in args.inputs)
+    print('%d job(s) added, %d already queued' % (added, len(args.inputs) - added))
+
+
+def results_writer(db_path):
+    """on_result for jobqueue.run: stores every finished job in the results
+    database under the full parameters, defaults included, as the apps do."""
+    import pandas as pd
+    for path in app_paths():
+        if path not in sys.path:
+            sys.path.append(path)
+    db = results.ResultsDB(db_path)
+
+    def store(job, result):
+        defaults = importlib.import_module(BATCH_MODULES[job.app]).DEFAULTS
+        df = pd.read_json(io.StringIO(result), orient='split')
+        db.store(job.app, job.paths, dict(defaults, **job.params), df)
+    return db, store
+
+
+def status(queue, args):
+    counts = queue.counts()
+    print(' '.join('%s %d' % item for item in counts.items()))
+    if args.failed:
+        for job_id, app, paths, _, attempts, error, _ in queue.jobs(jobqueue.FAILED):
+            last = (error or '').strip().splitlines()[-1:] or ['']
+            print('%d %s %s (%d attempts): %s' % (job_id, app,
+                                                  os.pathsep.join(paths),
+                                                  attempts, last[0]))
+
+
+def export(queue, args):
+    import pandas as pd
+    frames = []
+    for paths, result in queue.results(args.app):
+        df = pd.read_json(io.StringIO(result), orient='split')
+        df.insert(0, 'File', os.pathsep.join(paths))
+        frames.append(df)
+    if not frames:
+        print('no finished jobs')
+        return
+    pd.concat(frames, ignore_index=True).to_csv(args.output, index=False)
+    print('%d job(s) written to %s' % (len(frames), args.output))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--db', default='jobs.sqlite')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    add_parser = commands.add_parser('add')
+    add_parser.add_argument('app', choices=sorted(BATCH_MODULES))
+    add_parser.add_argument('inputs', nargs='+')
+    add_parser.add_argument('--params', help='JSON file of parameters')
+
+    run_parser = commands.add_parser('run')
+    run_parser.add_argument('--workers', type=int, default=None)
+    run_parser.add_argument('--max-attempts', type=int, default=3)
+    run_parser.add_argument('--backoff', type=float, default=30.0,
+                            help='seconds before the first retry, doubled after')
+    run_parser.add_argument('--results', default=results.DEFAULT_PATH,
+                            help='results database to add finished jobs to')
+    run_parser.add_argument('--no-results', action='store_true')
+    run_parser.add_argument('--shared-memory', action='store_true',
+                            help='load here, compute in the workers')
+    run_parser.add_argument('--prefetch', type=int, default=2,
+                            help='jobs read ahead with --shared-memory '
+                                 '(0 reads each one when it is submitted)')
+
+    status_parser = commands.add_parser('status')
+    status_parser.add_argument('--failed', action='store_true',
+                               help='list the failed jobs and their errors')
+
+    commands.add_parser('retry', help='requeue the failed jobs')
+
+    export_parser = commands.add_parser('export')
+    export_parser.add_argument('output')
+    export_parser.add_argument('--app', choices=sorted(BATCH_MODULES))
+    args = parser.parse_args(argv)
+
+    queue = jobqueue.JobQueue(args.db, getattr(args, 'max_attempts', 3),
+                              getattr(args, 'backoff', 30.0))
+    try:
+        if args.command == 'add':
+            add(queue, args)
+        elif args.command == 'run':
+            db, store = None, None
+            if not args.no_results:
+                db, store = results_writer(args.results)
+            try:
+                counts = jobqueue.run(queue, args.workers, app_paths(),
+                                      on_result=store,
+                                      shared_memory=args.shared_memory,
+                                      prefetch=args.prefetch)
+            finally:
+                if db is not None:
+                    db.close()
+            print(' '.join('%s %d' % item for item in counts.items()))
+            return 1 if counts[jobqueue.FAILED] else 0
+        elif args.command == 'status':
+            status(queue, args)
+        elif args.command == 'retry':
+            print('%d failed job(s) requeued' % queue.retry_failed())
+        elif args.command == 'export':
+            export(queue, args)
+    finally:
+        queue.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
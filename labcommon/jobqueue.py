@@ -0,0 +1,384 @@
+"""Crash-safe queue of analysis jobs, kept in an SQLite file.
+
+A job is one call of an app's batch ``analyze(paths, params)`` (e.g. one
+.abf file for pyminis, an oscillation/fmax folder pair for Ca). Every state
+change is committed as it happens, so a run that is killed resumes where it
+stopped: jobs left 'running' by the dead run go back to 'pending' (the
+interrupted attempt counts). A failed attempt is retried after
+backoff * 2**(attempt-1) seconds until max_attempts is reached, then the job
+stays 'failed' with its traceback until retry_failed(). Results are stored
+with the job as DataFrame JSON.
+
+run() keeps `workers` jobs in flight on a process pool, replaces the pool if
+a worker process dies, and reports progress after every finished job. With
+shared_memory the batch module's load() runs in this process and compute()
+in the worker, which gets the data through labcommon.shared rather than
+reading the files itself. The loads are prefetched: up to `prefetch` jobs
+are read and decoded on I/O threads (labcommon.prefetch) while the workers
+compute, so a worker that finishes gets its next sweeps without waiting for
+the disk. At most `prefetch` loaded jobs wait for a worker; beyond that no
+more jobs are claimed until one is handed over. Each result is also handed
+to on_result(job, result), e.g. to put it in the results database; an
+error there is reported and the run goes on.
+"""
+import importlib
+import json
+import os
+import sqlite3
+import sys
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from labcommon import shared
+from labcommon.prefetch import Prefetcher
+
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+STATUSES = (PENDING, RUNNING, DONE, FAILED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    app TEXT NOT NULL,
+    task TEXT NOT NULL,
+    paths TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_try REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    result TEXT,
+    seconds REAL,
+    added REAL,
+    started REAL,
+    finished REAL,
+    UNIQUE (app, paths, params)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, next_try);
+"""
+
+Job = namedtuple('Job', ['id', 'app', 'task', 'paths', 'params', 'attempts'])
+
+
+class JobQueue:
+    def __init__(self, path, max_attempts=3, backoff=30.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, app, task, paths, params):
+        """Queues analyze(paths, params) of task ('module:function') unless
+        the same job is already queued. Returns True if it was added."""
+        cur = self.conn.execute(
+            'INSERT OR IGNORE INTO jobs (app, task, paths, params, added) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (app, task, json.dumps([os.path.abspath(p) for p in paths]),
+             json.dumps(params, sort_keys=True), time.time()))
+        return cur.rowcount > 0
+
+    def recover(self):
+        """Jobs left running by a run that died: back to pending, or failed
+        if that was their last attempt."""
+        cur = self.conn.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' "
+            "ELSE 'pending' END, error = 'interrupted' WHERE status = 'running'",
+            (self.max_attempts,))
+        return cur.rowcount
+
+    def claim(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute(
+                "SELECT id, app, task, paths, params, attempts FROM jobs "
+                "WHERE status = 'pending' AND next_try <= ? ORDER BY id LIMIT 1",
+                (time.time(),)).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, "
+                    "started = ? WHERE id = ?", (time.time(), row[0]))
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        return Job(row[0], row[1], row[2], json.loads(row[3]),
+                   json.loads(row[4]), row[5] + 1)
+
+    def finish(self, job, result, seconds):
+        self.conn.execute(
+            "UPDATE jobs SET status = 'done', result = ?, seconds = ?, "
+            "error = NULL, finished = ? WHERE id = ?",
+            (result, seconds, time.time(), job.id))
+
+    def fail(self, job, error):
+        if job.attempts >= self.max_attempts:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, finished = ? "
+                "WHERE id = ?", (error, time.time(), job.id))
+        else:
+            delay = self.backoff * 2**(job.attempts - 1)
+            self.conn.execute(
+                "UPDATE jobs SET status = 'pending', error = ?, next_try = ? "
+                "WHERE id = ?", (error, time.time() + delay, job.id))
+
+    def release(self, job):
+        """Back to pending without counting the attempt (run stopped)."""
+        self.conn.execute(
+            "UPDATE jobs SET status = 'pending', attempts = attempts - 1 "
+            "WHERE id = ?", (job.id,))
+
+    def retry_failed(self):
+        cur = self.conn.execute(
+            "UPDATE jobs SET status = 'pending', attempts = 0, next_try = 0 "
+            "WHERE status = 'failed'")
+        return cur.rowcount
+
+    def counts(self):
+        counts = dict.fromkeys(STATUSES, 0)
+        counts.update(self.conn.execute(
+            'SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        return counts
+
+    def next_try(self):
+        """Seconds until the next pending job may start, None if none are
+        pending."""
+        row = self.conn.execute(
+            "SELECT MIN(next_try) FROM jobs WHERE status = 'pending'").fetchone()
+        return None if row[0] is None else max(row[0] - time.time(), 0)
+
+    def jobs(self, status=None, app=None):
+        """(id, app, paths, status, attempts, error, seconds) rows."""
+        query = ('SELECT id, app, paths, status, attempts, error, seconds '
+                 'FROM jobs WHERE 1')
+        args = []
+        if status is not None:
+            query += ' AND status = ?'
+            args.append(status)
+        if app is not None:
+            query += ' AND app = ?'
+            args.append(app)
+        return [(r[0], r[1], json.loads(r[2])) + r[3:]
+                for r in self.conn.execute(query + ' ORDER BY id', args)]
+
+    def results(self, app=None):
+        """(paths, result JSON) of every finished job."""
+        query = "SELECT paths, result FROM jobs WHERE status = 'done'"
+        args = []
+        if app is not None:
+            query += ' AND app = ?'
+            args.append(app)
+        return [(json.loads(r[0]), r[1])
+                for r in self.conn.execute(query + ' ORDER BY id', args)]
+
+
+def _init_worker(paths):
+    for path in paths:
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
+def run_job(task, paths, params):
+    """Runs in a worker: (DataFrame JSON, seconds)."""
+    module, function = task.split(':')
+    start = time.perf_counter()
+    result = getattr(importlib.import_module(module), function)(paths, params)
+    return result.to_json(orient='split'), time.perf_counter() - start
+
+
+def run_shared(task, ref, params, load_seconds=0.0):
+    """Runs in a worker: compute() of the task's module on the data the
+    parent loaded and shared."""
+    module = importlib.import_module(task.split(':')[0])
+    start = time.perf_counter()
+    result = shared.call(module.compute, ref, params)
+    return (result.to_json(orient='split'),
+            time.perf_counter() - start + load_seconds)
+
+
+def load_shared(task, paths, params):
+    """Runs on a prefetch thread: load() of the task's module, shared.
+    Returns (SharedData, seconds)."""
+    module = importlib.import_module(task.split(':')[0])
+    start = time.perf_counter()
+    block = shared.share(module.load(paths, params))
+    return block, time.perf_counter() - start
+
+
+def submit_shared(pool, job, block, load_seconds):
+    try:
+        future = pool.submit(run_shared, job.task, block.ref, job.params,
+                             load_seconds)
+    except BaseException:
+        block.release()
+        raise
+    future.add_done_callback(block.release)
+    return future
+
+
+def submit(pool, job, shared_memory=False):
+    if not shared_memory:
+        return pool.submit(run_job, job.task, job.paths, job.params)
+    module = importlib.import_module(job.task.split(':')[0])
+    start = time.perf_counter()
+    block = shared.share(module.load(job.paths, job.params))
+    return submit_shared(pool, job, block, time.perf_counter() - start)
+
+
+def _drop_loads(queue, loads):
+    """Requeues the prefetched jobs not handed to a worker."""
+    if loads is None:
+        return 0
+    left = loads.close()
+    for (job, started), future in left:
+        if future.done() and not future.cancelled() and \
+                future.exception() is None:
+            future.result()[0].release()
+        queue.release(job)
+    return len(left)
+
+
+class Progress:
+    def __init__(self):
+        self.start = time.time()
+        self.finished = 0
+
+    def line(self, queue, job, ok, seconds):
+        self.finished += 1
+        counts = queue.counts()
+        settled = counts[DONE] + counts[FAILED]
+        rate = self.finished / max(time.time() - self.start, 1e-9)
+        remaining = counts[PENDING] + counts[RUNNING]
+        eta = time.strftime('%H:%M:%S', time.gmtime(remaining / rate))
+        name = os.path.basename(job.paths[0]) if job.paths else str(job.id)
+        return ('[%d/%d] done %d failed %d running %d | %.1f jobs/min | '
+                'eta %s | %s %s (%.1f s)' % (
+                    settled, sum(counts.values()), counts[DONE],
+                    counts[FAILED], counts[RUNNING], rate * 60, eta,
+                    'ok' if ok else 'error', name, seconds))
+
+
+def run(queue, workers=None, sys_paths=(), report=print, poll=0.5,
+        on_result=None, shared_memory=False, prefetch=2):
+    """Works through the queue until nothing is pending. Returns the status
+    counts. prefetch 0 loads every shared job just before it is submitted."""
+    workers = workers or os.cpu_count() or 1
+    if shared_memory:
+        # the batch modules are imported here too
+        _init_worker(sys_paths)
+    recovered = queue.recover()
+    if recovered:
+        report('%d interrupted job(s) requeued' % recovered)
+
+    def new_pool():
+        return ProcessPoolExecutor(workers, initializer=_init_worker,
+                                   initargs=(list(sys_paths),))
+
+    pool = new_pool()
+    running = {}
+    loads = (Prefetcher(load_shared, prefetch)
+             if shared_memory and prefetch else None)
+    progress = Progress()
+    interrupted = False
+
+    def failed(job, started, err):
+        queue.fail(job, ''.join(traceback.format_exception(
+            type(err), err, err.__traceback__)))
+        report(progress.line(queue, job, False,
+                             time.perf_counter() - started))
+
+    try:
+        while True:
+            while loads is not None and loads.room() > 0:
+                job = queue.claim()
+                if job is None:
+                    break
+                loads.put((job, time.perf_counter()), job.task, job.paths,
+                          job.params)
+            if loads is not None:
+                for (job, started), load in loads.take(workers - len(running)):
+                    try:
+                        block, load_seconds = load.result()
+                        future = submit_shared(pool, job, block, load_seconds)
+                    except Exception as err:
+                        failed(job, started, err)
+                        continue
+                    running[future] = (job, started)
+            while loads is None and len(running) < workers:
+                job = queue.claim()
+                if job is None:
+                    break
+                started = time.perf_counter()
+                try:
+                    future = submit(pool, job, shared_memory)
+                except Exception as err:
+                    # loading failed in this process (or the pool is broken,
+                    # which the next wait() finds out)
+                    failed(job, started, err)
+                    continue
+                running[future] = (job, started)
+            if not running and not (loads is not None and len(loads)):
+                delay = queue.next_try()
+                if delay is None:
+                    break
+                # everything left is waiting out a retry backoff
+                time.sleep(min(delay, 5.0) + 0.01)
+                continue
+
+            # loads that are done only wait for a free worker
+            loading = [] if loads is None else [
+                future for future in loads.futures if not future.done()]
+            done, _ = wait(list(running) + loading, timeout=poll,
+                           return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                if future not in running:
+                    continue
+                job, started = running.pop(future)
+                try:
+                    result, seconds = future.result()
+                except BrokenProcessPool:
+                    broken = True
+                    queue.fail(job, 'worker process died')
+                    report(progress.line(queue, job, False,
+                                         time.perf_counter() - started))
+                except Exception as err:
+                    failed(job, started, err)
+                else:
+                    queue.finish(job, result, seconds)
+                    if on_result is not None:
+                        try:
+                            on_result(job, result)
+                        except Exception as err:
+                            # the job is done in the queue, a results
+                            # database that is locked or gone must not
+                            # stop the run
+                            report('could not store the result of %s: %s' % (
+                                os.pathsep.join(job.paths), err))
+                    report(progress.line(queue, job, True, seconds))
+            if broken:
+                # the other jobs in flight died with the pool
+                for future, (job, started) in running.items():
+                    queue.fail(job, 'worker process died')
+                running = {}
+                pool.shutdown(wait=False)
+                pool = new_pool()
+    except KeyboardInterrupt:
+        for future, (job, started) in running.items():
+            future.cancel()
+            queue.release(job)
+        requeued = len(running) + _drop_loads(queue, loads)
+        report('stopped, %d running job(s) requeued' % requeued)
+        interrupted = True
+    finally:
+        _drop_loads(queue, loads)
+        pool.shutdown(wait=not interrupted)
+    return queue.counts()
@@ -0,0 +1,51 @@
+"""Deferred imports so the app windows can appear before scipy, pandas and
+neurphys are loaded."""
+import importlib
+import threading
+
+
+_registry = []
+
+
+class LazyModule:
+    """Stands in for a module and imports it on first attribute access."""
+    def __init__(self, name):
+        self._lazy_name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._lazy_name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return '<lazy module %r (%s)>' % (self._lazy_name, state)
+
+
+def lazy_import(name):
+    module = LazyModule(name)
+    _registry.append(module)
+    return module
+
+
+def warm_up():
+    for module in list(_registry):
+        try:
+            module._load()
+        except ImportError:
+            # surfaces again, with a traceback, when the app really needs it
+            pass
+
+
+def warm_up_in_background():
+    thread = threading.Thread(target=warm_up, name='import-warm-up',
+                              daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,191 @@
+"""Profiles from raw Prairie View linescan images.
+
+Prairie View writes each linescan as uncompressed TIFFs, one per cycle and
+channel, with one image row per scanned line (the row-to-row interval is
+the scanLinePeriod in the folder's xml). Pages are memory-mapped, not read,
+and a set of ROIs, each a set of pixel ranges along the scan line, is
+reduced to mean profiles with a single matrix product per block of lines:
+(lines x pixels) @ (pixels x ROIs). Blocks from every channel and cycle are
+reduced in a thread pool; numpy releases the GIL for the products.
+"""
+import glob
+import os
+import re
+import struct
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+
+FILE_PATTERN = re.compile(r'_Cycle(\d+)_Ch(\d+)_(\d+)(\.ome)?\.tif$',
+                          re.IGNORECASE)
+LINE_PERIOD = re.compile(r'key="scanLinePeriod"\s+value="([0-9.eE+-]+)"')
+BLOCK_LINES = 8192
+
+_TYPE_SIZES = {1: 1, 3: 2, 4: 4, 16: 8}
+_TYPE_CODES = {1: 'B', 3: 'H', 4: 'I', 16: 'Q'}
+_SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+def _read_tags(f, order, offset):
+    f.seek(offset)
+    n_entries, = struct.unpack(order + 'H', f.read(2))
+    tags = {}
+    for _ in range(n_entries):
+        tag, typ, count, value = struct.unpack(order + 'HHI4s', f.read(12))
+        size = _TYPE_SIZES.get(typ)
+        if size is None:
+            continue
+        if size * count > 4:
+            here = f.tell()
+            f.seek(struct.unpack(order + 'I', value)[0])
+            value = f.read(size * count)
+            f.seek(here)
+        tags[tag] = struct.unpack_from(order + _TYPE_CODES[typ]*count, value)
+    next_ifd, = struct.unpack(order + 'I', f.read(4))
+    return tags, next_ifd
+
+
+def tiff_pages(path):
+    """Every page of an uncompressed TIFF as a read-only memmap of shape
+    (rows, columns)."""
+    pages = []
+    with open(path, 'rb') as f:
+        head = f.read(8)
+        order = {b'II': '<', b'MM': '>'}.get(head[:2])
+        if order is None or struct.unpack(order + 'H', head[2:4])[0] != 42:
+            raise ValueError('%s is not a classic TIFF file' % path)
+        offset, = struct.unpack(order + 'I', head[4:8])
+        while offset:
+            tags, offset = _read_tags(f, order, offset)
+            if tags.get(259, (1,))[0] != 1:
+                raise ValueError('%s is compressed' % path)
+            if tags.get(277, (1,))[0] != 1:
+                raise ValueError('%s has more than one sample per pixel' % path)
+            cols, rows = tags[256][0], tags[257][0]
+            bits = tags.get(258, (8,))[0]
+            kind = _SAMPLE_KINDS[tags.get(339, (1,))[0]]
+            strips, counts = tags[273], tags[279]
+            contiguous = all(strips[i] + counts[i] == strips[i+1]
+                             for i in range(len(strips) - 1))
+            if not contiguous:
+                raise ValueError('%s has non-contiguous strips' % path)
+            dtype = np.dtype(order + kind + str(bits // 8))
+            pages.append(np.memmap(path, dtype=dtype, mode='r',
+                                   offset=strips[0], shape=(rows, cols)))
+    return pages
+
+
+def line_period(folder):
+    for xml in glob.glob(os.path.join(folder, '*.xml')):
+        with open(xml, errors='ignore') as f:
+            match = LINE_PERIOD.search(f.read())
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def roi_weights(n_pixels, rois):
+    """(pixels x ROIs) matrix whose product with a block of lines gives the
+    mean of each ROI. An ROI is a (start, stop) pixel range or a list of
+    them."""
+    weights = np.zeros((n_pixels, len(rois)), dtype='float32')
+    for j, roi in enumerate(rois):
+        ranges = [roi] if np.isscalar(roi[0]) else roi
+        for start, stop in ranges:
+            weights[max(int(start), 0):min(int(stop), n_pixels), j] = 1
+        count = weights[:, j].sum()
+        if not count:
+            raise ValueError('ROI %d has no pixels on the scan line' % (j+1))
+        weights[:, j] /= count
+    return weights
+
+
+def reduce_blocks(blocks, weights, block_lines=BLOCK_LINES):
+    parts = []
+    for page in blocks:
+        for start in range(0, len(page), block_lines):
+            block = np.asarray(page[start:start+block_lines], dtype='float32')
+            parts.append(block @ weights)
+    if not parts:
+        return np.empty((0, weights.shape[1]), dtype='float32')
+    return np.concatenate(parts)
+
+
+class LinescanImages:
+    """The raw linescan images of a Prairie View folder, grouped by cycle
+    (trial) and channel."""
+    def __init__(self, folder):
+        self.folder = folder
+        files = {}
+        for path in glob.glob(os.path.join(folder, '*.tif')):
+            match = FILE_PATTERN.search(path)
+            if match:
+                cycle, channel, part = (int(g) for g in match.groups()[:3])
+                files.setdefault((cycle, channel), []).append((part, path))
+        if not files:
+            raise ValueError('No linescan images in %s' % folder)
+
+        self.period = line_period(folder)
+        if self.period is None:
+            raise ValueError('No scanLinePeriod in the xml of %s' % folder)
+
+        # pages of every file, in acquisition order, for each cycle/channel
+        self.pages = OrderedDict()
+        for key in sorted(files):
+            self.pages[key] = [page for part, path in sorted(files[key])
+                               for page in tiff_pages(path)]
+        self.cycles = sorted({cycle for cycle, _ in self.pages})
+        self.channels = sorted({channel for _, channel in self.pages})
+        self.n_pixels = next(iter(self.pages.values()))[0].shape[1]
+
+    def mean_line(self, channel):
+        """Time-averaged intensity along the scan line, for picking ROIs."""
+        total = np.zeros(self.n_pixels)
+        n = 0
+        for (cycle, ch), pages in self.pages.items():
+            if ch == channel:
+                for page in pages:
+                    total += np.asarray(page, dtype='float64').sum(axis=0)
+                    n += len(page)
+        return total / max(n, 1)
+
+    def profiles(self, rois, workers=None):
+        """{(cycle, channel): (lines x ROIs) float32 array of ROI means}."""
+        weights = roi_weights(self.n_pixels, rois)
+        with ThreadPoolExecutor(workers) as pool:
+            futures = OrderedDict((key, pool.submit(reduce_blocks, pages,
+                                                    weights))
+                                  for key, pages in self.pages.items())
+            return OrderedDict((key, future.result())
+                               for key, future in futures.items())
+
+    def profile_frame(self, roi):
+        """Same layout as the exported linescan from read_pv: one 'Prof n'
+        and 'Prof n Time' column per channel n, indexed by (sweep, line)."""
+        profiles = self.profiles([roi])
+        frames = OrderedDict()
+        for cycle in self.cycles:
+            columns = OrderedDict()
+            for channel in self.channels:
+                vals = profiles.get((cycle, channel))
+                if vals is None:
+                    continue
+                columns['Prof %d' % channel] = vals[:, 0].astype('float64')
+                columns['Prof %d Time' % channel] = np.arange(len(vals)) * self.period
+            n = min(len(vals) for vals in columns.values())
+            frames['Sweep%04d' % cycle] = pd.DataFrame(
+                OrderedDict((name, vals[:n]) for name, vals in columns.items()))
+        return pd.concat(frames)
+
+
+def parse_roi(text):
+    """'10-40' or '10-40, 60-80' -> [(10, 40), (60, 80)], '' -> None."""
+    if not text.strip():
+        return None
+    ranges = []
+    for part in text.split(','):
+        start, stop = part.split('-')
+        ranges.append((int(start), int(stop)))
+    return ranges
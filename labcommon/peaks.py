@@ -0,0 +1,174 @@
+"""Peak and valley detection with the semantics of detect_peaks (Duarte's
+detect_peaks, as bundled in neurphys.pacemaking), for long traces.
+
+detect_peaks enforces the minimum peak distance by walking the candidates
+from the highest down and masking every neighbour of each kept peak over the
+whole candidate array, which is quadratic in the number of candidates; on a
+noisy trace every local maximum is a candidate. Here the same greedy pass
+runs in rounds: every candidate that comes first (in detect_peaks' order)
+among the candidates within mpd of it is certainly kept, and its neighbours
+certainly dropped, so a round settles all of those at once with a sliding
+window minimum. Whatever the rounds leave is finished one candidate at a
+time against a bucketed index of the kept peaks. The result is the same
+indices as detect_peaks, in O(n log n) for the sort.
+
+As in detect_peaks 1.0.5, mph is negated along with x when valley=True.
+"""
+import numpy as np
+
+
+MAX_ROUNDS = 8
+
+
+def _candidates(x, edge):
+    dx = x[1:] - x[:-1]
+    indnan = np.flatnonzero(np.isnan(x))
+    if indnan.size:
+        x[indnan] = np.inf
+        dx[np.isnan(dx)] = np.inf
+    before = np.concatenate(([0], dx))
+    after = np.concatenate((dx, [0]))
+    found = []
+    if not edge:
+        found.append((after < 0) & (before > 0))
+    else:
+        if edge.lower() in ['rising', 'both']:
+            found.append((after <= 0) & (before > 0))
+        if edge.lower() in ['falling', 'both']:
+            found.append((after < 0) & (before >= 0))
+    mask = np.zeros(x.size, dtype=bool)
+    for m in found:
+        mask |= m
+    if indnan.size:
+        near = np.concatenate((indnan, indnan-1, indnan+1))
+        mask[near[(near >= 0) & (near < x.size)]] = False
+    mask[0] = mask[-1] = False
+    return np.flatnonzero(mask)
+
+
+def window_min(a, half):
+    """Minimum of a[i-half:i+half+1] for every i (van Herk/Gil-Werman)."""
+    k = 2*half + 1
+    n = a.size
+    fill = np.iinfo(a.dtype).max
+    blocks = -(-(n + 2*half) // k)
+    padded = np.full(blocks*k + k, fill, dtype=a.dtype)
+    padded[half:half+n] = a
+    shaped = padded[:blocks*k + k].reshape(-1, k)
+    prefix = np.minimum.accumulate(shaped, axis=1).ravel()
+    suffix = np.minimum.accumulate(shaped[:, ::-1], axis=1)[:, ::-1].ravel()
+    return np.minimum(suffix[:n], prefix[k-1:k-1+n])
+
+
+def _settle_rounds(ind, rank, reach, size):
+    """Keeps and drops what the sliding-minimum rounds can decide.
+    Returns (keep, undecided) masks over ind."""
+    keep = np.zeros(ind.size, dtype=bool)
+    open_ = np.ones(ind.size, dtype=bool)
+    fill = np.iinfo(rank.dtype).max
+    dense = np.full(size, fill, dtype=rank.dtype)
+    for _ in range(MAX_ROUNDS):
+        live = np.flatnonzero(open_)
+        if not live.size:
+            break
+        dense.fill(fill)
+        dense[ind[live]] = rank[live]
+        first = live[window_min(dense, reach)[ind[live]] == rank[live]]
+        keep[first] = True
+        # everything within reach of a newly kept peak goes
+        starts = np.bincount(np.maximum(ind[first] - reach, 0),
+                             minlength=size + 1)
+        stops = np.bincount(np.minimum(ind[first] + reach + 1, size),
+                            minlength=size + 1)
+        covered = np.cumsum(starts - stops)[:size] > 0
+        open_ &= ~covered[ind]
+        if live.size - np.count_nonzero(open_[live]) < live.size // 20:
+            break
+    return keep, open_
+
+
+def _suppress(ind, heights, mpd, kpsh):
+    # the order detect_peaks visits the candidates in; a stable sort so that
+    # of equal heights the later candidate always comes first
+    order = np.argsort(heights, kind='stable')[::-1]
+    rank = np.empty(ind.size, dtype=np.int32)
+    rank[order] = np.arange(ind.size)
+    reach = int(np.floor(mpd))
+
+    if kpsh:
+        keep = np.zeros(ind.size, dtype=bool)
+        undecided = np.ones(ind.size, dtype=bool)
+    else:
+        size = int(ind[-1]) + 1
+        keep, undecided = _settle_rounds(ind, rank, min(reach, size), size)
+
+    # the rest in order, against the kept peaks bucketed by position; kept
+    # peaks are more than mpd apart, so a bucket of width mpd rarely holds
+    # more than one
+    width = max(reach, 1)
+    buckets = {}
+    for i in np.flatnonzero(keep).tolist():
+        buckets.setdefault(int(ind[i]) // width, []).append(i)
+    pos = ind.tolist()
+    h = heights.tolist()
+    todo = undecided[order]
+    for i in order[todo].tolist():
+        p = pos[i]
+        blocked = False
+        for b in range(int((p - mpd) // width), int((p + mpd) // width) + 1):
+            for j in buckets.get(b, ()):
+                if abs(pos[j] - p) <= mpd and (not kpsh or h[j] > h[i]):
+                    blocked = True
+                    break
+            if blocked:
+                break
+        if not blocked:
+            keep[i] = True
+            buckets.setdefault(p // width, []).append(i)
+    return ind[keep]
+
+
+def detect_peaks(x, mph=None, mpd=1, threshold=0, edge='rising', kpsh=False,
+                 valley=False):
+    """Indexes of the peaks (or valleys) in x, as detect_peaks returns them.
+
+    mph: minimum peak height; mpd: minimum distance between peaks, in
+    samples; threshold: minimum difference to both neighbours; edge: 'rising',
+    'falling', 'both' or None for flat peaks; kpsh: keep peaks of the same
+    height that are closer than mpd."""
+    x = np.array(x, dtype='float64')
+    if x.size < 3:
+        return np.array([], dtype=int)
+    if valley:
+        x = -x
+        if mph is not None:
+            mph = -mph
+    ind = _candidates(x, edge)
+    if ind.size and mph is not None:
+        ind = ind[x[ind] >= mph]
+    if ind.size and threshold > 0:
+        dx = np.min(np.vstack([x[ind]-x[ind-1], x[ind]-x[ind+1]]), axis=0)
+        ind = np.delete(ind, np.where(dx < threshold)[0])
+    if ind.size and mpd > 1:
+        ind = _suppress(ind, x[ind], mpd, kpsh)
+    return ind
+
+
+def benchmark(n=10**7, mpds=(5, 40, 400), seed=0):
+    """Times detect_peaks(valley=True) on n samples of smoothed noise, the
+    worst case for the number of candidates."""
+    import time
+    noise = np.random.RandomState(seed).normal(size=n)
+    x = np.convolve(noise, np.ones(9) / 9, mode='same')
+    lines = []
+    for mpd in mpds:
+        start = time.perf_counter()
+        found = detect_peaks(x, mpd=mpd, valley=True)
+        lines.append('n=%d mpd=%d: %d valleys in %.2f s' % (
+            n, mpd, found.size, time.perf_counter() - start))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import sys
+    print(benchmark(int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**7))
@@ -0,0 +1,285 @@
+"""Plots of a GraphicsLayoutWidget made once and reused on every run.
+
+plot_widget.clear() followed by addPlot() and plot() builds new PlotItems
+(view box, axes, menus) and curves each time an analysis is re-run, and
+every old one, with whatever was connected to it, is left to the garbage
+collector. A PlotGrid keeps them instead: plot(row, col) hands out the
+same PlotItem for the same cell and curve(plot, name, x, y) the same
+PlotDataItem for the same name, only the data changes (setData). Signals
+of the plots and curves can therefore be connected once, when they are
+made (the created callback), not on every run.
+
+    grid = PlotGrid(self.plot_widget)
+
+    grid.reset()
+    top = grid.plot(0, 0)
+    grid.curve(top, 'vm', time, vm, pen='b')
+    grid.finish()
+
+After reset(), whatever is not asked for again before finish() is taken
+out of the layout (plots) or emptied (curves), but kept for the next run.
+clear() does both at once, for windows that add plots one by one as the
+user asks for them, and remove(key) takes a single plot out, e.g. one the
+user hides.
+
+Markers that can run into the tens of thousands (detected events) go in a
+MarkerLayer rather than a symbol curve: one ScatterPlotItem with a single
+style, so every marker is blitted from the same cached pixmap, showing only
+the markers in the visible x range (at most one per pixel column when there
+are more than `limit`). Its markers are kept sorted by x, so insert() and
+remove() of one marker redraw only if it is in view, and only the markers
+in view. segments() draws many short pieces of trace (one per oscillation)
+as one NaN-separated curve per colour instead of one curve each. A long
+trace goes in an EnvelopeCurve, which draws the visible part of it from a
+labcommon.pyramid.MinMaxPyramid at about two points per pixel column.
+"""
+import itertools
+import numpy as np
+import pyqtgraph as pg
+
+
+class PlotGrid:
+    def __init__(self, widget):
+        self.widget = widget
+        # key -> PlotItem, key -> (row, col) of the ones in the layout now
+        self._plots = {}
+        self._shown = {}
+        # (plot, name) -> PlotDataItem, MarkerLayer or EnvelopeCurve
+        self._curves = {}
+        self._used_plots = set()
+        self._used_curves = set()
+
+    def reset(self):
+        """Starts a run, see the module docstring."""
+        self._used_plots = set()
+        self._used_curves = set()
+
+    def finish(self):
+        for key in list(set(self._shown) - self._used_plots):
+            self._take_out(key)
+        for key, curve in self._curves.items():
+            if key not in self._used_curves:
+                curve.clear()
+
+    def clear(self):
+        self.reset()
+        self.finish()
+
+    def _take_out(self, key):
+        self.widget.removeItem(self._plots[key])
+        del self._shown[key]
+
+    def remove(self, key):
+        """Takes the plot kept for key out of the layout now, rather than at
+        finish(), and returns the (row, col) it was at, None if it was not
+        shown. The plot and its curves are kept for the next run."""
+        cell = self._shown.get(key)
+        if cell is not None:
+            self._take_out(key)
+            self._used_plots.discard(key)
+        return cell
+
+    def plot(self, row, col=0, created=None, key=None, **kwargs):
+        """The PlotItem at row, col, made with kwargs the first time (and
+        passed to created then), without a title and auto-ranging on the new
+        data. A plot given a key (e.g. a navigator of fixed height) is kept
+        for that key rather than for its cell."""
+        key = (row, col) if key is None else key
+        plot = self._plots.get(key)
+        if plot is None:
+            plot = self._plots[key] = pg.PlotItem(**kwargs)
+            if created is not None:
+                created(plot)
+        if self._shown.get(key) != (row, col):
+            for other, cell in list(self._shown.items()):
+                if other == key or cell == (row, col):
+                    self._take_out(other)
+            self.widget.addItem(plot, row, col)
+            self._shown[key] = (row, col)
+        self._used_plots.add(key)
+        plot.setTitle(None)
+        plot.enableAutoRange()
+        return plot
+
+    def _item(self, plot, name, make, created):
+        key = (plot, name)
+        item = self._curves.get(key)
+        new = item is None
+        if new:
+            item = self._curves[key] = make()
+            if created is not None:
+                created(item)
+        self._used_curves.add(key)
+        return item, new
+
+    def curve(self, plot, name, x, y, created=None, **opts):
+        """Sets the data (and style opts) of the curve called name in plot,
+        made the first time."""
+        curve, new = self._item(plot, name, lambda: plot.plot(x, y, **opts),
+                                created)
+        if not new:
+            curve.setData(x, y, **opts)
+        return curve
+
+    def markers(self, plot, name, x, y, keys=None, created=None, **style):
+        """Sets the markers of the MarkerLayer called name in plot, made
+        with style the first time."""
+        layer, _ = self._item(plot, name, lambda: MarkerLayer(plot, **style),
+                              created)
+        layer.setData(x, y, keys)
+        return layer
+
+    def envelope(self, plot, name, pyramid, t0=0.0, dt=1.0, created=None,
+                 **opts):
+        """Sets the MinMaxPyramid drawn by the EnvelopeCurve called name in
+        plot, made with opts the first time."""
+        curve, _ = self._item(plot, name, lambda: EnvelopeCurve(plot, **opts),
+                              created)
+        curve.setData(pyramid, t0, dt)
+        return curve
+
+    def segments(self, plot, name, segments, pens, **opts):
+        """The (x, y) pieces in segments with the pens in turn, as one curve
+        per pen called name0, name1 ..."""
+        segments = list(segments)
+        pens = list(pens)
+        for i, pen in enumerate(pens):
+            parts = list(itertools.islice(segments, i, None, len(pens)))
+            x, y = _join(parts)
+            self.curve(plot, '%s%d' % (name, i), x, y, pen=pen,
+                       connect='finite', **opts)
+
+
+def _join(parts):
+    """x and y of (x, y) parts, with a NaN between consecutive parts."""
+    if not parts:
+        return np.empty(0), np.empty(0)
+    gap = np.array([np.nan])
+    xs, ys = [], []
+    for x, y in parts:
+        xs += [np.asarray(x, dtype='float64'), gap]
+        ys += [np.asarray(y, dtype='float64'), gap]
+    return np.concatenate(xs[:-1]), np.concatenate(ys[:-1])
+
+
+class MarkerLayer:
+    """Markers of one style in a plot, see the module docstring.
+
+    keys (e.g. sample indexes) name the markers for remove(); sigClicked is
+    that of the scatter item, (item, points)."""
+    def __init__(self, plot, symbol='o', size=7, pen='r', brush='r',
+                 limit=5000):
+        self.plot = plot
+        self.limit = limit
+        self.scatter = pg.ScatterPlotItem(symbol=symbol, size=size,
+                                          pen=pg.mkPen(pen),
+                                          brush=pg.mkBrush(brush),
+                                          pxMode=True)
+        plot.addItem(self.scatter)
+        self.sigClicked = self.scatter.sigClicked
+        self._x = np.empty(0)
+        self._y = np.empty(0)
+        self._keys = np.empty(0, dtype='int64')
+        self._shown = (0, 0)
+        plot.getViewBox().sigXRangeChanged.connect(self._range_changed)
+
+    def __len__(self):
+        return len(self._x)
+
+    def clear(self):
+        self.setData([], [])
+
+    def setData(self, x, y, keys=None):
+        x = np.asarray(x, dtype='float64')
+        order = np.argsort(x, kind='stable')
+        self._x = x[order]
+        self._y = np.asarray(y, dtype='float64')[order]
+        self._keys = (np.arange(len(x)) if keys is None else
+                      np.asarray(keys, dtype='int64'))[order]
+        self.redraw()
+
+    def insert(self, key, x, y):
+        i = np.searchsorted(self._x, x)
+        self._x = np.insert(self._x, i, x)
+        self._y = np.insert(self._y, i, y)
+        self._keys = np.insert(self._keys, i, key)
+        if self._in_view(x):
+            self.redraw()
+
+    def remove(self, key):
+        found = np.flatnonzero(self._keys == key)
+        if not len(found):
+            return
+        x = self._x[found[0]]
+        self._x = np.delete(self._x, found)
+        self._y = np.delete(self._y, found)
+        self._keys = np.delete(self._keys, found)
+        if self._in_view(x):
+            self.redraw()
+
+    def _in_view(self, x):
+        x0, x1 = self.plot.getViewBox().viewRange()[0]
+        return x0 <= x <= x1
+
+    def _range_changed(self, *_):
+        self.redraw(only_if_changed=True)
+
+    def redraw(self, only_if_changed=False):
+        vb = self.plot.getViewBox()
+        x0, x1 = vb.viewRange()[0]
+        i0 = int(np.searchsorted(self._x, x0, side='left'))
+        i1 = int(np.searchsorted(self._x, x1, side='right'))
+        if only_if_changed and (i0, i1) == self._shown and \
+                i1 - i0 <= self.limit:
+            return
+        self._shown = (i0, i1)
+        x = self._x[i0:i1]
+        y = self._y[i0:i1]
+        if len(x) > self.limit:
+            # one marker per pixel column, they would overlap anyway
+            width = max(vb.width(), 1.0)
+            columns = ((x - x0) * (width / max(x1 - x0, 1e-12))).astype('int64')
+            _, first = np.unique(columns, return_index=True)
+            x, y = x[first], y[first]
+        self.scatter.setData(x=x, y=y)
+
+
+class EnvelopeCurve:
+    """A trace drawn from its MinMaxPyramid: the samples in the visible x
+    range, or their min/max envelope when there are more than two per pixel
+    column, redrawn as the view moves. Sample i is at t0 + i*dt. The first
+    and last sample times are always in the data (with NaN values, so not
+    drawn) for auto-range to cover the whole trace."""
+    def __init__(self, plot, **opts):
+        self.plot = plot
+        self.curve = plot.plot([], [], connect='finite', **opts)
+        self.pyramid = None
+        self.t0 = 0.0
+        self.dt = 1.0
+        plot.getViewBox().sigXRangeChanged.connect(self.redraw)
+
+    def setData(self, pyramid, t0=0.0, dt=1.0):
+        self.pyramid = pyramid
+        self.t0 = t0
+        self.dt = dt
+        self.redraw()
+
+    def clear(self):
+        self.pyramid = None
+        self.curve.clear()
+
+    def redraw(self, *_):
+        if self.pyramid is None:
+            return
+        n = len(self.pyramid)
+        if not n:
+            self.curve.clear()
+            return
+        vb = self.plot.getViewBox()
+        x0, x1 = vb.viewRange()[0]
+        i0 = int(np.floor((x0 - self.t0) / self.dt))
+        i1 = int(np.ceil((x1 - self.t0) / self.dt)) + 1
+        x, y = self.pyramid.view(i0, i1, 2 * max(int(vb.width()), 500))
+        x = np.concatenate(([0], x, [n - 1]))
+        y = np.concatenate(([np.nan], y, [np.nan]))
+        self.curve.setData(self.t0 + x * self.dt, y)
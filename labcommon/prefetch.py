@@ -0,0 +1,100 @@
+"""Reading ahead: the next files load on I/O threads while the current ones
+are analysed.
+
+A Prefetcher runs load(*args) on `depth` threads for the items put() into
+it, and hands the finished loads back through take(). It never holds more
+than `depth` items that have been put but not taken: put() is only allowed
+while room() > 0, so a producer that gets ahead of the analysis waits
+instead of filling memory with decoded files. Reading and decoding
+(read_abf, import_folder, numpy) release the GIL for most of their time, so
+the loads overlap with the analysis even in the same process.
+
+imap() is the same for a simple loop:
+
+    for path, data in prefetch.imap(load, paths, depth=2):
+        analyse(data)
+"""
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class Prefetcher:
+    def __init__(self, load, depth=2):
+        if depth < 1:
+            raise ValueError('Prefetch depth must be at least 1')
+        self.load = load
+        self.depth = depth
+        self._pool = ThreadPoolExecutor(depth, thread_name_prefix='prefetch')
+        # future -> tag, in the order put
+        self._loads = OrderedDict()
+
+    def __len__(self):
+        return len(self._loads)
+
+    def room(self):
+        return self.depth - len(self._loads)
+
+    def put(self, tag, *args):
+        if self.room() <= 0:
+            raise RuntimeError('Prefetcher is full, take() a load first')
+        self._loads[self._pool.submit(self.load, *args)] = tag
+
+    @property
+    def futures(self):
+        return list(self._loads)
+
+    def take(self, n=None, ordered=False):
+        """Up to n finished loads as (tag, future), oldest first. With ordered
+        nothing is taken past a load that is still running."""
+        taken = []
+        for future in list(self._loads):
+            if n is not None and len(taken) >= n:
+                break
+            if not future.done():
+                if ordered:
+                    break
+                continue
+            taken.append((self._loads.pop(future), future))
+        return taken
+
+    def wait(self, timeout=None):
+        """Blocks until a load finishes (or timeout)."""
+        if self._loads:
+            wait(self._loads, timeout=timeout, return_when=FIRST_COMPLETED)
+
+    def close(self):
+        """Cancels the loads not started, waits for the running ones and
+        returns (tag, future) of every load not taken, so their results can
+        be cleaned up."""
+        left = [(tag, future) for future, tag in self._loads.items()]
+        for future in self._loads:
+            future.cancel()
+        self._loads = OrderedDict()
+        self._pool.shutdown(wait=True)
+        return left
+
+
+def imap(load, items, depth=2):
+    """(item, load(item)) for every item in order, loading up to depth items
+    ahead of the one being used. An exception of load is raised when its
+    item is reached."""
+    prefetcher = Prefetcher(load, depth)
+    items = iter(items)
+    end = object()
+
+    def fill():
+        while prefetcher.room() > 0:
+            item = next(items, end)
+            if item is end:
+                return
+            prefetcher.put(item, item)
+
+    try:
+        fill()
+        while len(prefetcher):
+            wait(prefetcher.futures[:1])
+            item, future = prefetcher.take(1, ordered=True)[0]
+            fill()
+            yield item, future.result()
+    finally:
+        prefetcher.close()
@@ -0,0 +1,91 @@
+"""Qt front end for labcommon.profiling: a tool window with per-stage
+totals, the last run's breakdown and trace export, opened with Ctrl+Shift+P
+in every app."""
+from PyQt5 import QtCore, QtGui, QtWidgets
+from labcommon.profiling import profiler
+
+
+HEADERS = ['Stage', 'Calls', 'Total (s)', 'Mean (ms)', 'Max (ms)',
+           'Peak (MB)']
+
+
+class ProfileWindow(QtWidgets.QWidget):
+    def __init__(self, parent=None):
+        super().__init__(parent, QtCore.Qt.Tool)
+        self.setWindowTitle('Profiling')
+        self.resize(560, 400)
+        layout = QtWidgets.QVBoxLayout(self)
+
+        options_layout = QtWidgets.QHBoxLayout()
+        self.enable_checkbox = QtWidgets.QCheckBox('Record stages')
+        self.enable_checkbox.setChecked(profiler.enabled)
+        self.enable_checkbox.toggled.connect(self.set_enabled)
+        self.memory_checkbox = QtWidgets.QCheckBox('Track allocations (slower)')
+        self.memory_checkbox.setChecked(profiler.track_memory)
+        self.memory_checkbox.toggled.connect(self.set_track_memory)
+        options_layout.addWidget(self.enable_checkbox)
+        options_layout.addWidget(self.memory_checkbox)
+
+        self.last_label = QtWidgets.QLabel('')
+        self.last_label.setWordWrap(True)
+
+        self.table = QtWidgets.QTableWidget()
+        self.table.setColumnCount(len(HEADERS))
+        self.table.setHorizontalHeaderLabels(HEADERS)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        header = self.table.horizontalHeader()
+        header.setSectionResizeMode(0, QtWidgets.QHeaderView.Stretch)
+
+        buttons_layout = QtWidgets.QHBoxLayout()
+        reset_btn = QtWidgets.QPushButton('Reset')
+        reset_btn.clicked.connect(self.reset)
+        dump_btn = QtWidgets.QPushButton('Save trace')
+        dump_btn.clicked.connect(self.save_trace)
+        buttons_layout.addWidget(reset_btn)
+        buttons_layout.addWidget(dump_btn)
+
+        layout.addLayout(options_layout)
+        layout.addWidget(self.last_label)
+        layout.addWidget(self.table)
+        layout.addLayout(buttons_layout)
+
+        profiler.listeners.append(self.refresh)
+        self.refresh(profiler)
+
+    def set_enabled(self, checked):
+        if checked:
+            profiler.enable()
+        else:
+            profiler.disable()
+
+    def set_track_memory(self, checked):
+        profiler.track_memory = checked
+
+    def reset(self):
+        profiler.reset()
+        self.refresh(profiler)
+
+    def refresh(self, prof):
+        self.last_label.setText(prof.summary())
+        self.table.setRowCount(0)
+        for i, (name, stats) in enumerate(prof.stats.items()):
+            self.table.insertRow(i)
+            row = [name, '%d' % stats.count, '%0.3f' % stats.total,
+                   '%0.2f' % (stats.mean * 1e3), '%0.2f' % (stats.max * 1e3),
+                   '%0.2f' % (stats.peak / 2**20)]
+            for j, val in enumerate(row):
+                self.table.setItem(i, j, QtWidgets.QTableWidgetItem(val))
+
+    def save_trace(self):
+        path = QtWidgets.QFileDialog.getSaveFileName(self, 'Save trace', '',
+                                                     'Trace (*.json)')[0]
+        if any(path):
+            profiler.dump(path)
+
+
+def install(widget):
+    """Adds the Ctrl+Shift+P shortcut that opens the profiling window."""
+    window = ProfileWindow(widget)
+    shortcut = QtWidgets.QShortcut(QtGui.QKeySequence('Ctrl+Shift+P'), widget)
+    shortcut.activated.connect(window.show)
+    return window
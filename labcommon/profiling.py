@@ -0,0 +1,180 @@
+"""Opt-in per-stage timing for the analysis apps.
+
+    with profiler.stage('run_detection'):
+        with profiler.stage('smoothing'):
+            ...
+
+While the profiler is disabled (the default) stage() returns a shared no-op
+context manager. Once enabled, every stage records wall time, call count
+and, with track_memory, the peak of traced allocations while it ran. Memory
+tracking uses tracemalloc, which slows the profiled code down noticeably, so
+it can be switched off separately. Runs can be dumped as Chrome trace-event
+JSON (chrome://tracing or Perfetto) to compare them offline.
+
+Setting LAB_APPS_PROFILE=1 enables the profiler at start-up, and
+LAB_APPS_PROFILE=time enables it without memory tracking; 0 leaves it off.
+"""
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+
+ENV_VAR = 'LAB_APPS_PROFILE'
+MAX_EVENTS = 100000
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class StageStats:
+    __slots__ = ('count', 'total', 'max', 'peak')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.peak = 0
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class Profiler:
+    def __init__(self, enabled=False, track_memory=True):
+        self.enabled = enabled
+        self.track_memory = track_memory
+        self.stats = OrderedDict()
+        self.events = deque(maxlen=MAX_EVENTS)
+        # (name, depth, seconds, peak bytes) of the last top-level stage
+        self.last_run = []
+        self.listeners = []
+        self._stack = []
+        self._current = []
+        self._t0 = time.perf_counter()
+        self._own_tracemalloc = False
+
+    def enable(self, track_memory=None):
+        if track_memory is not None:
+            self.track_memory = track_memory
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        if self._own_tracemalloc and not self._stack:
+            tracemalloc.stop()
+            self._own_tracemalloc = False
+
+    def reset(self):
+        self.stats.clear()
+        self.events.clear()
+        self.last_run = []
+
+    def stage(self, name):
+        # stages nest through a single stack, so only the GUI thread records
+        if (not self.enabled or
+                threading.current_thread() is not threading.main_thread()):
+            return _NULL_STAGE
+        return self._record(name)
+
+    @contextmanager
+    def _record(self, name):
+        memory = self.track_memory
+        frame = {'base': 0, 'peak': 0}
+        if memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._own_tracemalloc = True
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                # the enclosing stage's peak so far, before it is reset
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            if hasattr(tracemalloc, 'reset_peak'):
+                # before 3.9 peaks are the high-water mark since tracing began
+                tracemalloc.reset_peak()
+            frame['base'] = current
+        self._stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._stack.pop()
+            peak_bytes = 0
+            if memory and tracemalloc.is_tracing():
+                frame['peak'] = max(frame['peak'],
+                                    tracemalloc.get_traced_memory()[1])
+                peak_bytes = max(frame['peak'] - frame['base'], 0)
+                if self._stack:
+                    self._stack[-1]['peak'] = max(self._stack[-1]['peak'],
+                                                  frame['peak'])
+            self._add(name, len(self._stack), start, elapsed, peak_bytes)
+
+    def _add(self, name, depth, start, elapsed, peak_bytes):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = StageStats()
+        stats.count += 1
+        stats.total += elapsed
+        stats.max = max(stats.max, elapsed)
+        stats.peak = max(stats.peak, peak_bytes)
+
+        self.events.append({'name': name, 'ph': 'X', 'pid': os.getpid(),
+                            'tid': 0, 'ts': (start - self._t0) * 1e6,
+                            'dur': elapsed * 1e6,
+                            'args': {'peak_bytes': peak_bytes}})
+        # stages finish innermost first, keep them in start order
+        self._current.append((start, name, depth, elapsed, peak_bytes))
+        if depth == 0:
+            self.last_run = [row[1:] for row in sorted(self._current)]
+            self._current = []
+            for listener in list(self.listeners):
+                listener(self)
+
+    def summary(self):
+        """One line for a status bar: the last run and its direct stages."""
+        if not self.last_run:
+            return ''
+        name, _, elapsed, _ = self.last_run[0]
+        parts = ['%s %0.3f s' % (name, elapsed)]
+        parts += ['%s %0.1f ms' % (stage, secs * 1e3)
+                  for stage, depth, secs, _ in self.last_run[1:] if depth == 1]
+        return ' | '.join(parts)
+
+    def report(self):
+        lines = ['%-24s %6s %10s %10s %10s %10s' % ('stage', 'calls',
+                                                    'total (s)', 'mean (ms)',
+                                                    'max (ms)', 'peak (MB)')]
+        for name, stats in self.stats.items():
+            lines.append('%-24s %6d %10.3f %10.2f %10.2f %10.2f' % (
+                name, stats.count, stats.total, stats.mean * 1e3,
+                stats.max * 1e3, stats.peak / 2**20))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        stats = OrderedDict((name, {'count': s.count, 'total_s': s.total,
+                                    'max_s': s.max, 'peak_bytes': s.peak})
+                            for name, s in self.stats.items())
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': list(self.events),
+                       'displayTimeUnit': 'ms',
+                       'stats': stats}, f)
+
+
+profiler = Profiler()
+_MODE = os.environ.get(ENV_VAR, '').strip().lower()
+# off for '' and '0', like LAB_APPS_NO_CACHE
+if _MODE not in ('', '0'):
+    profiler.enable(track_memory=_MODE != 'time')
@@ -0,0 +1,76 @@
+"""Min/max pyramid of a long trace, for drawing any part of it at screen
+resolution.
+
+Level 0 holds the minimum and maximum of every BLOCK samples, each level
+above it those of FACTOR blocks of the level below, up to a few hundred
+blocks for the whole trace. Together the levels take a sixth of the memory
+of the trace and are built in one pass over it. view(i0, i1, points) picks
+the finest level that draws samples i0 to i1 in no more than `points`
+points (the samples themselves when they fit), so the cost of drawing
+depends on the width of the plot, not on the length of the recording. The
+envelope keeps every peak: an event narrower than a pixel still shows.
+"""
+import numpy as np
+
+
+BLOCK = 16
+FACTOR = 4
+TOP = 256
+
+
+def _reduce(mins, maxs, size):
+    starts = np.arange(0, len(mins), size)
+    return np.fmin.reduceat(mins, starts), np.fmax.reduceat(maxs, starts)
+
+
+class MinMaxPyramid:
+    def __init__(self, values, block=BLOCK, factor=FACTOR):
+        self.values = np.asarray(values)
+        # (samples per block, mins, maxs), finest first
+        self.levels = []
+        size = block
+        mins, maxs = self.values, self.values
+        step = block
+        while len(mins) > TOP or not self.levels:
+            if len(mins) == 0:
+                break
+            mins, maxs = _reduce(mins, maxs, step)
+            self.levels.append((size, mins, maxs))
+            size *= factor
+            step = factor
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        return sum(mins.nbytes + maxs.nbytes for _, mins, maxs in self.levels)
+
+    def range(self):
+        """Minimum and maximum of the whole trace."""
+        if not len(self.values):
+            return np.nan, np.nan
+        _, mins, maxs = self.levels[-1]
+        return np.nanmin(mins), np.nanmax(maxs)
+
+    def view(self, i0, i1, points):
+        """(x, y) drawing samples i0 to i1 in at most about `points` points,
+        x in samples: the samples or, per block, its minimum and maximum."""
+        i0 = max(int(i0), 0)
+        i1 = min(int(i1), len(self.values))
+        if i1 <= i0:
+            return np.empty(0), np.empty(0)
+        if i1 - i0 <= points:
+            return np.arange(i0, i1, dtype='float64'), self.values[i0:i1]
+        for size, mins, maxs in self.levels:
+            if 2 * (i1 - i0) / size <= points:
+                break
+        b0, b1 = i0 // size, -(-i1 // size)
+        starts = np.arange(b0, b1, dtype='float64') * size
+        x = np.empty(2 * (b1 - b0))
+        y = np.empty(2 * (b1 - b0), dtype=mins.dtype)
+        x[0::2] = starts
+        x[1::2] = starts + size / 2
+        y[0::2] = mins[b0:b1]
+        y[1::2] = maxs[b0:b1]
+        return x, y
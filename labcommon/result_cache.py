@@ -0,0 +1,123 @@
+"""Analysis results kept on disk, keyed by their input data and parameters.
+
+A key is a hash of the task name, the exact parameters and a fingerprint of
+the input arrays: their dtype, shape and 64 evenly spaced 4 kB samples of
+their bytes (all of them for small arrays). Fingerprinting a sweep is
+therefore about as cheap as reading its length, at the price of missing a
+change that falls entirely between samples; data as recorded is never edited
+in place, so in practice any re-export or different file shows up.
+
+Entries are pickled into one file each under ~/.lab_apps/result_cache. A hit
+touches the file, and after every put the least recently used files are
+removed until the directory is back under its budget (1 GB, or
+LAB_APPS_CACHE_MB). Setting bypass makes get() miss while put() still stores
+the fresh result; LAB_APPS_NO_CACHE=1 turns the cache off altogether. Like
+the Fmax calibrations, a cached result is only ever a shortcut, so disk
+errors are treated as misses.
+"""
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import numpy as np
+
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.lab_apps',
+                            'result_cache')
+DEFAULT_BUDGET = int(float(os.environ.get('LAB_APPS_CACHE_MB', 1024)) * 2**20)
+
+# bump when an analysis changes what it returns for the same input
+VERSION = 1
+
+SAMPLES = 64
+CHUNK = 4096
+
+
+def fingerprint(arrays):
+    """Cheap hash of numeric arrays, see the module docstring."""
+    digest = hashlib.blake2b(digest_size=20)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(('%s %s\n' % (array.dtype.str, array.shape)).encode())
+        raw = array.reshape(-1).view(np.uint8)
+        if raw.nbytes <= SAMPLES * CHUNK:
+            digest.update(raw)
+            continue
+        for start in np.linspace(0, raw.nbytes - CHUNK, SAMPLES).astype('int64'):
+            digest.update(raw[start:start+CHUNK])
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, path=DEFAULT_PATH, budget=DEFAULT_BUDGET):
+        self.path = path
+        self.budget = budget
+        self.enabled = os.environ.get('LAB_APPS_NO_CACHE', '') in ('', '0')
+        self.bypass = False
+
+    def key(self, task, arrays, params):
+        text = json.dumps([VERSION, task, fingerprint(arrays), params],
+                          sort_keys=True, default=str)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def get(self, key):
+        if not self.enabled or self.bypass:
+            return None
+        path = self._file(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError,
+                ImportError):
+            # unreadable or written by other code, drop it
+            self._remove(path)
+            return None
+        return value
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._file(key))
+        except OSError:
+            return
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries beyond the budget."""
+        try:
+            entries = [(e.stat().st_mtime, e.stat().st_size, e.path)
+                       for e in os.scandir(self.path)
+                       if e.name.endswith('.pkl')]
+        except OSError:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.budget:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        try:
+            for entry in os.scandir(self.path):
+                self._remove(entry.path)
+        except OSError:
+            pass
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,283 @@
+"""Results of all four apps in one local SQLite database.
+
+Every store() is one run: the result table of one app for one file (or the
+folders analysed together) with one set of parameters. Runs are keyed on the
+app, the file and a hash of the parameters, and belong to a cell, by default
+the folder the file is in. The rows go into a typed table per app, bulk
+inserted in a single transaction:
+
+    mini_events      pyminis, one row per event
+    ca_oscillations  ca, one row per oscillation
+    bap_fits         baps, one row per averaged fit
+    atype_steps      atype, one row per voltage step
+
+Storing the same file with the same parameters again replaces the rows of
+the run, or only those of the sweeps given, so re-detecting one sweep leaves
+the others in place (and a sweep that no longer has any events is emptied).
+The count and sum of every column of a run are kept up to date in run_stats
+as it is stored, so summary() across cells reads a few rows per file instead
+of every event. Anything else goes through query():
+
+    db = ResultsDB()
+    db.summary('pyminis')
+    db.query('SELECT cell, COUNT(*) FROM mini_events JOIN runs '
+             'ON runs.id = run_id GROUP BY cell')
+
+or from the command line, python -m labcommon.results summary pyminis.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.lab_apps',
+                            'results.sqlite')
+
+# what store() raises when the database cannot be opened or written
+ERRORS = (sqlite3.Error, OSError)
+
+# app -> (table, [(result column, SQL column)])
+TABLES = OrderedDict([
+    ('pyminis', ('mini_events', [('Time (s)', 'time'),
+                                 ('Amplitude (pA)', 'amplitude'),
+                                 ('Rise 10-90 (ms)', 'rise'),
+                                 ('Half-width (ms)', 'half_width'),
+                                 ('Decay tau (ms)', 'decay_tau'),
+                                 ('Charge (fC)', 'charge')])),
+    ('ca', ('ca_oscillations', [('Average Area', 'average_area'),
+                                ('Total Area', 'total_area'),
+                                ('Peak', 'peak'),
+                                ('Baseline', 'baseline'),
+                                ('Average', 'average')])),
+    ('baps', ('bap_fits', [('Peak', 'peak'), ('Total Area', 'total_area'),
+                           ('Average Area', 'average_area'), ('a', 'a'),
+                           ('b', 'b'), ('c', 'c'), ('d', 'd')])),
+    ('atype', ('atype_steps', [('Steps', 'step'), ('I (pA)', 'current'),
+                               ('g', 'conductance'), ('tau (ms)', 'tau')])),
+])
+
+RUNS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    app TEXT NOT NULL,
+    cell TEXT NOT NULL,
+    file TEXT NOT NULL,
+    param_hash TEXT NOT NULL,
+    params TEXT NOT NULL,
+    created REAL NOT NULL,
+    rows INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (app, file, param_hash)
+);
+CREATE INDEX IF NOT EXISTS runs_cell ON runs (app, cell);
+CREATE INDEX IF NOT EXISTS runs_params ON runs (param_hash);
+CREATE TABLE IF NOT EXISTS run_stats (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    name TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    total REAL NOT NULL,
+    PRIMARY KEY (run_id, name)
+);
+"""
+
+TABLE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {table} (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    sweep TEXT,
+    row INTEGER NOT NULL,
+    {columns}
+);
+CREATE INDEX IF NOT EXISTS {table}_run ON {table} (run_id, sweep);
+"""
+
+
+def param_hash(params):
+    text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def default_cell(file):
+    """The folder the file is in, or the first of several files."""
+    first = file.split(os.pathsep)[0]
+    return os.path.basename(os.path.dirname(os.path.abspath(first)))
+
+
+class ResultsDB:
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            if self.path != ':memory:':
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                            exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(RUNS_SCHEMA)
+            for table, columns in TABLES.values():
+                conn.executescript(TABLE_SCHEMA.format(
+                    table=table, columns=',\n    '.join(
+                        '%s REAL' % name for _, name in columns)))
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def store(self, app, file, params, df, cell=None, sweeps=None):
+        """Writes the result table df of one run and returns the run id.
+
+        file is a path, or several joined with os.pathsep; df has the
+        columns the app copies to the clipboard, and 'Sweep' if the rows
+        come from different sweeps. sweeps are the names of the sweeps df
+        stands for, whether or not they have rows: only their old rows are
+        replaced. None replaces every row of the run."""
+        table, columns = TABLES[app]
+        if not isinstance(file, str):
+            file = os.pathsep.join(file)
+        if cell is None:
+            cell = default_cell(file)
+        digest = param_hash(params)
+
+        row_sweeps = (df['Sweep'].astype(str).tolist() if 'Sweep' in df.columns
+                      else [None] * len(df))
+        # SQLite stores NaN as NULL
+        values = [df[col].astype('float64').tolist() if col in df.columns
+                  else [None] * len(df) for col, _ in columns]
+
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO runs (app, cell, file, param_hash, '
+                'params, created) VALUES (?, ?, ?, ?, ?, ?)',
+                (app, cell, file, digest, json.dumps(params, sort_keys=True,
+                                                      default=str),
+                 time.time()))
+            run_id = conn.execute(
+                'SELECT id FROM runs WHERE app = ? AND file = ? AND '
+                'param_hash = ?', (app, file, digest)).fetchone()[0]
+            conn.execute('UPDATE runs SET cell = ?, created = ? WHERE id = ?',
+                         (cell, time.time(), run_id))
+
+            if sweeps is not None:
+                conn.executemany(
+                    'DELETE FROM %s WHERE run_id = ? AND sweep = ?' % table,
+                    [(run_id, sweep) for sweep in set(map(str, sweeps)) |
+                     set(row_sweeps) - {None}])
+            else:
+                conn.execute('DELETE FROM %s WHERE run_id = ?' % table,
+                             (run_id,))
+            names = ['run_id', 'sweep', 'row'] + [name for _, name in columns]
+            conn.executemany(
+                'INSERT INTO %s (%s) VALUES (%s)' % (
+                    table, ', '.join(names), ', '.join('?' * len(names))),
+                ((run_id, sweep, i) + row for i, (sweep, row) in
+                 enumerate(zip(row_sweeps, zip(*values)))))
+            self._update_stats(conn, run_id, table, columns)
+        return run_id
+
+    def _update_stats(self, conn, run_id, table, columns):
+        names = [name for _, name in columns]
+        row = conn.execute('SELECT COUNT(*), %s FROM %s WHERE run_id = ?' % (
+            ', '.join('COUNT(%s), TOTAL(%s)' % (name, name) for name in names),
+            table), (run_id,)).fetchone()
+        conn.execute('UPDATE runs SET rows = ? WHERE id = ?', (row[0], run_id))
+        conn.executemany(
+            'INSERT OR REPLACE INTO run_stats (run_id, name, n, total) '
+            'VALUES (?, ?, ?, ?)',
+            [(run_id, name, row[1+2*i], row[2+2*i])
+             for i, name in enumerate(names)])
+
+    def query(self, sql, args=()):
+        """A DataFrame of any SELECT over runs and the result tables."""
+        import pandas as pd
+        return pd.read_sql_query(sql, self._connect(), params=args)
+
+    def frame(self, app, cell=None):
+        """The stored rows of one app with their run's cell and file, under
+        the app's own column names."""
+        table, columns = TABLES[app]
+        sql = ('SELECT cell AS Cell, file AS File, param_hash AS Params, '
+               'sweep AS Sweep, %s FROM %s JOIN runs ON runs.id = run_id' % (
+                   ', '.join('%s AS "%s"' % (name, col)
+                             for col, name in columns), table))
+        args = ()
+        if cell is not None:
+            sql += ' WHERE cell = ?'
+            args = (cell,)
+        return self.query(sql + ' ORDER BY run_id, row', args)
+
+    def summary(self, app, param=None):
+        """Rows, files and the mean of every value per cell (and parameter
+        set), optionally only for runs with the given parameter hash."""
+        table, columns = TABLES[app]
+        means = ', '.join(
+            'SUM(CASE name WHEN \'%s\' THEN total END) / '
+            'SUM(CASE name WHEN \'%s\' THEN n END) AS "%s"' % (name, name, col)
+            for col, name in columns)
+        sql = ('SELECT cell AS Cell, param_hash AS Params, '
+               'COUNT(DISTINCT runs.id) AS Files, '
+               'SUM(CASE WHEN name = \'%s\' THEN rows END) AS Rows, %s '
+               'FROM runs JOIN run_stats ON run_id = runs.id WHERE app = ?' % (
+                   columns[0][1], means))
+        args = (app,)
+        if param is not None:
+            sql += ' AND param_hash LIKE ?'
+            args += (param + '%',)
+        return self.query(sql + ' GROUP BY cell, param_hash ORDER BY cell',
+                          args)
+
+
+def save(app, file, params, df, path=DEFAULT_PATH, sweeps=None):
+    """Stores one run from an app window, without keeping the database
+    open between saves."""
+    db = ResultsDB(path)
+    try:
+        return db.store(app, file, params, df, sweeps=sweeps)
+    finally:
+        db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--db', default=DEFAULT_PATH)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    summary_parser = commands.add_parser('summary')
+    summary_parser.add_argument('app', choices=list(TABLES))
+    summary_parser.add_argument('--params', help='parameter hash (prefix)')
+
+    export_parser = commands.add_parser('export')
+    export_parser.add_argument('app', choices=list(TABLES))
+    export_parser.add_argument('output')
+    export_parser.add_argument('--cell')
+
+    query_parser = commands.add_parser('query')
+    query_parser.add_argument('sql')
+    args = parser.parse_args(argv)
+
+    db = ResultsDB(args.db)
+    try:
+        if args.command == 'summary':
+            print(db.summary(args.app, args.params).to_string(index=False))
+        elif args.command == 'export':
+            df = db.frame(args.app, args.cell)
+            df.to_csv(args.output, index=False)
+            print('%d row(s) written to %s' % (len(df), args.output))
+        elif args.command == 'query':
+            print(db.query(args.sql).to_string(index=False))
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
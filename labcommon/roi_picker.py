@@ -0,0 +1,51 @@
+"""Dialog for choosing a linescan ROI on the time-averaged scan line."""
+from PyQt5 import QtWidgets
+import pyqtgraph as pg
+
+
+COLORS = ['r', 'g', 'b', 'm']
+
+
+class RoiPicker(QtWidgets.QDialog):
+    def __init__(self, images, roi=None, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Pick linescan ROI')
+        self.resize(700, 400)
+        layout = QtWidgets.QVBoxLayout(self)
+
+        plot_widget = pg.PlotWidget()
+        plot = plot_widget.getPlotItem()
+        plot.setLabel('bottom', 'Pixel')
+        plot.addLegend()
+        for i, channel in enumerate(images.channels):
+            plot.plot(images.mean_line(channel), pen=COLORS[i % len(COLORS)],
+                      name='Ch %d' % channel)
+
+        if roi:
+            start, stop = roi[0][0], roi[-1][1]
+        else:
+            start, stop = images.n_pixels // 3, 2 * images.n_pixels // 3
+        self.region = pg.LinearRegionItem([start, stop],
+                                          bounds=[0, images.n_pixels])
+        plot.addItem(self.region)
+
+        buttons = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Ok |
+                                             QtWidgets.QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+
+        layout.addWidget(plot_widget)
+        layout.addWidget(buttons)
+
+    def roi_text(self):
+        start, stop = self.region.getRegion()
+        return '%d-%d' % (int(round(start)), int(round(stop)))
+
+
+def pick_roi(parent, images, roi=None):
+    """The ROI text ('start-stop') chosen by the user, or None if
+    cancelled."""
+    dialog = RoiPicker(images, roi, parent)
+    if dialog.exec_():
+        return dialog.roi_text()
+    return None
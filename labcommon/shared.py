@@ -0,0 +1,181 @@
+"""Data handed to worker processes through shared memory instead of pickles.
+
+share(obj) copies every numeric array in obj - ndarrays, DataFrame columns
+and index codes, nested in dicts, lists and tuples, such as the output of a
+batch module's load() - into one shared memory block, and keeps the rest
+(sweep names, parameters) as a small skeleton. Its picklable `ref` is all
+that goes to a worker, where call(function, ref, ...) attaches the block and
+rebuilds obj around read-only views of it, without copying the data:
+
+    block = shared.share(batch.load(paths, params))
+    future = pool.submit(shared.call, batch.compute, block.ref, params)
+    future.add_done_callback(block.release)
+
+The block is reference counted: share() holds one reference, acquire() adds
+one per extra user and the last release() unlinks it. release accepts and
+ignores an argument so it can be a done callback, which is how the block
+outlives a cancelled or crashed task.
+
+Results must not keep views of the shared data (they are copied back to the
+parent anyway); the worker unmaps the block when the function returns.
+"""
+import gc
+import sys
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+
+ALIGN = 64
+
+# before 3.13 every attach registers the block with the resource tracker,
+# which is shared with the parent; the parent's unlink clears it
+_ATTACH = {'track': False} if sys.version_info >= (3, 13) else {}
+
+
+def _shareable(array):
+    return (isinstance(array, np.ndarray) and array.dtype.kind in 'biufcmM'
+            and array.nbytes > 0)
+
+
+class _Packer:
+    def __init__(self):
+        self.arrays = []
+        self.size = 0
+
+    def array(self, array):
+        array = np.ascontiguousarray(array)
+        offset = self.size
+        self.arrays.append((offset, array))
+        self.size += -(-array.nbytes // ALIGN) * ALIGN
+        return ('array', offset, array.dtype.str, array.shape)
+
+    def index(self, index):
+        if isinstance(index, pd.MultiIndex):
+            return ('multiindex', list(index.levels),
+                    [self.pack(np.asarray(codes)) for codes in index.codes],
+                    list(index.names))
+        if isinstance(index, pd.RangeIndex) or not _shareable(index.values):
+            return ('value', index)
+        return ('index', self.array(index.values), index.name)
+
+    def pack(self, obj):
+        if _shareable(obj):
+            return self.array(obj)
+        if isinstance(obj, pd.DataFrame):
+            columns = list(obj.columns)
+            return ('frame', columns, [self.pack(obj[col].values)
+                                       for col in columns],
+                    self.index(obj.index))
+        if isinstance(obj, pd.Series):
+            return ('series', self.pack(obj.values), self.index(obj.index),
+                    obj.name)
+        if isinstance(obj, dict):
+            return ('dict', type(obj), [(key, self.pack(val))
+                                        for key, val in obj.items()])
+        if isinstance(obj, (list, tuple)) and type(obj) in (list, tuple):
+            return (type(obj).__name__, [self.pack(val) for val in obj])
+        return ('value', obj)
+
+
+def _rebuild(skeleton, buf):
+    kind = skeleton[0]
+    if kind == 'array':
+        _, offset, dtype, shape = skeleton
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape, dtype='int64'))
+        array = np.frombuffer(buf, dtype, count, offset).reshape(shape)
+        array.flags.writeable = False
+        return array
+    if kind == 'value':
+        return skeleton[1]
+    if kind == 'index':
+        return pd.Index(_rebuild(skeleton[1], buf), name=skeleton[2], copy=False)
+    if kind == 'multiindex':
+        return pd.MultiIndex(levels=skeleton[1],
+                             codes=[_rebuild(codes, buf) for codes in skeleton[2]],
+                             names=skeleton[3], verify_integrity=False)
+    if kind == 'frame':
+        _, columns, values, index = skeleton
+        return pd.DataFrame(dict(zip(columns, (_rebuild(v, buf) for v in values))),
+                            index=_rebuild(index, buf), columns=columns,
+                            copy=False)
+    if kind == 'series':
+        return pd.Series(_rebuild(skeleton[1], buf), index=_rebuild(skeleton[2], buf),
+                         name=skeleton[3], copy=False)
+    if kind == 'dict':
+        return skeleton[1]((key, _rebuild(val, buf)) for key, val in skeleton[2])
+    if kind == 'list':
+        return [_rebuild(val, buf) for val in skeleton[1]]
+    if kind == 'tuple':
+        return tuple(_rebuild(val, buf) for val in skeleton[1])
+    raise ValueError('Unknown shared data %r' % kind)
+
+
+class SharedData:
+    """One block in the parent, see share()."""
+    def __init__(self, obj):
+        packer = _Packer()
+        skeleton = packer.pack(obj)
+        self.nbytes = packer.size
+        self._shm = shared_memory.SharedMemory(create=True,
+                                               size=max(packer.size, 1))
+        for offset, array in packer.arrays:
+            view = np.ndarray(array.shape, array.dtype, self._shm.buf, offset)
+            view[...] = array
+            del view
+        self.ref = (self._shm.name, skeleton)
+        self._refs = 1
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._refs == 0:
+                raise ValueError('Shared data already released')
+            self._refs += 1
+        return self
+
+    def release(self, *_):
+        with self._lock:
+            if self._refs == 0:
+                return
+            self._refs -= 1
+            if self._refs > 0:
+                return
+        self._shm.close()
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    @property
+    def released(self):
+        return self._refs == 0
+
+
+def share(obj):
+    return SharedData(obj)
+
+
+def call(function, ref, *args, **kwargs):
+    """function(data, *args, **kwargs) on the data of a SharedData ref, run
+    in the worker."""
+    name, skeleton = ref
+    shm = shared_memory.SharedMemory(name=name, **_ATTACH)
+    try:
+        return function(_rebuild(skeleton, shm.buf), *args, **kwargs)
+    finally:
+        _close(shm)
+
+
+def _close(shm):
+    try:
+        shm.close()
+    except BufferError:
+        # views still held in reference cycles (pandas caches)
+        gc.collect()
+        try:
+            shm.close()
+        except BufferError:
+            pass
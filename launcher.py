@@ -0,0 +1,119 @@
+"""Start any of the analysis apps from one place.
+
+    python launcher.py pyminis
+    python launcher.py ca --startup-target 1.5
+    python launcher.py baps --profile-imports
+    python launcher.py atype --profile --trace atype_trace.json
+
+The window is shown as soon as Qt and pyqtgraph are up; scipy, pandas and
+neurphys are imported by a background thread afterwards (or on first use).
+--profile-imports reruns the start-up under ``python -X importtime`` and
+prints the modules that cost the most. --profile records per-stage timings
+of the analysis (Ctrl+Shift+P shows them) and --trace writes them to a
+trace file on exit.
+"""
+import time
+_T0 = time.perf_counter()
+
+import argparse
+import importlib
+import os
+import re
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# name -> (directory, module, window class)
+APPS = {'pyminis': ('pyminis', 'pyminis', 'MiniAnalysis'),
+        'ca': ('ca_oscill', 'ca_analysis_app', 'CaAnalysis'),
+        'baps': ('baps', 'bap_analysis', 'bAPAnalysis'),
+        'atype': ('atype', 'atype', 'ATypeAnalysis')}
+
+IMPORTTIME = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def load_window_class(name):
+    directory, module, cls = APPS[name]
+    for path in (os.path.join(ROOT, directory), ROOT):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    # worker processes (e.g. the pyminis parameter sweep) import the app's
+    # modules too and do not run this function
+    os.environ['PYTHONPATH'] = os.pathsep.join(
+        [os.path.join(ROOT, directory), ROOT] +
+        [p for p in os.environ.get('PYTHONPATH', '').split(os.pathsep) if p])
+    return getattr(importlib.import_module(module), cls)
+
+
+def import_report(stderr, top=15):
+    """Top-level imports sorted by cumulative time, from -X importtime."""
+    rows = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME.match(line)
+        if match and len(match.group(3)) <= 1:
+            rows.append((int(match.group(2)), int(match.group(1)),
+                         match.group(4)))
+    rows.sort(reverse=True)
+    total = sum(r[0] for r in rows)
+    lines = ['%-40s %10s %10s' % ('module', 'cum (ms)', 'self (ms)')]
+    for cum, own, module in rows[:top]:
+        lines.append('%-40s %10.1f %10.1f' % (module, cum / 1e3, own / 1e3))
+    lines.append('%-40s %10.1f' % ('total top-level', total / 1e3))
+    return '\n'.join(lines)
+
+
+def profile_imports(name):
+    cmd = [sys.executable, '-X', 'importtime', os.path.abspath(__file__),
+           name, '--exit-after-show']
+    result = subprocess.run(cmd, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    print(import_report(result.stderr))
+    return result.returncode
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('app', choices=sorted(APPS))
+    parser.add_argument('--profile-imports', action='store_true')
+    parser.add_argument('--startup-target', type=float, default=1.5,
+                        help='seconds to window shown, warn when exceeded')
+    parser.add_argument('--profile', action='store_true',
+                        help='record per-stage timings of the analysis')
+    parser.add_argument('--trace', metavar='PATH',
+                        help='write the recorded stages to PATH on exit')
+    parser.add_argument('--exit-after-show', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.profile_imports:
+        return profile_imports(args.app)
+
+    from PyQt5 import QtWidgets
+    from labcommon.profiling import profiler
+    if args.profile or args.trace:
+        profiler.enable()
+    app = QtWidgets.QApplication(sys.argv[:1])
+    window = load_window_class(args.app)()
+    window.show()
+    app.processEvents()
+    elapsed = time.perf_counter() - _T0
+    print('%s window shown after %.2f s' % (args.app, elapsed))
+    if elapsed > args.startup_target:
+        print('start-up is over the %.2f s target, run with '
+              '--profile-imports to see why' % args.startup_target)
+
+    if args.exit_after_show:
+        return 0
+    from labcommon.lazy import warm_up_in_background
+    warm_up_in_background()
+    status = app.exec_()
+    if args.trace:
+        profiler.dump(args.trace)
+        print(profiler.report())
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+"""Event detection on many sweeps at once, in worker processes.
+
+detect_sweep runs the steps of MiniAnalysis.run_detection followed by
+calc_vals on one sweep, with the parameters captured from the window, so
+the checked sweeps of a file can be fanned out over a process pool. The
+sweeps go out through shared memory (detect_shared) and only the fit
+parameters and the events come back from the workers; the fit, subtraction
+and smoothed columns are rebuilt by sweep_columns when a sweep is displayed.
+
+load and compute do the same for every sweep of a recording without the
+window, with the window's default parameters for anything not given, for
+the job queue.
+"""
+import os
+import struct
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from scipy.optimize import curve_fit
+import neurphys.read_abf as abf
+import neurphys.read_pv as rpv
+import neurphys.utilities as util
+import detection
+import kinetics
+import lazy_abf
+from labcommon import peaks
+
+
+# the defaults of the MiniAnalysis window; sweeps=None is every sweep
+DEFAULTS = OrderedDict([('stim_start', 0), ('peak_time_delta', 0.02),
+                        ('end_fit', 0.3), ('sub_trans', True),
+                        ('detect_method', 'Peaks'), ('mpd', 0.01),
+                        ('rms_multiple', 1), ('rms_start', 0),
+                        ('rms_stop', 0.1), ('noise_mode', 'Fixed region'),
+                        ('noise_window', 0.5), ('detect_start', 0.02),
+                        ('detect_stop', None), ('event_bsl_window', 40),
+                        ('kinetics_window', 0.02), ('smth_by', 10),
+                        ('tolerance', 20), ('template_rise', 0.0005),
+                        ('template_decay', 0.004), ('template_threshold', 4),
+                        ('sweeps', None)])
+
+
+def biexp_decay(x, a, b, c, d, e):
+    return a*(np.exp(-x/b)) + c*(np.exp(-x/d)) + e
+
+
+def fit_transient(time, primary, params):
+    """popt, peak index and peak time as found by gen_fit/fit_transient."""
+    stim_start = params['stim_start']
+    mask = (time >= stim_start) & (time <= stim_start + params['peak_time_delta'])
+    if not mask.any():
+        raise ValueError('No data points between stim start and peak')
+    peak_ix = np.flatnonzero(mask)[np.nanargmin(primary[mask])]
+    peak_time = time[peak_ix]
+
+    fit_ixs = np.flatnonzero((time >= peak_time) & (time <= params['end_fit']))
+    x = (time[fit_ixs] - time[fit_ixs[0]]) * 1e3
+    guess = np.array([-1, 1, -1, 10, primary[fit_ixs].max()])
+    try:
+        popt, pcov = curve_fit(biexp_decay, x, primary[fit_ixs], guess,
+                               maxfev=10000)
+    except RuntimeError:
+        raise ValueError('Transient fit failed')
+    return popt, peak_ix, peak_time
+
+
+def fit_column(time, primary, popt, peak_ix, end_fit):
+    # the same layout as MiniAnalysis.update_sweep_fit
+    fit_ixs = np.flatnonzero((time >= time[peak_ix]) & (time <= end_fit))
+    fit_vals = biexp_decay((time[fit_ixs] - time[fit_ixs[0]]) * 1e3, *popt)
+    first20 = np.nanmean(primary[:21])
+    front_fill = util.simple_smoothing(primary[:peak_ix+1], 20)
+    front_fill[np.isnan(front_fill)] = first20
+    back_fill = np.full(len(primary) - (len(front_fill) + len(fit_vals)),
+                        fit_vals[-1])
+    return np.concatenate((front_fill, fit_vals, back_fill))
+
+
+def sweep_columns(time, primary, params, result):
+    """fit, subtraction and smthd columns for a sweep detected by
+    detect_sweep, without refitting."""
+    columns = OrderedDict()
+    base = primary
+    if result['popt'] is not None:
+        columns['fit'] = fit_column(time, primary, result['popt'],
+                                    result['peak_ix'], params['end_fit'])
+        columns['subtraction'] = primary - columns['fit']
+        base = columns['subtraction']
+    columns['smthd'] = util.simple_smoothing(base, params['smth_by'])
+    return columns
+
+
+def detect_sweep(name, time, primary, params, template=None):
+    time = np.asarray(time, dtype='float64')
+    primary = np.asarray(primary, dtype='float64')
+    sampling = 1 / (time[1] - time[0])
+    result = {'sweep': name, 'popt': None, 'peak_ix': None,
+              'peak_time': None}
+
+    if params['sub_trans']:
+        popt, peak_ix, peak_time = fit_transient(time, primary, params)
+        result.update(popt=popt, peak_ix=peak_ix, peak_time=peak_time)
+    smthd = sweep_columns(time, primary, params, result)['smthd']
+
+    # gen_subset
+    if params['detect_start'] is None:
+        start = time[0]
+    elif params['sub_trans']:
+        start = result['peak_time'] + params['detect_start']
+    else:
+        start = params['detect_start']
+    stop = time[-1] if params['detect_stop'] is None else params['detect_stop']
+    subset_ixs = np.flatnonzero((time >= start) & (time <= stop))
+    subset = smthd[subset_ixs]
+
+    mpd_points = int(params['mpd'] * sampling)
+    if params['detect_method'] == 'Template':
+        criterion = detection.scaled_template_criterion(subset, template)
+        starts = peaks.detect_peaks(criterion, mph=params['template_threshold'],
+                                    mpd=mpd_points)
+        ixs = np.unique(detection.template_valleys(subset, starts, template))
+    else:
+        ixs = peaks.detect_peaks(subset, mpd=mpd_points, valley=True)
+    indexes = np.sort(subset_ixs[ixs])
+
+    # check_height
+    bsl = params['event_bsl_window']
+    heights = detection.event_heights(smthd, indexes, bsl)
+    if params['noise_mode'] == 'Fixed region':
+        mask = (time >= params['rms_start']) & (time <= params['rms_stop'])
+        if not mask.any():
+            raise ValueError('No data points in RMS region')
+        region = smthd[mask]
+        noise = np.sqrt(np.nansum((region - np.nanmean(region))**2) / len(region))
+    else:
+        window = int(params['noise_window'] * sampling)
+        noise = detection.local_noise(smthd, window, params['noise_mode'])[indexes]
+    keep = heights > noise*params['rms_multiple']
+
+    result['indexes'] = indexes[keep]
+    result['heights'] = heights[keep]
+    result['times'] = time[result['indexes']]
+    result['kinetics'] = kinetics.event_kinetics(smthd, result['indexes'],
+                                                 sampling, 2*bsl,
+                                                 int(params['kinetics_window']*sampling))
+    return result
+
+
+def detect_shared(sweep, name, params, template=None):
+    """detect_sweep on a (time, primary) pair shared with labcommon.shared."""
+    time, primary = sweep
+    return detect_sweep(name, time, primary, params, template)
+
+
+def pooled_results(results):
+    """One row per event over all sweeps, in the order given."""
+    frames = []
+    for result in results:
+        df = result['kinetics'].copy()
+        df.insert(0, 'Amplitude (pA)', result['heights'])
+        df.insert(0, 'Time (s)', result['times'])
+        df.insert(0, 'Sweep', result['sweep'])
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=['Sweep', 'Time (s)', 'Amplitude (pA)'] +
+                            kinetics.COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def load(paths, params):
+    """{sweep name: (time, primary)} of an .abf file or a PV folder."""
+    path = paths[0]
+    names = params.get('sweeps')
+
+    def arrays(sweep_names, frame):
+        sweeps = OrderedDict()
+        for name in sweep_names:
+            if names is None or name in names:
+                sweep = frame(name)
+                sweeps[name] = (sweep.time.values, sweep.primary.values)
+        return sweeps
+
+    if os.path.isdir(path):
+        df = rpv.import_folder(path)['voltage recording']
+        if df is None:
+            raise ValueError('%s does not contain a voltage recording' % path)
+        return arrays(df.index.levels[0], lambda name: df.loc[name])
+    try:
+        recording = lazy_abf.LazyABF(path, prefetch=False)
+    except (ValueError, OSError, struct.error):
+        df = abf.read_abf(path)
+        return arrays(df.index.levels[0], lambda name: df.loc[name])
+    try:
+        return arrays(recording.sweeps, recording.frame)
+    finally:
+        recording.close()
+
+
+def compute(sweeps, params):
+    params = dict(DEFAULTS, **params)
+    template = None
+    results = []
+    for name, (time, primary) in sweeps.items():
+        if params['detect_method'] == 'Template' and template is None:
+            template = detection.biexp_template(1 / (time[1] - time[0]),
+                                                params['template_rise'],
+                                                params['template_decay'])
+        results.append(detect_sweep(name, time, primary, params, template))
+    return pooled_results(results)
+
+
+def analyze(paths, params):
+    """Pooled events of every sweep of the recording at paths[0]."""
+    return compute(load(paths, params), params)
@@ -0,0 +1,136 @@
+"""Compact in-memory representation of recordings.
+
+read_abf/import_folder return float64 frames with a float64 time column per
+sweep. A CompactRecording keeps each channel as int16 (when the samples sit
+on a regular ADC grid, as ABF data does) or float32, plus a gain/offset, and
+each sweep's time as t0 + i*dt. Physical units are only produced for the
+sweep or slice being worked on.
+"""
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+
+INT16_LEVELS = 65535
+
+
+class CompactChannel:
+    __slots__ = ('raw', 'gain', 'offset')
+
+    def __init__(self, raw, gain=1.0, offset=0.0):
+        self.raw = raw
+        self.gain = gain
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.raw)
+
+    @property
+    def nbytes(self):
+        return self.raw.nbytes
+
+    def values(self, start=None, stop=None, dtype='float64'):
+        vals = self.raw[start:stop].astype(dtype)
+        if self.gain != 1 or self.offset != 0:
+            vals *= self.gain
+            vals += self.offset
+        return vals
+
+
+def infer_step(values, sample=100000):
+    """Smallest spacing between distinct sample values, i.e. the ADC step
+    for data that came from an integer converter. None if not regular."""
+    uniq = np.unique(values[:sample])
+    if len(uniq) < 2:
+        return None
+    diffs = np.diff(uniq)
+    step = diffs.min()
+    if step <= 0 or not np.allclose(diffs / step, np.round(diffs / step),
+                                    atol=1e-3):
+        return None
+    return step
+
+
+def compact_channel(values, dtype='int16'):
+    values = np.asarray(values, dtype='float64')
+    if dtype == 'int16' and len(values) and not np.isnan(values).any():
+        step = infer_step(values)
+        lo, hi = values.min(), values.max()
+        if step is not None and (hi - lo) / step < INT16_LEVELS:
+            # centre on a grid point so every sample maps to an integer
+            offset = lo + np.round((hi - lo) / 2 / step) * step
+            raw = np.round((values - offset) / step)
+            if np.allclose(raw * step + offset, values, rtol=0,
+                           atol=step * 1e-3):
+                return CompactChannel(raw.astype('int16'), step, offset)
+    # irregular or NaN containing data keeps full float32 resolution
+    return CompactChannel(values.astype('float32'))
+
+
+class CompactSweep:
+    def __init__(self, channels, t0, dt, time=None):
+        self.channels = channels
+        self.t0 = t0
+        self.dt = dt
+        self._time = time
+
+    def __len__(self):
+        return len(next(iter(self.channels.values())))
+
+    @property
+    def nbytes(self):
+        extra = self._time.nbytes if self._time is not None else 0
+        return sum(ch.nbytes for ch in self.channels.values()) + extra
+
+    def time(self, start=None, stop=None):
+        if self._time is not None:
+            return self._time[start:stop]
+        ixs = np.arange(len(self))[start:stop]
+        return self.t0 + ixs * self.dt
+
+    def to_frame(self):
+        data = OrderedDict([('time', self.time())])
+        for name, channel in self.channels.items():
+            data[name] = channel.values()
+        return pd.DataFrame(data)
+
+    @classmethod
+    def from_frame(cls, frame, dtype='int16'):
+        time = frame['time'].values
+        t0 = time[0]
+        dt = (time[-1] - time[0]) / (len(time) - 1) if len(time) > 1 else 0
+        regular = np.allclose(np.diff(time), dt, rtol=1e-6, atol=0)
+        channels = OrderedDict((col, compact_channel(frame[col].values, dtype))
+                               for col in frame.columns if col != 'time')
+        return cls(channels, t0, dt, None if regular else time.copy())
+
+
+class CompactRecording:
+    """Sweep name -> CompactSweep, with the subset of the DataFrame interface
+    pyminis needs (sweep names and one sweep as a frame)."""
+    def __init__(self, sweeps):
+        self._sweeps = sweeps
+
+    @property
+    def sweeps(self):
+        return list(self._sweeps)
+
+    def __getitem__(self, name):
+        return self._sweeps[name]
+
+    def frame(self, name):
+        return self._sweeps[name].to_frame()
+
+    @property
+    def nbytes(self):
+        return sum(sweep.nbytes for sweep in self._sweeps.values())
+
+    @classmethod
+    def from_frame(cls, df, dtype='int16'):
+        sweeps = OrderedDict()
+        if isinstance(df.index, pd.MultiIndex):
+            for name in df.index.levels[0]:
+                sweeps[name] = CompactSweep.from_frame(df.loc[name], dtype)
+        else:
+            sweeps['Sweep0001'] = CompactSweep.from_frame(df, dtype)
+        return cls(sweeps)
@@ -0,0 +1,142 @@
+"""Numeric kernels used by pyminis' event detection."""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.ndimage import maximum_filter1d
+from scipy.signal import fftconvolve
+
+
+MAD_TO_SD = np.sqrt(np.pi / 2)
+
+
+def _window_bounds(n, window):
+    # [lo, hi) of a centered window of `window` points, clipped to the trace
+    window = max(int(window), 1)
+    start = np.arange(n) - window // 2
+    return np.clip(start, 0, n), np.clip(start + window, 0, n)
+
+
+def _running_sum(x, lo, hi):
+    cs = np.concatenate(([0], np.cumsum(x)))
+    return cs[hi] - cs[lo]
+
+
+def rolling_mean(values, window):
+    values = np.asarray(values, dtype='float64')
+    valid = ~np.isnan(values)
+    lo, hi = _window_bounds(len(values), window)
+    total = _running_sum(np.where(valid, values, 0), lo, hi)
+    count = _running_sum(valid, lo, hi)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / count
+
+
+def rolling_rms(values, window):
+    """RMS about the local mean in a centered window of ``window`` points."""
+    values = np.asarray(values, dtype='float64')
+    valid = ~np.isnan(values)
+    clean = np.where(valid, values, 0)
+    lo, hi = _window_bounds(len(values), window)
+    total = _running_sum(clean, lo, hi)
+    sumsq = _running_sum(clean * clean, lo, hi)
+    count = _running_sum(valid, lo, hi)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        var = sumsq / count - mean * mean
+    return np.sqrt(np.clip(var, 0, None))
+
+
+def rolling_mad(values, window):
+    """Mean absolute deviation about the local mean, scaled to match the RMS
+    of gaussian noise. Less inflated by the events themselves than RMS."""
+    values = np.asarray(values, dtype='float64')
+    dev = np.abs(values - rolling_mean(values, window))
+    return rolling_mean(dev, window) * MAD_TO_SD
+
+
+NOISE_ESTIMATORS = {'Rolling RMS': rolling_rms,
+                    'Rolling MAD': rolling_mad}
+
+
+def local_noise(values, window, method='Rolling RMS'):
+    return NOISE_ESTIMATORS[method](values, window)
+
+
+def event_heights(values, indexes, delta):
+    """Height of each valley below the max of values[ix-delta:ix+delta+2],
+    computed for all indexes at once with a running max over the trace."""
+    values = np.asarray(values, dtype='float64')
+    indexes = np.atleast_1d(indexes).astype('int')
+    if not len(indexes):
+        return np.empty(0)
+    filled = np.where(np.isnan(values), -np.inf, values)
+    bsl = maximum_filter1d(filled, 2*delta + 2, mode='constant',
+                           cval=-np.inf, origin=-1)
+    return bsl[indexes] - values[indexes]
+
+
+def biexp_template(sampling, rise, decay, length=None):
+    """Inward (negative going) biexponential event scaled to a peak of -1.
+    ``rise``, ``decay`` and ``length`` are in seconds."""
+    if length is None:
+        length = rise + 5*decay
+    t = np.arange(max(int(length * sampling), 3)) / sampling
+    template = -(1 - np.exp(-t/rise)) * np.exp(-t/decay)
+    return template / -template.min()
+
+
+def template_from_events(values, indexes, pre, post):
+    """Average of the events at ``indexes`` from ``pre`` points before to
+    ``post`` points after each valley, baselined on the first ``pre`` points
+    and scaled to a peak of -1."""
+    values = np.asarray(values, dtype='float64')
+    indexes = np.atleast_1d(indexes).astype('int')
+    indexes = indexes[(indexes - pre >= 0) & (indexes + post < len(values))]
+    if not len(indexes):
+        raise ValueError('No events far enough from the sweep edges')
+
+    windows = sliding_window_view(values, pre + post)[indexes - pre]
+    windows = windows - np.nanmean(windows[:, :pre], axis=1)[:, None]
+    template = np.nanmean(windows, axis=0)
+    return template / -template.min()
+
+
+def scaled_template_criterion(values, template):
+    """Clements & Bekkers (1997) detection criterion for every start position.
+
+    At each position the template is optimally scaled and offset onto the
+    data and the criterion is scale / standard error of the fit. The cross
+    term is an FFT correlation and the data sums are cumulative sums, so the
+    whole sweep costs O(n log n) instead of O(n * len(template)).
+    """
+    values = np.asarray(values, dtype='float64')
+    values = np.where(np.isnan(values), np.nanmean(values), values)
+    template = np.asarray(template, dtype='float64')
+    n = len(template)
+    if len(values) < n:
+        return np.empty(0)
+
+    sum_t = template.sum()
+    sum_t2 = np.dot(template, template)
+    sum_td = fftconvolve(values, template[::-1], mode='valid')
+
+    lo, hi = np.arange(len(values) - n + 1), np.arange(n, len(values) + 1)
+    sum_d = _running_sum(values, lo, hi)
+    sum_d2 = _running_sum(values * values, lo, hi)
+
+    scale = (sum_td - sum_t*sum_d/n) / (sum_t2 - sum_t*sum_t/n)
+    offset = (sum_d - scale*sum_t) / n
+    sse = (sum_d2 + scale*scale*sum_t2 + n*offset*offset -
+           2*(scale*sum_td + offset*sum_d - scale*offset*sum_t))
+    std_err = np.sqrt(np.clip(sse, 1e-12, None) / (n - 1))
+    return scale / std_err
+
+
+def template_valleys(values, starts, template):
+    """Valley of the data inside the template window at each start."""
+    values = np.asarray(values, dtype='float64')
+    starts = np.atleast_1d(starts).astype('int')
+    if not len(starts):
+        return starts
+    filled = np.where(np.isnan(values), np.inf, values)
+    windows = sliding_window_view(filled, len(template))[starts]
+    return starts + windows.argmin(axis=1)
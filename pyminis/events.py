@@ -0,0 +1,99 @@
+"""Waveform store for detected events.
+
+Each store holds one float32 row per event, the valley at column ``pre``.
+Rows are gathered through a strided view over the sweep, so the sweep is
+not copied (only the windows at its edges are padded), and saved stores can
+be reopened memory-mapped for sets too large to keep resident.
+"""
+import json
+import numpy as np
+import kinetics
+
+
+class EventStore:
+    def __init__(self, waveforms, indexes, pre, sampling, label=''):
+        self.waveforms = waveforms
+        self.indexes = np.asarray(indexes, dtype='int64')
+        self.pre = pre
+        self.sampling = sampling
+        self.label = label
+
+    @classmethod
+    def from_sweep(cls, values, indexes, pre, post, sampling, label=''):
+        windows = kinetics.gather_windows(values, indexes, pre, post)
+        return cls(windows.astype('float32'), indexes, pre, sampling, label)
+
+    def __len__(self):
+        return len(self.waveforms)
+
+    @property
+    def time(self):
+        return (np.arange(self.waveforms.shape[1]) - self.pre) / self.sampling
+
+    def average(self, aligned=False):
+        waveforms = self.aligned_on_rise() if aligned else self.waveforms
+        return np.nanmean(waveforms, axis=0, dtype='float64')
+
+    def rise_points(self, level=0.5):
+        # fractional column of the `level` crossing on each event's rise
+        bsl = max(self.pre // 4, 1)
+        baseline = np.nanmean(self.waveforms[:, :bsl], axis=1, dtype='float64')
+        amp = baseline - self.waveforms[:, self.pre]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            norm = (baseline[:, None] - self.waveforms) / amp[:, None]
+        return kinetics.last_below(norm, level, self.pre + 1)
+
+    def aligned_on_rise(self, level=0.5):
+        """Rows shifted so each event's ``level`` rise crossing lands on the
+        median crossing column. Columns shifted in from outside are NaN."""
+        rise = self.rise_points(level)
+        target = np.nanmedian(rise)
+        shift = np.nan_to_num(np.round(rise - target), nan=0).astype('int')
+        n_cols = self.waveforms.shape[1]
+        cols = np.arange(n_cols)[None, :] + shift[:, None]
+        valid = (cols >= 0) & (cols < n_cols)
+        rows = np.take_along_axis(self.waveforms, np.clip(cols, 0, n_cols-1),
+                                  axis=1)
+        return np.where(valid, rows, np.float32(np.nan))
+
+    def save(self, path):
+        out = np.lib.format.open_memmap(path + '.npy', mode='w+',
+                                        dtype='float32',
+                                        shape=self.waveforms.shape)
+        out[:] = self.waveforms
+        out.flush()
+        del out
+        meta = {'indexes': self.indexes.tolist(), 'pre': self.pre,
+                'sampling': self.sampling, 'label': self.label}
+        with open(path + '.json', 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        waveforms = np.load(path + '.npy', mmap_mode='r' if mmap else None)
+        return cls(waveforms, meta['indexes'], meta['pre'], meta['sampling'],
+                   meta['label'])
+
+
+def cell_average(stores, aligned=False):
+    """Average over every event of every store (e.g. all files of a cell),
+    so each event carries equal weight. Stores must share pre and width."""
+    if not stores:
+        return None
+    shapes = {(s.pre, s.waveforms.shape[1]) for s in stores}
+    if len(shapes) > 1:
+        raise ValueError('Event windows differ between files')
+
+    total = None
+    count = None
+    for store in stores:
+        waveforms = store.aligned_on_rise() if aligned else store.waveforms
+        valid = ~np.isnan(waveforms)
+        part = np.where(valid, waveforms, 0).sum(axis=0, dtype='float64')
+        total = part if total is None else total + part
+        n = valid.sum(axis=0)
+        count = n if count is None else count + n
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / count
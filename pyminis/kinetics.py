@@ -0,0 +1,115 @@
+"""Per-event kinetics for detected minis, computed for all events at once.
+
+Events are gathered into a 2-D array (one row per event, the valley at
+column ``pre``) and every measurement is a masked reduction over that array,
+so 10k events cost a handful of numpy calls instead of 10k curve_fits.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+COLUMNS = ['Rise 10-90 (ms)', 'Half-width (ms)', 'Decay tau (ms)',
+           'Charge (fC)']
+
+
+def gather_windows(values, indexes, pre, post):
+    """Rows of values[ix-pre:ix+post] for every index, NaN padded at the
+    sweep edges. Uses a strided view so only the result is allocated; the
+    few windows running over an edge are filled one by one."""
+    values = np.asarray(values, dtype='float64')
+    indexes = np.atleast_1d(indexes).astype('int')
+    windows = np.full((len(indexes), pre + post), np.nan)
+    inside = (indexes >= pre) & (indexes + post <= len(values))
+    if inside.any():
+        windows[inside] = sliding_window_view(values, pre + post)[
+            indexes[inside] - pre]
+    for row in np.flatnonzero(~inside):
+        start = indexes[row] - pre
+        lo, hi = max(start, 0), min(start + pre + post, len(values))
+        if lo < hi:
+            windows[row, lo - start:hi - start] = values[lo:hi]
+    return windows
+
+
+def last_below(norm, level, stop):
+    # last column < level before `stop`, per row, interpolated to the crossing
+    rows = np.arange(len(norm))
+    below = norm[:, :stop] < level
+    has = below.any(axis=1)
+    ix = stop - 1 - np.argmax(below[:, ::-1], axis=1)
+    ix = np.clip(ix, 0, stop - 2)
+    y0, y1 = norm[rows, ix], norm[rows, ix+1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = (level - y0) / (y1 - y0)
+    return np.where(has, ix + np.clip(frac, 0, 1), np.nan)
+
+
+def first_below(norm, level, start):
+    rows = np.arange(len(norm))
+    below = norm[:, start:] < level
+    has = below.any(axis=1)
+    ix = start + np.argmax(below, axis=1)
+    ix = np.clip(ix, 1, norm.shape[1] - 1)
+    y0, y1 = norm[rows, ix-1], norm[rows, ix]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = (y0 - level) / (y0 - y1)
+    return np.where(has, ix - 1 + np.clip(frac, 0, 1), np.nan)
+
+
+def decay_taus(norm, start, stop, dt):
+    """Batched log-linear fit of norm = exp(-t/tau) over each row's
+    [start, stop) columns where 0 < norm, returning tau in units of dt."""
+    cols = np.arange(norm.shape[1])
+    mask = ((cols >= start[:, None]) & (cols < stop[:, None]) &
+            (norm > 0) & ~np.isnan(norm))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        y = np.where(mask, np.log(np.where(mask, norm, 1)), 0)
+        t = np.where(mask, cols * dt, 0)
+        n = mask.sum(axis=1)
+        t_mean = t.sum(axis=1) / n
+        y_mean = y.sum(axis=1) / n
+        tc = np.where(mask, t - t_mean[:, None], 0)
+        slope = (tc * (y - y_mean[:, None])).sum(axis=1) / (tc * tc).sum(axis=1)
+        tau = -1 / slope
+    return np.where((n >= 3) & (tau > 0), tau, np.nan)
+
+
+def event_kinetics(values, indexes, sampling, pre, post, bsl=None):
+    """10-90% rise time, half-width, decay tau and charge of inward events
+    whose valleys are at ``indexes``. The baseline is the mean of the first
+    ``bsl`` (default pre // 4) of the ``pre`` points before each valley, so
+    ``pre`` needs to reach well before the event onset."""
+    import pandas as pd
+    dt = 1 / sampling
+    windows = gather_windows(values, indexes, pre, post)
+    if not len(windows):
+        return pd.DataFrame(columns=COLUMNS)
+
+    if bsl is None:
+        bsl = pre // 4
+    baseline = np.nanmean(windows[:, :max(bsl, 1)], axis=1)
+    amp = baseline - windows[:, pre]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        norm = (baseline[:, None] - windows) / amp[:, None]
+
+    t10 = last_below(norm, 0.1, pre + 1)
+    t90 = last_below(norm, 0.9, pre + 1)
+    rise_50 = last_below(norm, 0.5, pre + 1)
+    decay_50 = first_below(norm, 0.5, pre)
+
+    # fit the decay from 80% down to the first 20% crossing
+    d80 = first_below(norm, 0.8, pre)
+    d20 = first_below(norm, 0.2, pre)
+    fit_start = np.nan_to_num(np.ceil(d80), nan=pre).astype('int')
+    fit_stop = np.nan_to_num(np.floor(d20) + 1, nan=norm.shape[1]).astype('int')
+    tau = decay_taus(norm, fit_start, fit_stop, dt)
+
+    onset = np.nan_to_num(np.floor(t10), nan=0).astype('int')
+    cols = np.arange(windows.shape[1])
+    in_event = (cols >= onset[:, None]) & ~np.isnan(windows)
+    charge = np.where(in_event, windows - baseline[:, None], 0).sum(axis=1) * dt
+
+    return pd.DataFrame({'Rise 10-90 (ms)': (t90 - t10) * dt * 1e3,
+                         'Half-width (ms)': (decay_50 - rise_50) * dt * 1e3,
+                         'Decay tau (ms)': tau * 1e3,
+                         'Charge (fC)': charge * 1e3}, columns=COLUMNS)
@@ -0,0 +1,194 @@
+"""Sweep-on-demand access to ABF2 files.
+
+Only the header is parsed up front. The data section is memory-mapped and a
+sweep is decoded to a DataFrame the first time it is asked for, kept in a
+small LRU, and the following sweep is decoded in the background so stepping
+through sweeps does not wait on the disk. With compact=True the LRU holds
+compact.CompactSweeps of the raw int16 (or float32) samples with their gain
+and offset instead, and only the frame handed out is in physical units.
+"""
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import compact
+
+
+BLOCK = 512
+CHANNEL_NAMES = ['primary', 'secondary', 'tertiary', 'quaternary']
+
+
+def channel_name(ch):
+    return CHANNEL_NAMES[ch] if ch < len(CHANNEL_NAMES) else 'channel%d' % ch
+
+
+def _section(header, offset):
+    block, nbytes, entries = struct.unpack_from('<IIq', header, offset)
+    return block * BLOCK, nbytes, entries
+
+
+class ABFHeader:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            header = f.read(BLOCK)
+            if header[:4] != b'ABF2':
+                raise ValueError('%s is not an ABF2 file' % path)
+
+            self.n_episodes, = struct.unpack_from('<I', header, 12)
+            self.data_format, = struct.unpack_from('<H', header, 30)
+            protocol_start, _, _ = _section(header, 76)
+            adc_start, adc_bytes, self.n_channels = _section(header, 92)
+            self.data_start, _, self.n_points = _section(header, 236)
+
+            f.seek(protocol_start)
+            protocol = f.read(BLOCK)
+            self.operation_mode, = struct.unpack_from('<h', protocol, 0)
+            adc_interval, = struct.unpack_from('<f', protocol, 2)
+            samples_per_episode, = struct.unpack_from('<i', protocol, 22)
+            adc_range, = struct.unpack_from('<f', protocol, 110)
+            adc_resolution, = struct.unpack_from('<i', protocol, 118)
+
+            f.seek(adc_start)
+            adc = f.read(adc_bytes * self.n_channels)
+
+        self.sampling = 1e6 / adc_interval
+        # operation mode 3 is gap-free, stored as one long sweep
+        if self.operation_mode == 3 or self.n_episodes == 0:
+            self.n_sweeps = 1
+            self.sweep_points = self.n_points // self.n_channels
+        else:
+            self.n_sweeps = self.n_episodes
+            self.sweep_points = samples_per_episode // self.n_channels
+
+        self.gains = []
+        self.offsets = []
+        for i in range(self.n_channels):
+            entry = adc[i*adc_bytes:(i+1)*adc_bytes]
+            telegraph, = struct.unpack_from('<h', entry, 2)
+            addit_gain, = struct.unpack_from('<f', entry, 6)
+            prog_gain, = struct.unpack_from('<f', entry, 28)
+            scale, inst_offset, signal_gain, signal_offset = \
+                struct.unpack_from('<ffff', entry, 40)
+            gain = scale * signal_gain * prog_gain
+            if telegraph:
+                gain *= addit_gain
+            if self.data_format == 0:
+                self.gains.append(adc_range / adc_resolution / gain)
+            else:
+                self.gains.append(1.0)
+            self.offsets.append(inst_offset - signal_offset)
+
+
+class LazyABF:
+    """Exposes ``sweeps`` and ``frame(name)`` like CompactRecording."""
+    def __init__(self, path, cache_size=4, prefetch=True, compact=False):
+        self.path = path
+        self.compact = compact
+        self.header = ABFHeader(path)
+        dtype = '<i2' if self.header.data_format == 0 else '<f4'
+        self._data = np.memmap(path, dtype=dtype, mode='r',
+                               offset=self.header.data_start,
+                               shape=(self.header.n_points,))
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(1) if prefetch else None
+
+    @property
+    def sweeps(self):
+        return ['Sweep%04d' % (i+1) for i in range(self.header.n_sweeps)]
+
+    @property
+    def sampling(self):
+        return self.header.sampling
+
+    def _raw(self, i):
+        h = self.header
+        n = h.sweep_points * h.n_channels
+        return np.asarray(self._data[i*n:(i+1)*n]).reshape(-1, h.n_channels)
+
+    def decode(self, i):
+        h = self.header
+        raw = self._raw(i)
+        data = OrderedDict([('time', np.arange(len(raw)) / h.sampling)])
+        for ch in range(h.n_channels):
+            vals = raw[:, ch].astype('float64')
+            vals *= h.gains[ch]
+            vals += h.offsets[ch]
+            data[channel_name(ch)] = vals
+        return pd.DataFrame(data)
+
+    def decode_compact(self, i):
+        """Sweep i as a CompactSweep, the samples copied out of the file
+        as they are stored."""
+        h = self.header
+        raw = self._raw(i)
+        channels = OrderedDict(
+            (channel_name(ch), compact.CompactChannel(np.array(raw[:, ch]),
+                                                      h.gains[ch],
+                                                      h.offsets[ch]))
+            for ch in range(h.n_channels))
+        return compact.CompactSweep(channels, 0.0, 1 / h.sampling)
+
+    def _decode(self, i):
+        return self.decode_compact(i) if self.compact else self.decode(i)
+
+    def _get(self, name):
+        with self._lock:
+            if name in self._cache:
+                self._cache.move_to_end(name)
+                return self._cache[name]
+            future = self._pending.get(name)
+
+        frame = None
+        if future is not None:
+            try:
+                frame = future.result()
+            except Exception:
+                # decoded again below, a failed prefetch is not kept
+                pass
+            finally:
+                with self._lock:
+                    self._pending.pop(name, None)
+        if frame is None:
+            frame = self._decode(self.sweeps.index(name))
+
+        with self._lock:
+            self._cache[name] = frame
+            self._cache.move_to_end(name)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return frame
+
+    def prefetch(self, name):
+        if self._executor is None:
+            return
+        with self._lock:
+            if name in self._cache or name in self._pending:
+                return
+            self._pending[name] = self._executor.submit(
+                self._decode, self.sweeps.index(name))
+
+    def frame(self, name):
+        frame = self._get(name)
+        sweeps = self.sweeps
+        i = sweeps.index(name)
+        if i + 1 < len(sweeps):
+            self.prefetch(sweeps[i+1])
+        if self.compact:
+            return frame.to_frame()
+        # callers add columns to the sweep, keep the cached one pristine
+        return frame.copy()
+
+    def close(self):
+        if self._executor is not None:
+            with self._lock:
+                for future in self._pending.values():
+                    future.cancel()
+                self._pending = {}
+            # a decode already running still reads the memmap
+            self._executor.shutdown(wait=True)
+        self._data = None
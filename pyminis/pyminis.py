@@ -1,20 +1,197 @@
 from PyQt5 import QtCore, QtGui, QtWidgets
 import sys
 import os
-import neurphys.read_abf as abf
-import neurphys.read_pv as rpv
-import neurphys.pacemaking as pace
-import neurphys.utilities as util
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from labcommon.lazy import lazy_import, warm_up_in_background
+import struct
 import pyqtgraph as pg
 import numpy as np
-from scipy.optimize import curve_fit
-import pandas as pd
 import time
+import queue
+import threading
 import warnings
 import logging
+import multiprocessing
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import stream
+import kinetics
+import events
+import session
+from labcommon import plots, profile_window, pyramid, result_cache
+from labcommon.profiling import profiler
+# scipy, pandas and neurphys load on first use or from the warm-up thread
+abf = lazy_import('neurphys.read_abf')
+rpv = lazy_import('neurphys.read_pv')
+peaks = lazy_import('labcommon.peaks')
+util = lazy_import('neurphys.utilities')
+optimize = lazy_import('scipy.optimize')
+pd = lazy_import('pandas')
+detection = lazy_import('detection')
+compact = lazy_import('compact')
+sensitivity = lazy_import('sensitivity')
+batch = lazy_import('batch')
+lazy_abf = lazy_import('lazy_abf')
+results = lazy_import('labcommon.results')
+shared = lazy_import('labcommon.shared')
 warnings.filterwarnings("ignore")
 
+# attributes written to and restored from session files
+SESSION_PARAMS = ['stim_start', 'peak_time_delta', 'end_fit', 'sub_trans',
+                  'detect_method', 'mpd', 'rms_multiple', 'rms_start',
+                  'rms_stop', 'noise_mode', 'noise_window', 'detect_start',
+                  'detect_stop', 'event_bsl_window', 'kinetics_window',
+                  'smth_by', 'tolerance', 'template_rise', 'template_decay',
+                  'template_threshold']
+
+# navigator: columns of the event density, and the width of the detail view
+# when stepping to an event while the whole sweep is shown (s)
+DENSITY_BINS = 400
+EVENT_WINDOW = 0.5
+
+
+class ParameterSweepDialog(QtWidgets.QDialog):
+    """Event counts and amplitude distributions over a grid of detection
+    parameters, for the sweep currently checked in the main window."""
+    def __init__(self, main):
+        super().__init__(main)
+        self.main = main
+        self.summary = None
+        self.amplitudes = []
+        self.setWindowTitle('Parameter sweep')
+        self.resize(1000*main.ratio, 600*main.ratio)
+
+        layout = QtWidgets.QHBoxLayout(self)
+        left_col = QtWidgets.QVBoxLayout()
+
+        smth = main.smth_by
+        mpd = main.mpd
+        form = QtWidgets.QFormLayout()
+        self.smth_txt = QtWidgets.QLineEdit('%d, %d, %d' % (max(smth//2, 1),
+                                                            smth, smth*2))
+        self.mpd_txt = QtWidgets.QLineEdit('%g, %g, %g' % (mpd/2, mpd, mpd*2))
+        self.event_bsl_txt = QtWidgets.QLineEdit('%d' % main.event_bsl_window)
+        self.rms_txt = QtWidgets.QLineEdit('1, 1.5, 2, 2.5, 3')
+        form.addRow('Smooth by (# points):', self.smth_txt)
+        form.addRow('Min. peak distance (s):', self.mpd_txt)
+        form.addRow('Event baseline (# points):', self.event_bsl_txt)
+        form.addRow('RMS multiplier:', self.rms_txt)
+
+        buttons_layout = QtWidgets.QHBoxLayout()
+        self.run_btn = QtWidgets.QPushButton('Run')
+        self.run_btn.clicked.connect(self.run)
+        self.apply_btn = QtWidgets.QPushButton('Use selected')
+        self.apply_btn.clicked.connect(self.apply_selected)
+        self.copy_btn = QtWidgets.QPushButton('Copy table')
+        self.copy_btn.clicked.connect(self.copy_table)
+        buttons_layout.addWidget(self.run_btn)
+        buttons_layout.addWidget(self.apply_btn)
+        buttons_layout.addWidget(self.copy_btn)
+
+        self.table = QtWidgets.QTableWidget()
+        self.table.setColumnCount(len(sensitivity.SUMMARY_COLUMNS))
+        self.table.setHorizontalHeaderLabels(sensitivity.SUMMARY_COLUMNS)
+        self.table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.itemSelectionChanged.connect(self.plot_selected)
+
+        left_col.addLayout(form)
+        left_col.addLayout(buttons_layout)
+        left_col.addWidget(self.table)
+
+        self.plot = pg.PlotWidget()
+        self.plot.setLabel('bottom', 'Amplitude (pA)')
+        self.plot.setLabel('left', 'Cumulative fraction')
+        self.plot.addLegend()
+
+        layout.addLayout(left_col)
+        layout.addWidget(self.plot)
+
+    def run(self):
+        try:
+            grid = {'smth_by': sensitivity.parse_values(self.smth_txt.text(), int),
+                    'mpd': sensitivity.parse_values(self.mpd_txt.text()),
+                    'event_bsl_window': sensitivity.parse_values(self.event_bsl_txt.text(), int),
+                    'rms_multiple': sensitivity.parse_values(self.rms_txt.text())}
+        except ValueError:
+            self.main.gen_error_mbox('Parameter values must be comma separated numbers')
+            return
+        if not all(grid.values()) or min(grid['smth_by']) < 1:
+            self.main.gen_error_mbox('Every parameter needs at least one valid value')
+            return
+
+        result = self.main.run_parameter_sweep(grid)
+        if result is None:
+            return
+        self.summary, amplitudes = result
+        self.amplitudes = list(amplitudes.values())
+
+        self.table.setRowCount(0)
+        for i, row in enumerate(self.summary.itertuples(index=False)):
+            self.table.insertRow(i)
+            for j, val in enumerate(row):
+                # parameters and event count, then amplitudes
+                item = QtGui.QTableWidgetItem('%g' % val if j < 5 else
+                                              '%0.3f' % val)
+                self.table.setItem(i, j, item)
+        self.plot.clear()
+
+    def selected_rows(self):
+        return sorted({ix.row() for ix in self.table.selectedIndexes()})
+
+    def plot_selected(self):
+        self.plot.clear()
+        for n, row in enumerate(self.selected_rows()):
+            amps = np.sort(self.amplitudes[row])
+            if not len(amps):
+                continue
+            setting = self.summary.iloc[row]
+            name = 'smth %d, mpd %g, bsl %d, rms %g' % tuple(setting[sensitivity.GRID_PARAMS])
+            self.plot.plot(amps, np.arange(1, len(amps)+1) / len(amps),
+                           pen=pg.mkPen(pg.intColor(n), width=1.5*self.main.ratio),
+                           name=name)
+
+    def apply_selected(self):
+        rows = self.selected_rows()
+        if self.summary is None or not rows:
+            return
+        setting = self.summary.iloc[rows[0]]
+        self.main.smth_by = int(setting['smth_by'])
+        self.main.mpd = float(setting['mpd'])
+        self.main.event_bsl_window = int(setting['event_bsl_window'])
+        self.main.rms_multiple = float(setting['rms_multiple'])
+        self.main.update_param_widgets()
+
+    def copy_table(self):
+        if self.summary is not None:
+            self.summary.to_clipboard(index=False)
+
+
+class DataFrameDialog(QtWidgets.QDialog):
+    def __init__(self, parent, title, df):
+        super().__init__(parent)
+        self.df = df
+        self.setWindowTitle(title)
+        self.resize(800*parent.ratio, 500*parent.ratio)
+        layout = QtWidgets.QVBoxLayout(self)
+
+        table = QtWidgets.QTableWidget(len(df), len(df.columns))
+        table.setHorizontalHeaderLabels([str(col) for col in df.columns])
+        table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        for i, row in enumerate(df.itertuples(index=False)):
+            for j, val in enumerate(row):
+                text = val if isinstance(val, str) else "%0.3f" % val
+                table.setItem(i, j, QtGui.QTableWidgetItem(text))
+
+        copy_btn = QtWidgets.QPushButton('Copy')
+        copy_btn.clicked.connect(self.copy)
+        layout.addWidget(table)
+        layout.addWidget(copy_btn)
+
+    def copy(self):
+        self.df.to_clipboard(index=False)
+
 
 class MiniAnalysis(QtWidgets.QMainWindow):
     def __init__(self):
@@ -28,11 +205,19 @@ class MiniAnalysis(QtWidgets.QMainWindow):
         pg.setConfigOption('background', 'w')
         pg.setConfigOption('foreground', 'k')
 
+        self.cell_stores = []
         self.checked = None
+        self.compact = False
         self.counter = 0
         self.data_col = 'primary'
         self.decay_fit = None
         self.decay_x = None
+        self.batch_errors = []
+        self.batch_executor = None
+        self.batch_futures = {}
+        self.batch_params = None
+        self.batch_results = {}
+        self.detect_method = 'Peaks'
         self.detect_start = 0.02
         self.detect_stop = None
         self.detection_plot = None
@@ -52,23 +237,46 @@ class MiniAnalysis(QtWidgets.QMainWindow):
         self.heights = None
         self.indexes = []
         self.item = None
+        self.kinetics = None
+        self.kinetics_window = 0.02
         self.mpd = 0.01
+        self.multi_sweep = False
+        self.nav_range = (0, 1)
+        self.nav_region = None
+        self.nav_syncing = False
+        self.navigator = None
+        self.noise_cache = {}
+        self.noise_mode = 'Fixed region'
+        self.noise_window = 0.5
+        self.online_detector = None
+        self.online_queue = queue.Queue()
+        self.online_source = None
         self.parent_dir = ''
         self.peak_time = None
         self.peak_time_delta = 0.02
         self.points_plot = None
         self.poly_subset = None
         self.poly_order = 1
+        # MinMaxPyramids of the last traces drawn, by data fingerprint
+        self.pyramids = OrderedDict()
+        self.recording = None
+        self.result_cache = result_cache.ResultCache()
         self.rise_fit = None
         self.rms_start = 0
         self.rms_stop = 0.1
         self.rms_multiple = 1
         self.sampling = None
+        self.show_navigator = True
         self.smth_by = 10
+        self.source_path = None
         self.stim_start = 0
         self.sub_trans = True
         self.sweep = None
         self.sweep_median = None
+        self.template = None
+        self.template_decay = 0.004
+        self.template_rise = 0.0005
+        self.template_threshold = 4
         self.tolerance = 20
         self.time = 0
         self.user_a1 = None
@@ -82,6 +290,8 @@ class MiniAnalysis(QtWidgets.QMainWindow):
         self.menubar = self.menuBar()
         self.setup_file_menu()
         self.setup_copy_menu()
+        self.setup_events_menu()
+        self.setup_online_menu()
 
         central_widget = QtWidgets.QWidget()
         self.layout = QtWidgets.QHBoxLayout(central_widget)
@@ -112,7 +322,7 @@ class MiniAnalysis(QtWidgets.QMainWindow):
         self.tab_widget.setMinimumSize(QtCore.QSize(230*self.ratio,
                                                     400*self.ratio))
         self.tab_widget.setMaximumWidth(230*self.ratio)
-        self.tab_widget.setMaximumHeight(500*self.ratio)
+        self.tab_widget.setMaximumHeight(650*self.ratio)
 
         self.tab_widget.addTab(self.create_fit_tab(), "Fit transient")
         self.tab_widget.addTab(self.create_events_tab(), "Detect events")
@@ -134,13 +344,17 @@ class MiniAnalysis(QtWidgets.QMainWindow):
         self.left_col.addLayout(buttons_layout)
 
         self.table = QtWidgets.QTableWidget()
-        self.table.setFixedWidth(150*self.ratio)
-        self.table.setColumnCount(1)
-        self.table.setHorizontalHeaderLabels(['Amplitude (pA)'])
+        self.table.setFixedWidth(500*self.ratio)
+        self.table_headers = ['Amplitude (pA)'] + kinetics.COLUMNS
+        self.table.setColumnCount(len(self.table_headers))
+        self.table.setHorizontalHeaderLabels(self.table_headers)
         header = self.table.horizontalHeader()
-        header.setResizeMode(0, QtGui.QHeaderView.Stretch)
+        for i in range(len(self.table_headers)):
+            header.setResizeMode(i, QtGui.QHeaderView.Stretch)
 
         self.plot_widget = pg.GraphicsLayoutWidget(self)
+        self.plot_grid = plots.PlotGrid(self.plot_widget)
+        self.plot_widget.scene().sigMouseClicked.connect(self.plot_clicked)
 
         self.layout.addLayout(self.left_col)
         self.layout.addWidget(self.plot_widget)
@@ -148,6 +362,14 @@ class MiniAnalysis(QtWidgets.QMainWindow):
 
         self.setCentralWidget(central_widget)
 
+        self.online_timer = QtCore.QTimer(self)
+        self.online_timer.timeout.connect(self.drain_online_events)
+        self.batch_timer = QtCore.QTimer(self)
+        self.batch_timer.timeout.connect(self.collect_batch_results)
+
+        self.profile_window = profile_window.install(self)
+        profiler.listeners.append(self.show_profile)
+
     def setup_file_menu(self):
         file_menu = self.menubar.addMenu('File')
         load_abf_action = QtGui.QAction('Load Axon File', self)
@@ -156,8 +378,23 @@ class MiniAnalysis(QtWidgets.QMainWindow):
         load_pv_action = QtGui.QAction('Load PV folder', self)
         load_pv_action.triggered.connect(self.load_pv)
 
+        compact_action = QtGui.QAction('Compact storage (int16/float32)', self)
+        compact_action.setCheckable(True)
+        compact_action.toggled.connect(self.set_compact)
+
+        save_session_action = QtGui.QAction('Save session', self)
+        save_session_action.triggered.connect(self.save_session)
+
+        open_session_action = QtGui.QAction('Open session', self)
+        open_session_action.triggered.connect(self.open_session)
+
         file_menu.addAction(load_abf_action)
         file_menu.addAction(load_pv_action)
+        file_menu.addSeparator()
+        file_menu.addAction(save_session_action)
+        file_menu.addAction(open_session_action)
+        file_menu.addSeparator()
+        file_menu.addAction(compact_action)
 
     def setup_copy_menu(self):
         copy_menu = self.menubar.addMenu('Copy Data')
@@ -173,6 +410,86 @@ class MiniAnalysis(QtWidgets.QMainWindow):
         copy_menu.addAction(copy_fit)
         copy_menu.addAction(copy_sub)
 
+    def setup_events_menu(self):
+        events_menu = self.menubar.addMenu('Events')
+
+        plot_avg = QtGui.QAction('Plot average event', self)
+        plot_avg.triggered.connect(self.plot_average_event)
+        copy_avg = QtGui.QAction('Copy average event', self)
+        copy_avg.triggered.connect(self.copy_average_event)
+        save_events = QtGui.QAction('Save event waveforms', self)
+        save_events.triggered.connect(self.save_events)
+        add_cell = QtGui.QAction('Add events to cell average', self)
+        add_cell.triggered.connect(self.add_to_cell_average)
+        copy_cell = QtGui.QAction('Copy cell average', self)
+        copy_cell.triggered.connect(self.copy_cell_average)
+        clear_cell = QtGui.QAction('Clear cell average', self)
+        clear_cell.triggered.connect(self.clear_cell_average)
+        param_sweep = QtGui.QAction('Parameter sweep...', self)
+        param_sweep.triggered.connect(self.show_parameter_sweep)
+        multi_sweep = QtGui.QAction('Allow multiple checked sweeps', self)
+        multi_sweep.setCheckable(True)
+        multi_sweep.toggled.connect(self.set_multi_sweep)
+        detect_checked = QtGui.QAction('Detect in checked sweeps', self)
+        detect_checked.triggered.connect(self.run_batch_detection)
+        next_sweep = QtGui.QAction('Next checked sweep', self)
+        next_sweep.setShortcut(QtGui.QKeySequence('Ctrl+PgDown'))
+        next_sweep.triggered.connect(lambda: self.step_checked_sweep(1))
+        prev_sweep = QtGui.QAction('Previous checked sweep', self)
+        prev_sweep.setShortcut(QtGui.QKeySequence('Ctrl+PgUp'))
+        prev_sweep.triggered.connect(lambda: self.step_checked_sweep(-1))
+        show_pooled = QtGui.QAction('Show pooled results', self)
+        show_pooled.triggered.connect(self.show_pooled_results)
+        show_navigator = QtGui.QAction('Sweep navigator', self)
+        show_navigator.setCheckable(True)
+        show_navigator.setChecked(self.show_navigator)
+        show_navigator.toggled.connect(self.set_show_navigator)
+        next_event = QtGui.QAction('Next event', self)
+        next_event.setShortcut(QtGui.QKeySequence('Ctrl+Right'))
+        next_event.triggered.connect(lambda: self.step_event(1))
+        prev_event = QtGui.QAction('Previous event', self)
+        prev_event.setShortcut(QtGui.QKeySequence('Ctrl+Left'))
+        prev_event.triggered.connect(lambda: self.step_event(-1))
+        bypass_cache = QtGui.QAction('Bypass result cache', self)
+        bypass_cache.setCheckable(True)
+        bypass_cache.toggled.connect(self.set_bypass_cache)
+        save_results = QtGui.QAction('Save to results database', self)
+        save_results.triggered.connect(self.save_results)
+
+        events_menu.addAction(plot_avg)
+        events_menu.addAction(copy_avg)
+        events_menu.addAction(save_events)
+        events_menu.addSeparator()
+        events_menu.addAction(add_cell)
+        events_menu.addAction(copy_cell)
+        events_menu.addAction(clear_cell)
+        events_menu.addSeparator()
+        events_menu.addAction(param_sweep)
+        events_menu.addSeparator()
+        events_menu.addAction(multi_sweep)
+        events_menu.addAction(detect_checked)
+        events_menu.addAction(next_sweep)
+        events_menu.addAction(prev_sweep)
+        events_menu.addAction(show_pooled)
+        events_menu.addAction(save_results)
+        events_menu.addSeparator()
+        events_menu.addAction(show_navigator)
+        events_menu.addAction(next_event)
+        events_menu.addAction(prev_event)
+        events_menu.addSeparator()
+        events_menu.addAction(bypass_cache)
+
+    def setup_online_menu(self):
+        online_menu = self.menubar.addMenu('Online')
+
+        start_action = QtGui.QAction('Monitor acquisition file', self)
+        start_action.triggered.connect(self.start_online)
+        stop_action = QtGui.QAction('Stop monitoring', self)
+        stop_action.triggered.connect(self.stop_online)
+
+        online_menu.addAction(start_action)
+        online_menu.addAction(stop_action)
+
     def create_fit_tab(self):
         self.fit_tab = QtWidgets.QWidget()
         self.transient_layout = QtWidgets.QVBoxLayout(self.fit_tab)
@@ -323,6 +640,15 @@ class MiniAnalysis(QtWidgets.QMainWindow):
         self.event_param_title.setAlignment(QtCore.Qt.AlignCenter)
         self.event_param_title.setFixedHeight(30)
 
+        self.method_layout = QtWidgets.QHBoxLayout()
+        self.method_label = QtWidgets.QLabel('Detection method:')
+        self.method_label.setFixedWidth(self.label_width)
+        self.method_combo = QtWidgets.QComboBox()
+        self.method_combo.addItems(['Peaks', 'Template'])
+        self.method_combo.currentIndexChanged.connect(self.update_detect_method)
+        self.method_layout.addWidget(self.method_label)
+        self.method_layout.addWidget(self.method_combo)
+
         self.mpd_layout = QtWidgets.QHBoxLayout()
         self.mpd_label = QtWidgets.QLabel('Min. peak distance (s):')
         self.mpd_label.setFixedWidth(self.label_width)
@@ -367,6 +693,26 @@ class MiniAnalysis(QtWidgets.QMainWindow):
         self.rms_stop_layout.addWidget(self.rms_stop_txt)
         #self.rms_stop_layout.addItem(self.hspacer)
 
+        self.noise_mode_layout = QtWidgets.QHBoxLayout()
+        self.noise_mode_label = QtWidgets.QLabel('Noise estimate:')
+        self.noise_mode_label.setFixedWidth(self.label_width)
+        self.noise_mode_combo = QtWidgets.QComboBox()
+        self.noise_mode_combo.addItems(['Fixed region', 'Rolling RMS', 'Rolling MAD'])
+        self.noise_mode_combo.currentIndexChanged.connect(self.update_noise_mode)
+        self.noise_mode_layout.addWidget(self.noise_mode_label)
+        self.noise_mode_layout.addWidget(self.noise_mode_combo)
+
+        self.noise_window_layout = QtWidgets.QHBoxLayout()
+        self.noise_window_label = QtWidgets.QLabel('Noise window (s):')
+        self.noise_window_label.setFixedWidth(self.label_width)
+        self.noise_window_txt = QtWidgets.QLineEdit('0.5')
+        self.noise_window_txt.setFixedWidth(self.edit_width)
+        self.noise_window_txt.setSizePolicy(self.size_policy)
+        self.noise_window_txt.setEnabled(False)
+        self.noise_window_txt.editingFinished.connect(self.update_noise_window)
+        self.noise_window_layout.addWidget(self.noise_window_label)
+        self.noise_window_layout.addWidget(self.noise_window_txt)
+
         self.start_layout = QtWidgets.QHBoxLayout()
         self.start_label = QtWidgets.QLabel('Detection start (s from peak):')
         self.start_label.setFixedWidth(self.label_width)
@@ -400,6 +746,16 @@ class MiniAnalysis(QtWidgets.QMainWindow):
         self.event_bsl_layout.addWidget(self.event_bsl_txt)
         #self.polyfit_layout.addItem(self.hspacer)
 
+        self.kinetics_layout = QtWidgets.QHBoxLayout()
+        self.kinetics_label = QtWidgets.QLabel('Kinetics window (s after peak):')
+        self.kinetics_label.setFixedWidth(self.label_width)
+        self.kinetics_txt = QtWidgets.QLineEdit('0.02')
+        self.kinetics_txt.setFixedWidth(self.edit_width)
+        self.kinetics_txt.setSizePolicy(self.size_policy)
+        self.kinetics_txt.editingFinished.connect(self.update_kinetics_window)
+        self.kinetics_layout.addWidget(self.kinetics_label)
+        self.kinetics_layout.addWidget(self.kinetics_txt)
+
         self.smth_layout = QtWidgets.QHBoxLayout()
         self.smth_label = QtWidgets.QLabel('Smooth by (# points):')
         self.smth_label.setFixedWidth(self.label_width)
@@ -422,6 +778,45 @@ class MiniAnalysis(QtWidgets.QMainWindow):
         self.tolerance_layout.addWidget(self.tolerance_txt)
         #self.tolerance_layout.addItem(self.hspacer)
 
+        self.template_rise_layout = QtWidgets.QHBoxLayout()
+        self.template_rise_label = QtWidgets.QLabel('Template rise tau (s):')
+        self.template_rise_label.setFixedWidth(self.label_width)
+        self.template_rise_txt = QtWidgets.QLineEdit('0.0005')
+        self.template_rise_txt.setFixedWidth(self.edit_width)
+        self.template_rise_txt.setSizePolicy(self.size_policy)
+        self.template_rise_txt.editingFinished.connect(self.update_template_rise)
+        self.template_rise_layout.addWidget(self.template_rise_label)
+        self.template_rise_layout.addWidget(self.template_rise_txt)
+
+        self.template_decay_layout = QtWidgets.QHBoxLayout()
+        self.template_decay_label = QtWidgets.QLabel('Template decay tau (s):')
+        self.template_decay_label.setFixedWidth(self.label_width)
+        self.template_decay_txt = QtWidgets.QLineEdit('0.004')
+        self.template_decay_txt.setFixedWidth(self.edit_width)
+        self.template_decay_txt.setSizePolicy(self.size_policy)
+        self.template_decay_txt.editingFinished.connect(self.update_template_decay)
+        self.template_decay_layout.addWidget(self.template_decay_label)
+        self.template_decay_layout.addWidget(self.template_decay_txt)
+
+        self.template_thresh_layout = QtWidgets.QHBoxLayout()
+        self.template_thresh_label = QtWidgets.QLabel('Template criterion threshold:')
+        self.template_thresh_label.setFixedWidth(self.label_width)
+        self.template_thresh_txt = QtWidgets.QLineEdit('4')
+        self.template_thresh_txt.setFixedWidth(self.edit_width)
+        self.template_thresh_txt.setSizePolicy(self.size_policy)
+        self.template_thresh_txt.editingFinished.connect(self.update_template_threshold)
+        self.template_thresh_layout.addWidget(self.template_thresh_label)
+        self.template_thresh_layout.addWidget(self.template_thresh_txt)
+
+        template_buttons_layout = QtWidgets.QHBoxLayout()
+        self.template_btn = QtWidgets.QPushButton('Template from events')
+        self.template_btn.clicked.connect(self.make_template)
+        self.template_reset_btn = QtWidgets.QPushButton('Reset template')
+        self.template_reset_btn.clicked.connect(self.reset_template)
+        template_buttons_layout.addWidget(self.template_btn)
+        template_buttons_layout.addWidget(self.template_reset_btn)
+        self.update_detect_method()
+
         buttons_layout = QtWidgets.QHBoxLayout()
         self.detect_btn = QtWidgets.QPushButton('Run detection')
         self.detect_btn.clicked.connect(self.run_detection)
@@ -431,15 +826,23 @@ class MiniAnalysis(QtWidgets.QMainWindow):
         buttons_layout.addWidget(self.num_btn)
 
         self.event_param_layout.addWidget(self.event_param_title)
+        self.event_param_layout.addLayout(self.method_layout)
         self.event_param_layout.addLayout(self.mpd_layout)
         self.event_param_layout.addLayout(self.rms_layout)
         self.event_param_layout.addLayout(self.rms_start_layout)
         self.event_param_layout.addLayout(self.rms_stop_layout)
+        self.event_param_layout.addLayout(self.noise_mode_layout)
+        self.event_param_layout.addLayout(self.noise_window_layout)
         self.event_param_layout.addLayout(self.start_layout)
         self.event_param_layout.addLayout(self.stop_layout)
         self.event_param_layout.addLayout(self.event_bsl_layout)
+        self.event_param_layout.addLayout(self.kinetics_layout)
         self.event_param_layout.addLayout(self.smth_layout)
         self.event_param_layout.addLayout(self.tolerance_layout)
+        self.event_param_layout.addLayout(self.template_rise_layout)
+        self.event_param_layout.addLayout(self.template_decay_layout)
+        self.event_param_layout.addLayout(self.template_thresh_layout)
+        self.event_param_layout.addLayout(template_buttons_layout)
         self.event_param_layout.addLayout(buttons_layout)
         self.event_param_layout.addItem(self.vspacer)
 
@@ -451,29 +854,385 @@ class MiniAnalysis(QtWidgets.QMainWindow):
                                                     , self.parent_dir)[0]
         self.parent_dir = os.path.dirname(abf_file)
         if os.path.splitext(abf_file)[-1] == '.abf':
-            self.df = abf.read_abf(abf_file)
-            self.update_tree(abf_file)
+            self.open_abf(abf_file)
         elif any(abf_file):
             self.gen_error_mbox('Invalid file')
 
+    def open_abf(self, abf_file):
+        try:
+            # header only, sweeps are decoded when they are checked
+            with profiler.stage('load_abf'):
+                recording = lazy_abf.LazyABF(abf_file, compact=self.compact)
+        except (ValueError, OSError, struct.error):
+            recording = None
+        if recording is not None:
+            self.close_recording()
+            self.recording = recording
+            self.df = None
+        else:
+            with profiler.stage('load_abf'):
+                self.set_data(abf.read_abf(abf_file))
+        self.source_path = abf_file
+        self.update_tree(abf_file)
+
     def load_pv(self):
         folder = QtGui.QFileDialog().getExistingDirectory(self,
                                                           "Select PV data folder",
                                                           self.parent_dir)
         self.parent_dir = os.path.dirname(folder)
-        data_dict = rpv.import_folder(folder)
-        if data_dict['voltage recording'] is None:
+        if not self.open_pv(folder):
             message = 'Folder does not contain necessary data'
             self.gen_error_mbox(message)
+
+    def open_pv(self, folder):
+        with profiler.stage('import_folder'):
+            data_dict = rpv.import_folder(folder)
+        if data_dict['voltage recording'] is None:
+            return False
+        self.set_data(data_dict['voltage recording'])
+        self.source_path = folder
+        self.update_tree(folder)
+        return True
+
+    def fit_sliders(self):
+        # same order as popt
+        return [self.a1_slider, self.tau1_slider, self.a2_slider,
+                self.tau2_slider, self.c_slider]
+
+    def save_session(self):
+        if self.sweep is None:
+            self.gen_error_mbox('No sweep to save')
+            return
+        path = QtWidgets.QFileDialog.getSaveFileName(self
+                                                     , 'Save session'
+                                                     , self.parent_dir
+                                                     , 'pyminis session (*.npz)')[0]
+        if not any(path):
+            return
+
+        params = {name: getattr(self, name) for name in SESSION_PARAMS}
+        params.update({'source': self.source_path,
+                       'sweep': self.checked.text(0),
+                       'data_col': self.data_col,
+                       'peak_ix': getattr(self, 'peak_ix', None),
+                       'peak_time': self.peak_time,
+                       'fit_start_ix': self.fit_start_ix})
+        arrays = {'template': self.template}
+        if self.fit_a1 is not None and 'fit' in self.sweep.columns:
+            arrays['popt'] = [self.fit_a1, self.fit_tau1, self.fit_a2,
+                              self.fit_tau2, self.fit_c]
+            arrays['slider_positions'] = [s.sliderPosition()
+                                          for s in self.fit_sliders()]
+            arrays['fit_x'] = self.fit_x
+        if self.detection_plot is not None:
+            arrays['indexes'] = np.array(self.indexes, dtype='int64')
+        if self.heights is not None:
+            arrays['heights'] = self.heights
+            arrays['kinetics'] = self.kinetics.values
+        try:
+            session.save_session(path, params, arrays, self.sweep)
+        except (OSError, ValueError, TypeError) as err:
+            self.gen_error_mbox('Could not save session\n%s' % err)
+
+    def open_session(self):
+        path = QtWidgets.QFileDialog.getOpenFileName(self
+                                                     , 'Open session'
+                                                     , self.parent_dir
+                                                     , 'pyminis session (*.npz)')[0]
+        if not any(path):
+            return
+        try:
+            params, arrays, columns = session.load_session(path)
+        except (OSError, ValueError, KeyError) as err:
+            self.gen_error_mbox('Could not open session\n%s' % err)
+            return
+
+        self.parent_dir = os.path.dirname(path)
+        self.restore_recording(params['source'], params['sweep'], columns, path)
+
+        # change_transient resets detection start, so it goes first
+        self.transient_checkbox.setChecked(params['sub_trans'])
+        for name in SESSION_PARAMS:
+            setattr(self, name, params[name])
+        self.template = arrays.get('template')
+        self.update_param_widgets()
+
+        self.sweep = pd.DataFrame(columns)
+        self.sampling = 1/(self.sweep.time.iloc[1]-self.sweep.time.iloc[0])
+        self.noise_cache = {}
+        self.clear_all()
+
+        xlink = None
+        if 'popt' in arrays:
+            self.fit_x = arrays['fit_x']
+            self.peak_ix = params['peak_ix']
+            self.peak_time = params['peak_time']
+            self.fit_start_ix = params['fit_start_ix']
+            xlink = self.plot_fit()
+            # slider moves re-derive the user adjusted fit from popt
+            self.set_fit_params(arrays['popt'])
+            for slider, pos in zip(self.fit_sliders(),
+                                   arrays['slider_positions']):
+                slider.setSliderPosition(int(pos))
+        if params['data_col'] in self.sweep.columns:
+            self.data_col = params['data_col']
+
+        if 'indexes' in arrays:
+            self.indexes = arrays['indexes'].tolist()
+            self.plot_detected_events(xlink=xlink)
+        elif xlink is None:
+            self.plot_sweep_basic()
+
+        if 'heights' in arrays:
+            self.heights = arrays['heights']
+            self.kinetics = pd.DataFrame(arrays['kinetics'],
+                                         columns=kinetics.COLUMNS)
+            self.fill_table()
+
+    def restore_recording(self, source, name, columns, path):
+        opened = False
+        if source and os.path.isfile(source):
+            self.open_abf(source)
+            opened = True
+        elif source and os.path.isdir(source):
+            opened = self.open_pv(source)
+
+        if opened and name in self.sweep_names():
+            item = self.tree_widget.findItems(name, QtCore.Qt.MatchExactly)[0]
+            item.setCheckState(0, QtCore.Qt.Checked)
+            return
+
+        # source moved or deleted, the session's copy of the sweep stands in
+        raw = pd.DataFrame(OrderedDict([('time', columns['time']),
+                                        ('primary', columns['primary'])]))
+        self.set_data(pd.concat({name: raw}))
+        self.source_path = None
+        self.update_tree(path)
+
+    def update_param_widgets(self):
+        edits = {'stim_start': self.stim_txt,
+                 'peak_time_delta': self.peak_txt,
+                 'end_fit': self.end_fit_txt,
+                 'mpd': self.mpd_txt,
+                 'rms_multiple': self.rms_val_txt,
+                 'rms_start': self.rms_start_txt,
+                 'rms_stop': self.rms_stop_txt,
+                 'noise_window': self.noise_window_txt,
+                 'detect_start': self.start_txt,
+                 'detect_stop': self.stop_txt,
+                 'event_bsl_window': self.event_bsl_txt,
+                 'kinetics_window': self.kinetics_txt,
+                 'smth_by': self.smth_txt,
+                 'tolerance': self.tolerance_txt,
+                 'template_rise': self.template_rise_txt,
+                 'template_decay': self.template_decay_txt,
+                 'template_threshold': self.template_thresh_txt}
+        for name, edit in edits.items():
+            val = getattr(self, name)
+            edit.setText('' if val is None else str(val))
+
+        self.method_combo.setCurrentText(self.detect_method)
+        self.noise_mode_combo.setCurrentText(self.noise_mode)
+        self.update_detect_method()
+        self.update_noise_mode()
+
+    def set_compact(self, checked):
+        # applies to the next file loaded
+        self.compact = checked
+
+    def close_recording(self):
+        if isinstance(self.recording, lazy_abf.LazyABF):
+            self.recording.close()
+        self.recording = None
+
+    def set_data(self, df):
+        self.close_recording()
+        if self.compact:
+            self.recording = compact.CompactRecording.from_frame(df)
+            self.df = None
         else:
-            self.df = data_dict['voltage recording']
-            self.update_tree(folder)
+            self.recording = None
+            self.df = df
+
+    def sweep_names(self):
+        if self.recording is not None:
+            return self.recording.sweeps
+        return self.df.index.levels[0]
+
+    def load_sweep(self, name):
+        with profiler.stage('load_sweep'):
+            if self.recording is not None:
+                return self.recording.frame(name)
+            return self.df.loc[name]
+
+    def show_profile(self, prof):
+        self.statusBar().showMessage(prof.summary())
+
+    def start_online(self):
+        raw_file = QtWidgets.QFileDialog.getOpenFileName(self
+                                                    , 'Select raw float32 acquisition file'
+                                                    , self.parent_dir)[0]
+        if not any(raw_file):
+            return
+        sampling, ok = QtWidgets.QInputDialog.getDouble(self, 'Sampling rate'
+                                                        , 'Sampling rate (Hz):'
+                                                        , 20000, 1, 1e6, 1)
+        if not ok:
+            return
+
+        self.stop_online()
+        self.clear_all()
+        self.online_detector = stream.OnlineDetector(sampling
+                                                     , smth_by=self.smth_by
+                                                     , mpd=self.mpd
+                                                     , rms_multiple=self.rms_multiple
+                                                     , event_bsl_window=self.event_bsl_window
+                                                     , rms_window=self.rms_stop-self.rms_start)
+        self.online_detector.subscribe(self.online_queue.put)
+        self.online_source = stream.FileTailSource(raw_file)
+        thread = threading.Thread(target=self.online_detector.run
+                                  , args=(self.online_source,)
+                                  , daemon=True)
+        thread.start()
+        self.online_timer.start(100)
+
+    def stop_online(self):
+        if self.online_source is not None:
+            self.online_source.stop()
+            self.online_source = None
+        self.online_timer.stop()
+        self.drain_online_events()
+
+    def drain_online_events(self):
+        while True:
+            try:
+                event = self.online_queue.get_nowait()
+            except queue.Empty:
+                break
+            row = self.table.rowCount()
+            self.table.insertRow(row)
+            item = QtGui.QTableWidgetItem("%0.3f" % event.amplitude)
+            item.setToolTip('%0.4f s' % event.time)
+            self.table.setItem(row, 0, item)
+
+        if self.online_detector is not None:
+            stats = self.online_detector.latency_stats()
+            if stats is not None:
+                self.statusBar().showMessage('Events: %d, block latency %0.2f ms '
+                                             '(max %0.2f ms)'
+                                             % (len(self.online_detector.events)
+                                                , stats['mean (ms)']
+                                                , stats['max (ms)']))
 
     def copy_calc_vals(self):
         if self.heights is not None:
             df = pd.DataFrame({'Amplitude (pA)': self.heights})
+            if self.kinetics is not None:
+                df = pd.concat([df, self.kinetics], axis=1)
+            df.to_clipboard(index=False)
+
+    def get_event_store(self):
+        if self.sweep is None or not any(self.indexes):
+            return None
+        label = self.checked.text(0) if self.checked is not None else ''
+        return events.EventStore.from_sweep(self.sweep[self.data_col].values,
+                                            sorted(self.indexes),
+                                            2 * self.event_bsl_window,
+                                            int(self.kinetics_window * self.sampling),
+                                            self.sampling, label)
+
+    def plot_average_event(self):
+        store = self.get_event_store()
+        if store is None:
+            return
+        plot = self.plot_grid.plot(self.counter, 0, enableMenu=False)
+        self.plot_grid.curve(plot, 'average', store.time,
+                             store.average(aligned=True),
+                             pen=pg.mkPen('r', width=1.5*self.ratio))
+        plot.setTitle('Average of %d events' % len(store))
+        self.counter += 1
+
+    def copy_average_event(self):
+        store = self.get_event_store()
+        if store is not None:
+            df = pd.DataFrame({'time': store.time,
+                               'average': store.average(aligned=True)})
             df.to_clipboard(index=False)
 
+    def save_events(self):
+        store = self.get_event_store()
+        if store is None:
+            return
+        path = QtWidgets.QFileDialog.getSaveFileName(self
+                                                     , 'Save event waveforms'
+                                                     , self.parent_dir)[0]
+        if any(path):
+            store.save(os.path.splitext(path)[0])
+
+    def add_to_cell_average(self):
+        store = self.get_event_store()
+        if store is not None:
+            self.cell_stores.append(store)
+            n = sum(len(s) for s in self.cell_stores)
+            self.statusBar().showMessage('Cell average: %d events from %d sweeps'
+                                         % (n, len(self.cell_stores)))
+
+    def copy_cell_average(self):
+        try:
+            avg = events.cell_average(self.cell_stores, aligned=True)
+        except ValueError as e:
+            self.gen_error_mbox(str(e))
+            return
+        if avg is not None:
+            df = pd.DataFrame({'time': self.cell_stores[0].time,
+                               'average': avg})
+            df.to_clipboard(index=False)
+
+    def clear_cell_average(self):
+        self.cell_stores = []
+        self.statusBar().clearMessage()
+
+    def show_parameter_sweep(self):
+        dialog = ParameterSweepDialog(self)
+        dialog.show()
+
+    def run_parameter_sweep(self, grid):
+        if self.sweep is None:
+            self.gen_error_mbox('No sweep selected')
+            return None
+        if self.sub_trans:
+            if 'fit' not in self.sweep.columns:
+                self.gen_error_mbox('Fit the transient before running a parameter sweep')
+                return None
+            values = (self.sweep.primary - self.sweep.fit).values
+        else:
+            values = self.sweep.primary.values
+
+        # the sweep index is positional, so regions are index ranges
+        subset = self.gen_subset()
+        if not len(subset):
+            self.gen_error_mbox('No data points in detection region')
+            return None
+        detect_region = (subset.index[0], subset.index[-1] + 1)
+        sweep_time = self.sweep.time.values
+        rms_region = (np.searchsorted(sweep_time, self.rms_start),
+                      np.searchsorted(sweep_time, self.rms_stop, 'right'))
+        if self.noise_mode == 'Fixed region' and rms_region[0] >= rms_region[1]:
+            message = 'No data points in RMS region. Check start and stop times'
+            self.gen_error_mbox(message)
+            return None
+
+        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
+        try:
+            return sensitivity.parameter_grid(values, self.sampling,
+                                              detect_region=detect_region,
+                                              rms_region=rms_region,
+                                              noise_mode=self.noise_mode,
+                                              noise_window=int(self.noise_window*self.sampling),
+                                              **grid)
+        finally:
+            QtWidgets.QApplication.restoreOverrideCursor()
+
     def copy_fit(self):
         if self.sweep is not None and 'fit' in self.sweep.columns:
             self.sweep[['time', 'fit']].to_clipboard(index=False)
@@ -483,10 +1242,14 @@ class MiniAnalysis(QtWidgets.QMainWindow):
             self.sweep[['time', 'subtraction']].to_clipboard(index=False)
 
     def update_tree(self, path):
+        self.cancel_batch()
+        self.batch_results = {}
+        self.checked = None
         self.tree_widget.clear()
+        self.noise_cache = {}
         self.tree_widget.headerItem().setText(0, os.path.split(path)[-1])
         self.tree_widget.headerItem().setToolTip(0, path)
-        sweeps = self.df.index.levels[0]
+        sweeps = self.sweep_names()
 
         for sweep in sweeps:
             sweep_item = QtWidgets.QTreeWidgetItem(self.tree_widget)
@@ -500,21 +1263,216 @@ class MiniAnalysis(QtWidgets.QMainWindow):
 
     def update_checked(self, item):
         if item.checkState(0) == QtCore.Qt.Checked:
-            if self.checked is None:
-                self.checked = item
-                self.sweep = self.df.loc[item.text(0)]
-                self.sampling = 1/(self.sweep.time.iloc[1]-
-                                   self.sweep.time.iloc[0])
-            else:
+            if self.checked is not None and not self.multi_sweep:
                 self.checked.setCheckState(0, QtCore.Qt.Unchecked)
-                self.checked = item
-                self.sweep = self.df.loc[item.text(0)]
-                self.sampling = 1/(self.sweep.time.iloc[1]-
-                                   self.sweep.time.iloc[0])
-        else:
+            self.show_sweep(item)
+        elif item is self.checked:
+            self.store_batch_edits()
             self.checked = None
             self.sweep = None
 
+    def show_sweep(self, item):
+        self.store_batch_edits()
+        self.checked = item
+        self.sweep = self.load_sweep(item.text(0))
+        self.sampling = 1/(self.sweep.time.iloc[1]-
+                           self.sweep.time.iloc[0])
+        if item.text(0) in self.batch_results:
+            self.show_batch_result(item.text(0))
+
+    def set_multi_sweep(self, checked):
+        self.multi_sweep = checked
+        if not checked and self.checked is not None:
+            # back to a single checked sweep, the current one
+            for item in self.checked_items():
+                if item is not self.checked:
+                    item.setCheckState(0, QtCore.Qt.Unchecked)
+
+    def checked_items(self):
+        items = [self.tree_widget.topLevelItem(i)
+                 for i in range(self.tree_widget.topLevelItemCount())]
+        return [item for item in items
+                if item.checkState(0) == QtCore.Qt.Checked]
+
+    def step_checked_sweep(self, step):
+        items = self.checked_items()
+        if self.checked is None or self.checked not in items or len(items) < 2:
+            return
+        i = (items.index(self.checked) + step) % len(items)
+        self.show_sweep(items[i])
+
+    def detection_params(self):
+        return {name: getattr(self, name) for name in SESSION_PARAMS}
+
+    def run_batch_detection(self):
+        items = self.checked_items()
+        if not items:
+            self.gen_error_mbox('No sweeps checked')
+            return
+        self.cancel_batch()
+        self.store_batch_edits()
+        self.batch_params = self.detection_params()
+        self.batch_results = {}
+        self.batch_errors = []
+        template = None
+        if self.detect_method == 'Template':
+            if self.sampling is None:
+                self.gen_error_mbox('Check a sweep to set up the template')
+                return
+            template = self.get_template()
+
+        # fresh interpreters: a fork of the running Qt process can deadlock
+        self.batch_executor = ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context('spawn'))
+        for item in items:
+            name = item.text(0)
+            frame = self.load_sweep(name)
+            block = shared.share((frame.time.values, frame.primary.values))
+            future = self.batch_executor.submit(shared.call, batch.detect_shared,
+                                                block.ref, name,
+                                                self.batch_params, template)
+            # unlinked when the sweep is done, failed or cancelled
+            future.add_done_callback(block.release)
+            self.batch_futures[future] = name
+        self.statusBar().showMessage('Detecting events in %d sweeps' % len(items))
+        self.batch_timer.start(100)
+
+    def collect_batch_results(self):
+        done = [future for future in self.batch_futures if future.done()]
+        for future in done:
+            name = self.batch_futures.pop(future)
+            try:
+                self.batch_results[name] = future.result()
+            except Exception as err:
+                self.batch_errors.append('%s: %s' % (name, err))
+                continue
+            if self.checked is not None and self.checked.text(0) == name:
+                self.show_batch_result(name)
+
+        total = len(self.batch_results) + len(self.batch_futures)
+        self.statusBar().showMessage('Detected events in %d of %d sweeps'
+                                     % (len(self.batch_results), total))
+        if not self.batch_futures:
+            self.cancel_batch()
+            # once, with the timer stopped: a modal box would run the timer
+            # and this method again under it
+            if self.batch_errors:
+                errors, self.batch_errors = self.batch_errors, []
+                self.gen_error_mbox('Detection failed for\n' + '\n'.join(errors))
+        elif self.batch_errors:
+            self.statusBar().showMessage('Detected events in %d of %d sweeps, '
+                                         '%d failed' % (len(self.batch_results),
+                                                        total, len(self.batch_errors)))
+
+    def cancel_batch(self):
+        self.batch_timer.stop()
+        for future in self.batch_futures:
+            future.cancel()
+        self.batch_futures = {}
+        if self.batch_executor is not None:
+            self.batch_executor.shutdown(wait=False)
+            self.batch_executor = None
+
+    def show_batch_result(self, name):
+        result = self.batch_results[name]
+        columns = batch.sweep_columns(self.sweep.time.values,
+                                      self.sweep.primary.values,
+                                      self.batch_params, result)
+        for col, vals in columns.items():
+            self.sweep[col] = vals
+        self.noise_cache = {}
+        self.clear_all()
+
+        xlink = None
+        if 'fit' in columns:
+            self.peak_ix = result['peak_ix']
+            self.peak_time = result['peak_time']
+            xlink = self.plot_fit()
+            # what fit_transient sets, for the fit sliders
+            times = self.sweep.time.values
+            fit_ixs = np.flatnonzero((times >= times[self.peak_ix]) &
+                                     (times <= self.batch_params['end_fit']))
+            self.fit_start_ix = self.sweep.index.values[fit_ixs[0]]
+            self.fit_x = (times[fit_ixs] - times[fit_ixs[0]]) * 1e3
+            self.fit_vals = batch.biexp_decay(self.fit_x, *result['popt'])
+            self.set_fit_params(result['popt'])
+        self.data_col = 'smthd'
+        self.indexes = result['indexes'].tolist()
+        self.plot_detected_events(xlink=xlink)
+        self.heights = result['heights']
+        self.kinetics = result['kinetics']
+        self.fill_table()
+        if self.batch_params != self.detection_params():
+            self.statusBar().showMessage('%s: detected with earlier parameters' % name)
+
+    def store_batch_edits(self):
+        # keep points added or removed by hand on a batch detected sweep
+        if self.checked is None or self.sweep is None:
+            return
+        result = self.batch_results.get(self.checked.text(0))
+        if result is None or self.detection_plot is None:
+            return
+        indexes = sorted(self.indexes)
+        if indexes != result['indexes'].tolist():
+            self.indexes = indexes
+            result['indexes'] = np.array(indexes, dtype='int64')
+            result['times'] = self.sweep.time.values[result['indexes']]
+            result['heights'] = self.get_heights()
+            result['kinetics'] = self.get_kinetics()
+
+    def pooled_results(self):
+        self.store_batch_edits()
+        names = [self.tree_widget.topLevelItem(i).text(0)
+                 for i in range(self.tree_widget.topLevelItemCount())]
+        return batch.pooled_results([self.batch_results[name] for name in names
+                                     if name in self.batch_results])
+
+    def show_pooled_results(self):
+        if not self.batch_results:
+            self.gen_error_mbox('Run "Detect in checked sweeps" first')
+            return
+        dialog = DataFrameDialog(self, 'Pooled events', self.pooled_results())
+        dialog.show()
+
+    def save_results(self):
+        """The pooled events of the checked sweeps after a batch detection,
+        otherwise the events of the sweep on display."""
+        if self.batch_results:
+            df = self.pooled_results()
+            params = self.batch_params
+            # sweeps left without events replace their old rows too
+            sweeps = list(self.batch_results)
+        elif self.heights is not None and self.checked is not None:
+            # events added or removed since Calc vals have no heights yet
+            self.calc_vals()
+            if len(self.heights) != len(self.indexes) or (
+                    self.kinetics is not None and
+                    len(self.kinetics) != len(self.indexes)):
+                self.gen_error_mbox('The calculated values do not match the '
+                                    'events, nothing was saved')
+                return
+            df = pd.DataFrame({'Sweep': self.checked.text(0),
+                               'Time (s)': self.sweep.time.values[self.indexes],
+                               'Amplitude (pA)': self.heights})
+            if self.kinetics is not None:
+                df = pd.concat([df, self.kinetics], axis=1)
+            params = self.detection_params()
+            sweeps = [self.checked.text(0)]
+        else:
+            self.gen_error_mbox('No events to save')
+            return
+        if self.source_path is None:
+            self.gen_error_mbox('The recording of this session was not found')
+            return
+        try:
+            results.save('pyminis', self.source_path,
+                         dict(batch.DEFAULTS, **params), df, sweeps=sweeps)
+        except results.ERRORS as err:
+            self.gen_error_mbox('Could not save results: %s' % err)
+            return
+        self.statusBar().showMessage('%d events saved to %s'
+                                     % (len(df), results.DEFAULT_PATH))
+
     def update_stim_time(self):
         new_val = self.stim_txt.text()
         try:
@@ -602,6 +1560,109 @@ class MiniAnalysis(QtWidgets.QMainWindow):
             message = 'RMS region stop time must be >=0'
             self.gen_error_mbox(message)
 
+    def update_kinetics_window(self):
+        try:
+            new_val = float(self.kinetics_txt.text())
+            if new_val <= 0:
+                message = 'Kinetics window must be > 0'
+                self.gen_error_mbox(message)
+            else:
+                self.kinetics_window = new_val
+        except ValueError:
+            message = 'Kinetics window must be > 0'
+            self.gen_error_mbox(message)
+
+    def update_detect_method(self):
+        self.detect_method = self.method_combo.currentText()
+        template = self.detect_method == 'Template'
+        self.template_rise_txt.setEnabled(template and self.template is None)
+        self.template_decay_txt.setEnabled(template and self.template is None)
+        self.template_thresh_txt.setEnabled(template)
+        self.template_btn.setEnabled(template)
+        self.template_reset_btn.setEnabled(template)
+
+    def update_template_rise(self):
+        try:
+            new_val = float(self.template_rise_txt.text())
+            if new_val <= 0:
+                message = 'Template rise tau must be > 0'
+                self.gen_error_mbox(message)
+            else:
+                self.template_rise = new_val
+        except ValueError:
+            message = 'Template rise tau must be > 0'
+            self.gen_error_mbox(message)
+
+    def update_template_decay(self):
+        try:
+            new_val = float(self.template_decay_txt.text())
+            if new_val <= 0:
+                message = 'Template decay tau must be > 0'
+                self.gen_error_mbox(message)
+            else:
+                self.template_decay = new_val
+        except ValueError:
+            message = 'Template decay tau must be > 0'
+            self.gen_error_mbox(message)
+
+    def update_template_threshold(self):
+        try:
+            new_val = float(self.template_thresh_txt.text())
+            if new_val <= 0:
+                message = 'Template criterion threshold must be > 0'
+                self.gen_error_mbox(message)
+            else:
+                self.template_threshold = new_val
+        except ValueError:
+            message = 'Template criterion threshold must be > 0'
+            self.gen_error_mbox(message)
+
+    def make_template(self):
+        if self.sweep is None or not any(self.indexes):
+            self.gen_error_mbox('Detect and curate events first')
+            return
+        post = int((self.template_rise + 5*self.template_decay) * self.sampling)
+        try:
+            self.template = detection.template_from_events(self.sweep[self.data_col].values,
+                                                           self.indexes,
+                                                           self.event_bsl_window,
+                                                           post)
+        except ValueError as e:
+            self.gen_error_mbox(str(e))
+            return
+        self.template_btn.setText('Template (n=%d)' % len(self.indexes))
+        self.update_detect_method()
+
+    def reset_template(self):
+        self.template = None
+        self.template_btn.setText('Template from events')
+        self.update_detect_method()
+
+    def get_template(self):
+        if self.template is not None:
+            return self.template
+        return detection.biexp_template(self.sampling, self.template_rise,
+                                        self.template_decay)
+
+    def update_noise_mode(self):
+        self.noise_mode = self.noise_mode_combo.currentText()
+        fixed = self.noise_mode == 'Fixed region'
+        self.rms_start_txt.setEnabled(fixed)
+        self.rms_stop_txt.setEnabled(fixed)
+        self.noise_window_txt.setEnabled(not fixed)
+
+    def update_noise_window(self):
+        try:
+            new_val = float(self.noise_window_txt.text())
+            if new_val <= 0:
+                message = 'Noise window must be > 0'
+                self.gen_error_mbox(message)
+            else:
+                self.noise_window = new_val
+        except ValueError:
+            message = 'Noise window must be > 0'
+            self.gen_error_mbox(message)
+
     def update_start(self):
         new_val = self.start_txt.text()
         try:
@@ -675,9 +1736,13 @@ class MiniAnalysis(QtWidgets.QMainWindow):
             self.gen_error_mbox(message)
 
     def fit_and_plot(self):
-        self.clear_all()
-        self.gen_fit()
-        self.plot_fit()
+        with profiler.stage('fit_and_plot'):
+            with profiler.stage('clear_plots'):
+                self.clear_all()
+            with profiler.stage('fit'):
+                self.gen_fit()
+            with profiler.stage('plot_fit'):
+                self.plot_fit()
 
     def set_fit_params(self, popt):
         self.fit_a1 = popt[0]
@@ -780,14 +1845,15 @@ class MiniAnalysis(QtWidgets.QMainWindow):
 
     def plot_sweep_basic(self):
         if self.sweep is not None:
-            plot = self.plot_widget.addPlot(self.counter, 0, enableMenu=False)
-            plot.plot(self.sweep.time, self.sweep.primary, pen='b')
+            plot = self.plot_grid.plot(self.counter, 0, enableMenu=False)
+            self.plot_grid.curve(plot, 'data', self.sweep.time.values,
+                                 self.sweep.primary.values, pen='b')
             self.counter += 1
 
             return plot
 
     def clear_all(self):
-        self.plot_widget.clear()
+        self.plot_grid.clear()
         self.table.setRowCount(0)
 
         self.counter = 0
@@ -796,6 +1862,8 @@ class MiniAnalysis(QtWidgets.QMainWindow):
         self.fit_plot = None
         self.heights = None
         self.indexes = []
+        self.kinetics = None
+        self.navigator = None
         #self.peak_time = None
         self.plots = []
         self.points = {}
@@ -805,7 +1873,10 @@ class MiniAnalysis(QtWidgets.QMainWindow):
     def auto_plots(self):
         if self.counter > 0:
             for i in range(self.counter):
-                self.plot_widget.getItem(i, 0).autoRange()
+                # a hidden navigator leaves its row empty
+                plot = self.plot_widget.getItem(i, 0)
+                if plot is not None:
+                    plot.autoRange()
 
     def gen_fit(self):
         mask = ((self.sweep.time >= self.stim_start) &
@@ -847,8 +1918,9 @@ class MiniAnalysis(QtWidgets.QMainWindow):
 
     def plot_fit(self):
         plot1 = self.plot_sweep_basic()
-        self.fit_plot = plot1.plot(self.sweep.time, self.sweep.fit,
-                                   pen=pg.mkPen('r', width=1.5*self.ratio))
+        self.fit_plot = self.plot_grid.curve(plot1, 'fit', self.sweep.time.values,
+                                             self.sweep.fit.values,
+                                             pen=pg.mkPen('r', width=1.5*self.ratio))
 
         return plot1
 
@@ -872,83 +1944,283 @@ class MiniAnalysis(QtWidgets.QMainWindow):
     def get_event_ixs(self, subset):
         mpd_points = int(self.mpd * self.sampling)
         smthd = subset['smthd'].values
-        ixs = pace.detect_peaks(smthd, mpd=mpd_points, valley=True)
+        if self.detect_method == 'Template':
+            template = self.get_template()
+            with profiler.stage('template_criterion'):
+                criterion = detection.scaled_template_criterion(smthd, template)
+            with profiler.stage('detect_peaks'):
+                starts = peaks.detect_peaks(criterion, mph=self.template_threshold,
+                                            mpd=mpd_points)
+                ixs = np.unique(detection.template_valleys(smthd, starts, template))
+        else:
+            with profiler.stage('detect_peaks'):
+                ixs = peaks.detect_peaks(smthd, mpd=mpd_points, valley=True)
         self.indexes = subset.index.values[ixs].tolist()
-        self.check_height()
+        with profiler.stage('check_height'):
+            self.check_height()
 
     def plot_detected_events(self, subtraction=True, xlink=None):
-        self.detection_plot = self.plot_widget.addPlot(self.counter
-                                                       , 0
-                                                       , enableMenu=False)
-        x = self.sweep.time.values
-        y = self.sweep[self.data_col]
-        self.detection_plot.plot(x, y, pen='b', name='data')
-        self.detection_plot.scene().sigMouseClicked.connect(self.plot_clicked)
-        if xlink is not None:
-            self.detection_plot.setXLink(xlink)
+        # plots and curves are reused, so their signals are connected once:
+        # the scene's mouse clicks in __init__, the points' when made
+        self.detection_plot = self.plot_grid.plot(self.counter
+                                                  , 0
+                                                  , enableMenu=False)
+        # the trace is drawn from its min/max pyramid, only the visible part
+        # at the resolution of the screen
+        levels = self.get_pyramid(self.sweep[self.data_col].values)
+        t0 = self.sweep.time.values[0]
+        self.plot_grid.envelope(
+            self.detection_plot, 'envelope', levels, t0, 1/self.sampling,
+            created=lambda curve: curve.plot.sigXRangeChanged.connect(
+                self.sync_navigator),
+            pen='b')
+        # None unlinks a plot linked on an earlier run
+        self.detection_plot.setXLink(xlink)
+        self.counter += 1
 
         x = self.sweep.loc[self.indexes, 'time'].values
         y = self.sweep.loc[self.indexes, self.data_col].values
-        self.points_plot = self.detection_plot.plot(x, y, pen=None
-                                                    , symbol='o'
-                                                    , symbolPen='r'
-                                                    , symbolBrush='r'
-                                                    , symbolSize=7*self.ratio)
+        self.points_plot = self.plot_grid.markers(
+            self.detection_plot, 'points', x, y, self.indexes,
+            created=lambda layer: layer.sigClicked.connect(self.point_clicked),
+            symbol='o', size=7*self.ratio, pen='r', brush='r')
+        if self.show_navigator:
+            self.plot_navigator(levels, t0)
+
+    def get_pyramid(self, values):
+        key = result_cache.fingerprint([values])
+        levels = self.pyramids.pop(key, None)
+        if levels is None:
+            with profiler.stage('pyramid'):
+                levels = pyramid.MinMaxPyramid(values)
+        self.pyramids[key] = levels
+        while len(self.pyramids) > 4:
+            self.pyramids.popitem(last=False)
+        return levels
+
+    def setup_navigator(self, plot):
+        plot.setMaximumHeight(100*self.ratio)
+        plot.setMouseEnabled(x=False, y=False)
+        plot.hideAxis('left')
+        plot.hideButtons()
+        self.nav_region = pg.LinearRegionItem(brush=pg.mkBrush(0, 0, 255, 40))
+        self.nav_region.sigRegionChanged.connect(self.navigator_moved)
+        plot.addItem(self.nav_region, ignoreBounds=True)
+
+    def plot_navigator(self, levels, t0):
+        """The whole sweep with the event density under it, and the range
+        of the detection plot as a region that can be dragged."""
+        self.navigator = self.plot_grid.plot(self.counter, 0, key='navigator',
+                                             created=self.setup_navigator,
+                                             enableMenu=False)
+        self.counter += 1
+        self.plot_grid.envelope(self.navigator, 'overview', levels, t0,
+                                1/self.sampling, pen='b')
+        self.nav_range = levels.range()
+        self.update_density()
+        self.nav_region.setBounds([t0, self.sweep.time.values[-1]])
+        self.sync_navigator()
+
+    def update_density(self):
+        """Redraws the event density of the navigator, after events are
+        detected, added or removed."""
+        if self.navigator is None:
+            return
+        t0, t1 = self.sweep.time.values[[0, -1]]
+        times = self.sweep.loc[self.indexes, 'time'].values
+        counts, edges = np.histogram(times, bins=DENSITY_BINS, range=(t0, t1))
+        low, high = self.nav_range
+        density = low + counts / max(counts.max(), 1) * (high - low)
+        self.plot_grid.curve(self.navigator, 'density', edges, density,
+                             created=lambda curve: curve.setZValue(-1),
+                             stepMode=True, fillLevel=low, pen=None,
+                             brush=pg.mkBrush(255, 0, 0, 60))
+
+    def set_show_navigator(self, checked):
+        self.show_navigator = checked
+        if checked and self.navigator is None and self.detection_plot is not None:
+            self.plot_navigator(self.get_pyramid(self.sweep[self.data_col].values),
+                                self.sweep.time.values[0])
+        elif not checked and self.navigator is not None:
+            cell = self.plot_grid.remove('navigator')
+            self.navigator = None
+            if cell is not None and cell[0] == self.counter - 1:
+                self.counter -= 1
+
+    def sync_navigator(self, *_):
+        if self.navigator is None or self.detection_plot is None or self.nav_syncing:
+            return
+        self.nav_syncing = True
+        try:
+            self.nav_region.setRegion(self.detection_plot.getViewBox().viewRange()[0])
+        finally:
+            self.nav_syncing = False
 
-        self.points_plot.sigPointsClicked.connect(self.point_clicked)
+    def navigator_moved(self, region):
+        if self.detection_plot is None or self.nav_syncing:
+            return
+        self.nav_syncing = True
+        try:
+            self.detection_plot.setXRange(*region.getRegion(), padding=0)
+        finally:
+            self.nav_syncing = False
+
+    def step_event(self, step):
+        """Centres the detection plot on the next (step 1) or previous (-1)
+        event, keeping its width."""
+        if self.detection_plot is None or not self.indexes:
+            return
+        times = np.sort(self.sweep.loc[self.indexes, 'time'].values)
+        x0, x1 = self.detection_plot.getViewBox().viewRange()[0]
+        width = x1 - x0
+        duration = self.sweep.time.values[-1] - self.sweep.time.values[0]
+        if width > duration / 4:
+            width = min(EVENT_WINDOW, duration)
+        centre = (x0 + x1) / 2
+        if step > 0:
+            i = np.searchsorted(times, centre + width*1e-6, side='right')
+        else:
+            i = np.searchsorted(times, centre - width*1e-6, side='left') - 1
+        if 0 <= i < len(times):
+            self.detection_plot.setXRange(times[i] - width/2, times[i] + width/2,
+                                          padding=0)
+
+    def set_bypass_cache(self, checked):
+        self.result_cache.bypass = checked
+
+    def detection_key(self):
+        # a fit adjusted by hand is part of the input, and so is a template
+        # made from curated events
+        columns = ['time', 'primary']
+        if self.sub_trans and 'fit' in self.sweep.columns:
+            columns.append('fit')
+        arrays = [self.sweep[col].values for col in columns]
+        if self.detect_method == 'Template':
+            arrays.append(self.get_template())
+        return self.result_cache.key('pyminis.run_detection', arrays,
+                                     self.detection_params())
+
+    def detection_state(self, fitted):
+        """What run_detection found, for restore_detection. The transient
+        fit is only kept if this run made it."""
+        state = {'indexes': list(self.indexes), 'popt': None}
+        if fitted:
+            state.update(popt=[self.fit_a1, self.fit_tau1, self.fit_a2,
+                               self.fit_tau2, self.fit_c],
+                         peak_ix=self.peak_ix, peak_time=self.peak_time,
+                         fit_start_ix=self.fit_start_ix, fit_x=self.fit_x)
+        return state
+
+    def restore_detection(self, state):
+        xlink = None
+        if self.sub_trans:
+            if state['popt'] is not None:
+                self.peak_ix = state['peak_ix']
+                self.peak_time = state['peak_time']
+                self.fit_start_ix = state['fit_start_ix']
+                self.fit_x = state['fit_x']
+                self.fit_vals = batch.biexp_decay(self.fit_x, *state['popt'])
+                self.set_fit_params(state['popt'])
+                self.update_sweep_fit()
+            self.sweep['subtraction'] = self.sweep.primary - self.sweep.fit
+            xlink = self.plot_fit()
+            base = self.sweep['subtraction'].values
+        else:
+            base = self.sweep.primary.values
+        self.sweep['smthd'] = util.simple_smoothing(base, self.smth_by)
+        self.data_col = 'smthd'
+        self.indexes = list(state['indexes'])
+        self.plot_detected_events(subtraction=self.sub_trans, xlink=xlink)
 
     def run_detection(self):
-        self.clear_all()
-        if self.sub_trans and self.sweep is not None:
-            self.gen_subtraction()
-            xlink_plot = self.plot_fit()
-            self.sweep['smthd'] = util.simple_smoothing(self.sweep['subtraction'].values,
-                                                        self.smth_by)
-            #self.sweep_median = self.sweep[self.data_col].median()
-            self.data_col = 'smthd'
-            subset = self.gen_subset()
-            self.get_event_ixs(subset)
-            self.plot_detected_events(xlink=xlink_plot)
-
-        elif self.sweep is not None:
-            self.sweep['smthd'] = util.simple_smoothing(self.sweep.primary.values,
-                                                        self.smth_by)
-            #self.sweep_median = self.sweep[self.data_col].median()
-            self.data_col = 'smthd'
-            subset = self.gen_subset()
-            self.get_event_ixs(subset)
-            self.plot_detected_events(subtraction=False)
+        with profiler.stage('run_detection'):
+            self.clear_all()
+            if self.sweep is None:
+                return
+            with profiler.stage('cache_lookup'):
+                key = self.detection_key()
+                state = self.result_cache.get(key)
+            if state is not None:
+                with profiler.stage('restore_detection'):
+                    self.restore_detection(state)
+                return
+
+            fitted = self.sub_trans and 'fit' not in self.sweep.columns
+            if self.sub_trans:
+                with profiler.stage('subtraction'):
+                    self.gen_subtraction()
+                with profiler.stage('plot_fit'):
+                    xlink_plot = self.plot_fit()
+                with profiler.stage('smoothing'):
+                    self.sweep['smthd'] = util.simple_smoothing(self.sweep['subtraction'].values,
+                                                                self.smth_by)
+                #self.sweep_median = self.sweep[self.data_col].median()
+                self.data_col = 'smthd'
+                with profiler.stage('subset'):
+                    subset = self.gen_subset()
+                self.get_event_ixs(subset)
+                with profiler.stage('plot_events'):
+                    self.plot_detected_events(xlink=xlink_plot)
+
+            else:
+                with profiler.stage('smoothing'):
+                    self.sweep['smthd'] = util.simple_smoothing(self.sweep.primary.values,
+                                                                self.smth_by)
+                #self.sweep_median = self.sweep[self.data_col].median()
+                self.data_col = 'smthd'
+                with profiler.stage('subset'):
+                    subset = self.gen_subset()
+                self.get_event_ixs(subset)
+                with profiler.stage('plot_events'):
+                    self.plot_detected_events(subtraction=False)
+            self.result_cache.put(key, self.detection_state(fitted))
 
     def calc_vals(self):
+        with profiler.stage('calc_vals'):
+            self.table.setRowCount(0)
+            if any(self.indexes):
+                self.indexes.sort()
+                with profiler.stage('heights'):
+                    self.heights = self.get_heights()
+                with profiler.stage('kinetics'):
+                    self.kinetics = self.get_kinetics()
+                with profiler.stage('fill_table'):
+                    self.fill_table()
+
+    def fill_table(self):
         self.table.setRowCount(0)
-        if any(self.indexes):
-            self.indexes.sort()
-            self.heights = self.get_heights()
-
-            for i, height in enumerate(self.heights):
-                self.table.insertRow(i)
-                item = QtGui.QTableWidgetItem("%0.3f" % height)
-                self.table.setItem(i, 0, item)
+        for i, height in enumerate(self.heights):
+            self.table.insertRow(i)
+            row = [height] + self.kinetics.iloc[i].tolist()
+            for j, val in enumerate(row):
+                item = QtGui.QTableWidgetItem("%0.3f" % val)
+                self.table.setItem(i, j, item)
+
+    def get_kinetics(self):
+        # reach twice the baseline window back so the baseline precedes onset
+        pre = 2 * self.event_bsl_window
+        post = int(self.kinetics_window * self.sampling)
+        return kinetics.event_kinetics(self.sweep[self.data_col].values,
+                                       self.indexes, self.sampling, pre, post)
 
     def add_point(self, index):
         if index not in self.indexes:
             self.indexes.append(index)
-            self.update_points_plot()
+            self.points_plot.insert(index, self.sweep.loc[index, 'time'],
+                                    self.sweep.loc[index, self.data_col])
+            self.update_density()
 
     def remove_point(self, index):
         if index in self.indexes:
             self.indexes.remove(index)
-            self.update_points_plot()
+            self.points_plot.remove(index)
+            self.update_density()
 
     def update_points_plot(self):
         x = self.sweep.loc[self.indexes, 'time'].values
         y = self.sweep.loc[self.indexes, self.data_col].values
-        self.points_plot.setData(x, y
-                                 , pen=None
-                                 , symbol='o'
-                                 , symbolPen='r'
-                                 , symbolBrush='r'
-                                 , symbolSize=7*self.ratio)
+        self.points_plot.setData(x, y, self.indexes)
+        self.update_density()
 
     def find_nearest_peak(self, index, y_pos=None):
         if index < self.tolerance:
@@ -971,10 +2243,11 @@ class MiniAnalysis(QtWidgets.QMainWindow):
             self.add_point(ix)
 
     def plot_clicked(self, event):
-        if event.button()==2:
+        if event.button()==2 and self.detection_plot is not None:
             items = self.plot_widget.scene().items(event.scenePos())
+            navigator = None if self.navigator is None else self.navigator.getViewBox()
             for item in items:
-                if isinstance(item, pg.ViewBox):
+                if isinstance(item, pg.ViewBox) and item is not navigator:
                     pos = item.mapSceneToView(event.scenePos())
                     index = int(round(pos.x()*self.sampling))
                     if 0 <= index < len(self.sweep):
@@ -1012,8 +2285,9 @@ class MiniAnalysis(QtWidgets.QMainWindow):
             return a*(np.exp(-x/b)) + c*(np.exp(-x/d)) + e
 
         try:
-            popt, pcov = curve_fit(fit_eq, self.fit_x, fit_sub.primary,
-                                   guess, maxfev=10000)
+            with profiler.stage('curve_fit'):
+                popt, pcov = optimize.curve_fit(fit_eq, self.fit_x, fit_sub.primary,
+                                                guess, maxfev=10000)
         except RuntimeError:
             message = '''Fit Failed\nCheck input parameters.\nIf correct try increasing (or decreasing) end fit time'''
             self.gen_error_mbox(message)
@@ -1040,31 +2314,34 @@ class MiniAnalysis(QtWidgets.QMainWindow):
         self.poly_subset = self.gen_subset()['polyfit'].values
 
     def get_heights(self):
-        delta = self.event_bsl_window
-        heights = []
-        for ix in self.indexes:
-            if ix-delta < 0:
-                ix1 = 0
-            else:
-                ix1 = ix-delta
-
-            if ix+delta >= len(self.sweep[self.data_col]):
-                ix2 = len(self.sweep[self.data_col]) - 1
-            else:
-                ix2 = ix+delta
-
-            #max1 = np.nanmax(self.sweep.loc[ix1:ix, self.data_col].values)
-            #max2 = np.nanmax(self.sweep.loc[ix+1:ix2+1, self.data_col].values)
-            #bsl = np.mean([max1, max2])
-            bsl = np.nanmax(self.sweep.loc[ix1:ix2+1, self.data_col].values)
-            height = bsl - self.sweep.loc[ix, self.data_col]
-            heights.append(height)
-
-        return np.array(heights)
+        return detection.event_heights(self.sweep[self.data_col].values,
+                                       self.indexes, self.event_bsl_window)
+
+    def get_local_noise(self):
+        # the smoothed trace only changes with the sweep, the subtracted fit
+        # and smth_by, so the noise trace is reused across threshold changes
+        fit = (self.stim_start, self.peak_time_delta, self.end_fit,
+               self.user_a1, self.user_tau1, self.user_a2, self.user_tau2,
+               self.user_c) if self.sub_trans else None
+        key = (self.checked.text(0) if self.checked is not None else None,
+               self.sub_trans, fit, self.smth_by, self.noise_mode,
+               self.noise_window)
+        if key not in self.noise_cache:
+            window = int(self.noise_window * self.sampling)
+            self.noise_cache = {key: detection.local_noise(self.sweep[self.data_col].values,
+                                                           window, self.noise_mode)}
+        return self.noise_cache[key]
 
     def check_height(self):
         #values = np.atleast_1d(values).astype('float64')
         #indexes = np.atleast_1d(indexes).astype('int')
+        if self.noise_mode != 'Fixed region':
+            indexes = np.atleast_1d(self.indexes).astype('int')
+            noise = self.get_local_noise()[indexes]
+            heights = self.get_heights()
+            self.indexes = indexes[heights > noise*self.rms_multiple].tolist()
+            return
+
         try:
             mask = ((self.sweep.time >= self.rms_start) &
                    (self.sweep.time <= self.rms_stop))
@@ -1095,4 +2372,5 @@ if __name__ == '__main__':
     app = QtWidgets.QApplication(sys.argv)
     ex = MiniAnalysis()
     ex.show()
+    warm_up_in_background()
     sys.exit(app.exec_())
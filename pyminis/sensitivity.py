@@ -0,0 +1,100 @@
+"""Detection over a grid of smth_by, mpd, event_bsl_window and rms_multiple.
+
+The detection pipeline is staged so each stage runs once per distinct value
+of the parameters it depends on: the smoothed trace and its noise once per
+smth_by, the candidate valleys once per mpd, the heights once per
+event_bsl_window, leaving rms_multiple as a comparison on those heights.
+Each smth_by value is handled by its own worker process.
+"""
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import neurphys.utilities as util
+import detection
+from labcommon import peaks
+
+
+GRID_PARAMS = ['smth_by', 'mpd', 'event_bsl_window', 'rms_multiple']
+SUMMARY_COLUMNS = GRID_PARAMS + ['Events', 'Median amplitude (pA)',
+                                 'Mean amplitude (pA)']
+
+
+def parse_values(text, cast=float):
+    """'5, 10,20' -> [5.0, 10.0, 20.0], sorted and without repeats."""
+    return sorted({cast(val) for val in text.replace(';', ',').split(',')
+                   if val.strip()})
+
+
+def calc_rms(vals):
+    # same as MiniAnalysis.calc_rms
+    vals = np.atleast_1d(vals).astype('float64')
+    if not len(vals):
+        return np.nan
+    mean = np.nanmean(vals)
+    return np.sqrt(np.nansum(np.power(vals-mean, 2)) / len(vals))
+
+
+def smth_by_results(values, smth_by, settings):
+    """(setting, amplitudes) for every grid point sharing one smth_by."""
+    smthd = util.simple_smoothing(values, smth_by)
+    if settings['noise_mode'] == 'Fixed region':
+        lo, hi = settings['rms_region']
+        noise = calc_rms(smthd[lo:hi])
+        local_noise = None
+    else:
+        local_noise = detection.local_noise(smthd, settings['noise_window'],
+                                            settings['noise_mode'])
+
+    lo, hi = settings['detect_region']
+    results = []
+    for mpd in settings['mpd']:
+        mpd_points = int(mpd * settings['sampling'])
+        candidates = lo + peaks.detect_peaks(smthd[lo:hi], mpd=mpd_points,
+                                             valley=True)
+        if local_noise is not None:
+            noise = local_noise[candidates]
+        for bsl in settings['event_bsl_window']:
+            heights = detection.event_heights(smthd, candidates, bsl)
+            for multiple in settings['rms_multiple']:
+                keep = heights > noise*multiple
+                results.append(((smth_by, mpd, bsl, multiple), heights[keep]))
+    return results
+
+
+def parameter_grid(values, sampling, smth_by, mpd, event_bsl_window,
+                   rms_multiple, detect_region, rms_region=None,
+                   noise_mode='Fixed region', noise_window=0, workers=None):
+    """Run peak detection for every combination of the grid values.
+
+    ``detect_region`` and ``rms_region`` are (start, stop) positions in
+    ``values``, ``noise_window`` is in points. Returns a summary DataFrame
+    with one row per setting and an OrderedDict of setting -> amplitudes.
+    """
+    values = np.asarray(values, dtype='float64')
+    settings = {'sampling': sampling,
+                'mpd': sorted(set(mpd)),
+                'event_bsl_window': sorted(set(int(b) for b in event_bsl_window)),
+                'rms_multiple': sorted(set(rms_multiple)),
+                'detect_region': detect_region,
+                'rms_region': rms_region,
+                'noise_mode': noise_mode,
+                'noise_window': noise_window}
+    smth_values = sorted(set(int(s) for s in smth_by))
+
+    if workers == 1 or len(smth_values) == 1:
+        per_smth = [smth_by_results(values, s, settings) for s in smth_values]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            per_smth = list(pool.map(smth_by_results, itertools.repeat(values),
+                                     smth_values, itertools.repeat(settings)))
+
+    amplitudes = OrderedDict(itertools.chain.from_iterable(per_smth))
+    rows = []
+    for setting, amps in amplitudes.items():
+        if len(amps):
+            rows.append(setting + (len(amps), np.median(amps), np.mean(amps)))
+        else:
+            rows.append(setting + (0, np.nan, np.nan))
+    return pd.DataFrame(rows, columns=SUMMARY_COLUMNS), amplitudes
@@ -0,0 +1,55 @@
+"""Save and restore a pyminis session.
+
+A session is one .npz file. It holds the parameters as a JSON string, the
+fitted and slider-adjusted transient fit, the checked sweep with the columns
+derived from it (fit, subtraction, smthd) and the curated event indexes.
+Opening it puts the window back as it was without refitting or re-running
+detection.
+"""
+import json
+from collections import OrderedDict
+import numpy as np
+
+
+VERSION = 1
+SWEEP_COLUMNS = ['time', 'primary', 'fit', 'subtraction', 'smthd']
+SWEEP_PREFIX = 'sweep_'
+
+
+def _plain(value):
+    # numpy scalars (e.g. idxmin results) are not JSON serialisable; json
+    # expects a TypeError for anything else it cannot write
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('Object of type %s is not JSON serializable'
+                    % type(value).__name__)
+
+
+def save_session(path, params, arrays, sweep):
+    payload = {'params': np.array(json.dumps(dict(params, version=VERSION),
+                                             default=_plain))}
+    for name, vals in arrays.items():
+        if vals is not None:
+            payload[name] = np.asarray(vals)
+    for col in SWEEP_COLUMNS:
+        if col in sweep.columns:
+            payload[SWEEP_PREFIX + col] = sweep[col].values
+    np.savez(path, **payload)
+
+
+def load_session(path):
+    """Returns (params, arrays, sweep columns) as written by save_session."""
+    with np.load(path, allow_pickle=False) as f:
+        params = json.loads(str(f['params']))
+        if params.get('version', 0) > VERSION:
+            raise ValueError('Session was saved by a newer version of pyminis')
+        arrays = {}
+        columns = OrderedDict()
+        for name in f.files:
+            if name.startswith(SWEEP_PREFIX):
+                columns[name[len(SWEEP_PREFIX):]] = f[name]
+            elif name != 'params':
+                arrays[name] = f[name]
+    if 'time' not in columns or 'primary' not in columns:
+        raise ValueError('Session does not contain a sweep')
+    return params, arrays, columns
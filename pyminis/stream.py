@@ -0,0 +1,354 @@
+"""Online mini detection on a stream of sample blocks.
+
+The detector mirrors the offline pipeline in pyminis (smoothing, valley
+detection with a minimum peak distance, baseline-to-valley heights and an
+RMS threshold) but only ever looks at the samples it has already seen:
+smoothing is a trailing moving average and the noise RMS is a running
+estimate over the most recent ``rms_window`` seconds of smoothed data.
+"""
+import sys
+import time
+import argparse
+import threading
+from collections import deque, namedtuple
+import numpy as np
+
+
+MiniEvent = namedtuple('MiniEvent', ['index', 'time', 'amplitude', 'rms',
+                                     'latency'])
+
+
+class ArraySource:
+    def __init__(self, values, block_size=1024):
+        self.values = np.asarray(values)
+        self.block_size = block_size
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def __iter__(self):
+        for i in range(0, len(self.values), self.block_size):
+            if self._stop.is_set():
+                return
+            yield self.values[i:i+self.block_size]
+
+
+class PipeSource:
+    """Reads raw samples from a binary file-like object (pipe, socket.makefile)."""
+    def __init__(self, stream, dtype='<f4', block_size=1024, scale=1.0):
+        self.stream = stream
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+        self.scale = scale
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def __iter__(self):
+        nbytes = self.block_size * self.dtype.itemsize
+        leftover = b''
+        while not self._stop.is_set():
+            chunk = self.stream.read(nbytes)
+            if not chunk:
+                return
+            chunk = leftover + chunk
+            usable = len(chunk) - len(chunk) % self.dtype.itemsize
+            leftover = chunk[usable:]
+            if usable:
+                yield np.frombuffer(chunk[:usable], self.dtype) * self.scale
+
+
+class FileTailSource:
+    """Follows a raw sample file that is still being written by the acquisition."""
+    def __init__(self, path, dtype='<f4', block_size=1024, scale=1.0,
+                 poll_interval=0.002, timeout=None):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+        self.scale = scale
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def __iter__(self):
+        nbytes = self.block_size * self.dtype.itemsize
+        leftover = b''
+        last_data = time.perf_counter()
+        with open(self.path, 'rb') as f:
+            while not self._stop.is_set():
+                chunk = f.read(nbytes - len(leftover))
+                if chunk:
+                    last_data = time.perf_counter()
+                    chunk = leftover + chunk
+                    usable = len(chunk) - len(chunk) % self.dtype.itemsize
+                    leftover = chunk[usable:]
+                    if usable:
+                        yield (np.frombuffer(chunk[:usable], self.dtype) *
+                               self.scale)
+                else:
+                    idle = time.perf_counter() - last_data
+                    if self.timeout is not None and idle > self.timeout:
+                        return
+                    time.sleep(self.poll_interval)
+
+
+class RunningRMS:
+    """RMS over the last ``window`` samples, updated in O(block) per block."""
+    def __init__(self, window):
+        self.window = max(int(window), 2)
+        self._ring = np.zeros(self.window)
+        self._pos = 0
+        self._count = 0
+        self._sum = 0.0
+        self._sumsq = 0.0
+
+    def update(self, values):
+        values = np.asarray(values, dtype='float64')
+        values = values[~np.isnan(values)][-self.window:]
+        n = len(values)
+        if n == 0:
+            return
+
+        # slots that were never written hold zeros and subtract nothing
+        ixs = (self._pos + np.arange(n)) % self.window
+        old = self._ring[ixs]
+        self._sum -= old.sum()
+        self._sumsq -= np.dot(old, old)
+        self._count = min(self._count + n, self.window)
+
+        self._ring[ixs] = values
+        self._sum += values.sum()
+        self._sumsq += np.dot(values, values)
+        self._pos = (self._pos + n) % self.window
+
+    @property
+    def rms(self):
+        if self._count < 2:
+            return np.nan
+        mean = self._sum / self._count
+        return np.sqrt(max(self._sumsq / self._count - mean**2, 0))
+
+
+class OnlineDetector:
+    """Causal counterpart of get_event_ixs/check_height/get_heights.
+
+    Minimum distance suppression follows detect_peaks: a valley is dropped
+    only if a deeper valley within ``mpd`` survived, and of two equally deep
+    valleys the later one counts as the deeper. A valley is decided
+    once every deeper neighbour within ``mpd`` has been decided, and its
+    height is measured once ``event_bsl_window + 1`` samples past it have
+    arrived, so the look-ahead is bounded by those two windows.
+    """
+    def __init__(self, sampling, smth_by=10, mpd=0.01, rms_multiple=1,
+                 event_bsl_window=40, rms_window=0.1):
+        self.sampling = sampling
+        self.smth_by = smth_by
+        self.mpd_points = max(int(mpd * sampling), 1)
+        self.rms_multiple = rms_multiple
+        self.event_bsl_window = event_bsl_window
+        self.noise = RunningRMS(rms_window * sampling)
+
+        self.subscribers = []
+        self.events = []
+        self.block_latencies = deque(maxlen=1000)
+        self.samples_seen = 0
+
+        self._carry = np.empty(0)
+        self._buf = np.empty(0)
+        self._buf_start = 0
+        self._scan_from = 1
+        self._pending = []
+        self._decided = {}
+        self._queued = []
+        self._lookahead = max(self.mpd_points, event_bsl_window) + 2
+        # smoothed sample k averages raw samples k..k+smth_by-1, report the
+        # centre like simple_smoothing does
+        self._shift = (smth_by - 1) // 2
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def smooth(self, block):
+        vals = np.concatenate((self._carry, block))
+        n = self.smth_by
+        self._carry = vals[-(n-1):] if n > 1 else np.empty(0)
+        if len(vals) < n:
+            return np.empty(0)
+        cs = np.concatenate(([0], np.cumsum(vals)))
+        return (cs[n:] - cs[:-n]) / n
+
+    def process_block(self, block):
+        arrival = time.perf_counter()
+        block = np.asarray(block, dtype='float64')
+        self.samples_seen += len(block)
+
+        smthd = self.smooth(block)
+        self.noise.update(smthd)
+        self._buf = np.concatenate((self._buf, smthd))
+        end = self._buf_start + len(self._buf)
+
+        # local minima, same rule as detect_peaks(valley=True)
+        lo = self._scan_from - self._buf_start
+        if end - self._buf_start - lo >= 2:
+            seg = self._buf[lo-1:]
+            dx = np.diff(seg)
+            ine = np.where((dx[:-1] < 0) & (dx[1:] >= 0))[0]
+            self._pending.extend((ine + self._scan_from).tolist())
+            self._scan_from = end - 1
+
+        self._decide(self._scan_from - 1)
+        new_events = self._emit(end, arrival)
+        self.block_latencies.append(time.perf_counter() - arrival)
+        return new_events
+
+    def flush(self):
+        # end of stream, settle everything with the samples we have
+        arrival = time.perf_counter()
+        end = self._buf_start + len(self._buf)
+        self._decide(np.inf)
+        return self._emit(end, arrival, final=True)
+
+    def _emit(self, end, arrival, final=False):
+        new_events = []
+        rms = self.noise.rms
+        ready = [c for c in self._queued
+                 if final or c + self.event_bsl_window + 2 <= end]
+        for c in ready:
+            amp = self._height(c)
+            if amp > rms * self.rms_multiple:
+                ix = c + self._shift
+                event = MiniEvent(ix, ix / self.sampling, amp, rms,
+                                  time.perf_counter() - arrival)
+                new_events.append(event)
+        self._queued = self._queued[len(ready):]
+        self._trim(end)
+
+        for event in new_events:
+            self.events.append(event)
+            for callback in self.subscribers:
+                callback(event)
+
+        return new_events
+
+    def _value(self, ix):
+        return self._buf[ix - self._buf_start]
+
+    def _decide(self, scanned):
+        mpd = self.mpd_points
+        pending = np.array(self._pending, dtype='int64')
+        if not len(pending):
+            return
+        dec_ix = np.array(list(self._decided), dtype='int64')
+        dec_state = np.array([1 if kept else -1
+                              for kept in self._decided.values()], dtype='int8')
+
+        cands = np.concatenate((dec_ix, pending))
+        state = np.concatenate((dec_state, np.zeros(len(pending), 'int8')))
+        order = np.argsort(cands, kind='stable')
+        cands = cands[order]
+        state = state[order]
+        vals = self._buf[cands - self._buf_start]
+        left = np.searchsorted(cands, cands - mpd, 'left')
+        right = np.searchsorted(cands, cands + mpd, 'right')
+
+        # deepest first, so a valley's deeper neighbours are settled first;
+        # ties go to the later valley, which detect_peaks' reversed argsort
+        # visits first
+        todo = np.where((state == 0) & (cands + mpd <= scanned))[0]
+        for p in todo[np.lexsort((-cands[todo], vals[todo]))]:
+            nb = slice(left[p], right[p])
+            deeper = state[nb][(vals[nb] < vals[p]) |
+                               ((vals[nb] == vals[p]) & (cands[nb] > cands[p]))]
+            if (deeper == 0).any():
+                continue
+            state[p] = -1 if (deeper == 1).any() else 1
+
+        newly = (state != 0) & np.isin(cands, pending)
+        self._queued.extend(cands[newly & (state == 1)].tolist())
+        self._queued.sort()
+        self._pending = cands[state == 0].tolist()
+
+        oldest = min(self._pending + [scanned, cands[-1]]) - mpd
+        keep = (state != 0) & (cands >= oldest)
+        self._decided = dict(zip(cands[keep].tolist(),
+                                 (state[keep] == 1).tolist()))
+
+    def _height(self, c):
+        delta = self.event_bsl_window
+        ix1 = max(c - delta - self._buf_start, 0)
+        ix2 = c + delta + 2 - self._buf_start
+        bsl = np.nanmax(self._buf[ix1:ix2])
+        return bsl - self._value(c)
+
+    def _trim(self, end):
+        earliest = min(self._pending + self._queued +
+                       list(self._decided) + [end - 2])
+        keep_from = earliest - self.event_bsl_window - 1
+        cut = keep_from - self._buf_start
+        if cut > 0:
+            self._buf = self._buf[cut:]
+            self._buf_start = keep_from
+
+    def run(self, source):
+        for block in source:
+            self.process_block(block)
+        self.flush()
+
+    def latency_stats(self):
+        if not self.block_latencies:
+            return None
+        lat = np.array(self.block_latencies) * 1e3
+        return {'mean (ms)': lat.mean(),
+                'p95 (ms)': np.percentile(lat, 95),
+                'max (ms)': lat.max(),
+                'look-ahead (ms)': self._lookahead / self.sampling * 1e3}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Online mini detection on '
+                                     'a raw sample stream')
+    parser.add_argument('path', nargs='?', default='-',
+                        help="raw sample file to follow, '-' for stdin")
+    parser.add_argument('--sampling', type=float, required=True)
+    parser.add_argument('--dtype', default='<f4')
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--block-size', type=int, default=1024)
+    parser.add_argument('--smth-by', type=int, default=10)
+    parser.add_argument('--mpd', type=float, default=0.01)
+    parser.add_argument('--rms-multiple', type=float, default=1)
+    parser.add_argument('--rms-window', type=float, default=0.1)
+    parser.add_argument('--event-bsl-window', type=int, default=40)
+    parser.add_argument('--timeout', type=float, default=None)
+    args = parser.parse_args(argv)
+
+    if args.path == '-':
+        source = PipeSource(sys.stdin.buffer, args.dtype, args.block_size,
+                            args.scale)
+    else:
+        source = FileTailSource(args.path, args.dtype, args.block_size,
+                                args.scale, timeout=args.timeout)
+
+    detector = OnlineDetector(args.sampling, args.smth_by, args.mpd,
+                              args.rms_multiple, args.event_bsl_window,
+                              args.rms_window)
+    detector.subscribe(lambda e: print('%0.5f\t%0.3f\t%0.2f ms' %
+                                       (e.time, e.amplitude, e.latency*1e3),
+                                       flush=True))
+    try:
+        detector.run(source)
+    except KeyboardInterrupt:
+        pass
+
+    stats = detector.latency_stats()
+    if stats is not None:
+        print(', '.join('%s: %0.3f' % (k, v) for k, v in stats.items()),
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""The pyminis result cache key covers everything detection depends on."""
+import os
+import sys
+import types
+
+import numpy as np
+import pytest
+
+pytest.importorskip('PyQt5')
+pytest.importorskip('pyqtgraph')
+pd = pytest.importorskip('pandas')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'pyminis'))
+
+import pyminis
+from labcommon import result_cache
+
+
+def window(tmp_path, template):
+    """Just what detection_key reads of a MiniAnalysis window."""
+    win = types.SimpleNamespace(
+        sweep=pd.DataFrame({'time': np.arange(1000) / 1e4,
+                            'primary': np.sin(np.arange(1000.0))}),
+        sub_trans=False, detect_method='Template', template=template,
+        sampling=1e4, template_rise=0.0005, template_decay=0.003,
+        result_cache=result_cache.ResultCache(str(tmp_path)))
+    win.detection_params = lambda: {'detect_method': win.detect_method}
+    win.get_template = types.MethodType(pyminis.MiniAnalysis.get_template, win)
+    return win
+
+
+def key(win):
+    return pyminis.MiniAnalysis.detection_key(win)
+
+
+def test_template_changes_key(tmp_path):
+    first = window(tmp_path, np.hanning(50))
+    second = window(tmp_path, np.hanning(60))
+    assert key(first) != key(second)
+    assert key(first) == key(window(tmp_path, np.hanning(50)))
+
+
+def test_template_ignored_for_other_methods(tmp_path):
+    first = window(tmp_path, np.hanning(50))
+    second = window(tmp_path, np.hanning(60))
+    first.detect_method = second.detect_method = 'Peaks'
+    assert key(first) == key(second)